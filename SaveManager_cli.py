@@ -0,0 +1,412 @@
+import os
+import sys
+import ast
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import threading
+
+import backup_runner
+import size_cache
+import snapshot_store
+
+# Headless runner for the folder pairs saved by the app, for schedulers, login
+# scripts and machines without a display. Uses the app's save_folders.json and
+# settings.ini and the same copy engine, so runs behave like the Copy and
+# Verify buttons. Must not import dearpygui, dxcam, cv2 or keyboard.
+#
+#   python SaveManager_cli.py                 copy every folder pair
+#   python SaveManager_cli.py "Elden Ring"    copy the named pairs only
+#   python SaveManager_cli.py --verify        verify instead of copying
+#   python SaveManager_cli.py --json          JSON lines instead of text
+#   python SaveManager_cli.py --snapshots     list the snapshots of snapshot pairs
+#   python SaveManager_cli.py "Elden Ring" --restore 2025-04-10_18-30-00 --to D:\Restore
+#   python SaveManager_cli.py "Elden Ring" --restore-file saves\slot1.sl2 --to D:\Restore
+
+exit_ok = 0
+exit_failed = 1  # the run failed, or the configuration could not be read
+exit_usage = 2  # bad arguments or unknown folder pair names
+exit_incomplete = 3  # finished, but pairs were skipped or files failed
+exit_mismatch = 4  # verification found changed or missing files
+exit_cancelled = 130
+
+progress_interval: float = 0.5  # seconds between progress lines
+
+
+def default_data_dir():
+    # Same places the app uses: app_data next to the executable (or in the
+    # working folder when run from source), else the installed app's folder
+    if "__compiled__" in globals():
+        base_path = os.path.dirname(sys.executable)
+    else:
+        base_path = os.path.abspath(".")
+    local_data_dir = os.path.join(base_path, "app_data")
+    if not os.path.isdir(local_data_dir) and os.getenv("LOCALAPPDATA"):
+        return os.path.join(os.getenv("LOCALAPPDATA"), "SaveManager", "app_data")
+    return local_data_dir
+
+
+class Reporter:
+    # Turns progress queue events into text lines or JSON lines on stdout
+
+    def __init__(self, json_output, quiet, verbose):
+        self.json_output = json_output
+        self.quiet = quiet
+        self.verbose = verbose
+        self.live = not json_output and not quiet and sys.stderr.isatty()
+        self.total_bytes = 0
+        self.copied_bytes = 0
+        self.errors = 0
+        self.start_time = time.monotonic()
+        self.last_progress = 0.0
+
+    def emit(self, event, **fields):
+        print(json.dumps({"event": event, **fields}), flush=True)
+
+    def line(self, text, stream=None):
+        if self.live:
+            # Clear the progress line first
+            sys.stderr.write("\r\033[K")
+        print(text, file=stream or sys.stdout, flush=True)
+
+    def log(self, message, tag):
+        if tag == "error":
+            self.errors += 1
+        if self.json_output:
+            self.emit("log", tag=tag, message=message)
+        elif not self.quiet or tag == "error":
+            self.line(f"[{tag}] {message}", sys.stderr if tag == "error" else None)
+
+    def handle(self, item_type, data):
+        if item_type == "log_batch":
+            for log_type, log_data in data:
+                self.handle(log_type, log_data)
+        elif item_type == "log_message":
+            message, color, tag = data
+            self.log(message, tag)
+        elif item_type == "log_error":
+            message, context_tag = data
+            self.log(f"{message} ({context_tag})", "error")
+        elif item_type == "start":
+            self.total_bytes = data or 0
+            self.start_time = time.monotonic()
+            if self.json_output:
+                self.emit("start", total_bytes=self.total_bytes)
+        elif item_type == "adjust_total":
+            self.total_bytes = data
+        elif item_type == "progress":
+            self.copied_bytes = data
+            self.show_progress()
+        elif item_type == "update":
+            if self.json_output:
+                self.emit("status", message=data)
+            elif self.verbose:
+                self.line(data)
+        elif item_type in ("complete", "cancel", "error"):
+            if self.json_output:
+                self.emit(item_type, message=data)
+            elif item_type == "error":
+                self.line(f"FATAL ERROR: {data}", sys.stderr)
+            else:
+                self.line(data)
+
+    def show_progress(self):
+        now = time.monotonic()
+        if now - self.last_progress < progress_interval:
+            return
+        self.last_progress = now
+        elapsed = max(now - self.start_time, 1e-6)
+        if self.json_output:
+            self.emit(
+                "progress",
+                copied_bytes=self.copied_bytes,
+                total_bytes=self.total_bytes,
+                bytes_per_second=round(self.copied_bytes / elapsed),
+            )
+        elif self.live:
+            percent = (
+                100 * self.copied_bytes / self.total_bytes if self.total_bytes else 0
+            )
+            sys.stderr.write(
+                f"\r\033[K{percent:5.1f}%  {size_cache.format_size(self.copied_bytes)} of {size_cache.format_size(self.total_bytes)}  {size_cache.format_size(self.copied_bytes / elapsed)}/s"
+            )
+            sys.stderr.flush()
+
+
+def exit_code(result, skipped, reporter, verify):
+    if result.status == "error":
+        return exit_failed
+    if result.status == "cancel":
+        return exit_cancelled
+    if verify and (result.verify.mismatched or result.verify.missing):
+        return exit_mismatch
+    if skipped or result.skipped or reporter.errors or not result.done:
+        return exit_incomplete
+    return exit_ok
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Copy or verify Save Manager folder pairs without the window.",
+        epilog="Exit codes: 0 done, 1 failed, 2 bad arguments, 3 finished with skipped pairs or errors, 4 verification found differences, 130 cancelled.",
+    )
+    parser.add_argument(
+        "pairs", nargs="*", help="names of the folder pairs to run (default: all)"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="folder with save_folders.json and settings.ini (default: the app's)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="verify the destinations against the recorded hashes instead of copying",
+    )
+    parser.add_argument("--list", action="store_true", help="list the folder pairs")
+    parser.add_argument(
+        "--snapshots",
+        action="store_true",
+        help="list the snapshots of folder pairs in snapshot mode",
+    )
+    parser.add_argument(
+        "--restore",
+        metavar="SNAPSHOT",
+        help="restore a snapshot (an id from --snapshots) into the --to folder",
+    )
+    parser.add_argument(
+        "--restore-file",
+        metavar="PATH",
+        help="restore one file (its path inside the source) from the archive of the named pair into the --to folder",
+    )
+    parser.add_argument(
+        "--to",
+        metavar="FOLDER",
+        help="where --restore and --restore-file put the files",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a setting for this run, e.g. --set throttle_mb_s=20",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only print errors and the summary"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print status and debug messages"
+    )
+    args = parser.parse_args(argv)
+    if args.restore and not args.to:
+        parser.error("--restore needs --to")
+    if args.restore_file and not args.to:
+        parser.error("--restore-file needs --to")
+    if args.restore_file and len(args.pairs) != 1:
+        parser.error("--restore-file needs the name of one folder pair")
+    return args
+
+
+def pair_snapshots(settings, pairs):
+    # (pair, destination, store, header) for every snapshot of the pairs
+    found = []
+    for pair in pairs:
+        if pair["mode"] != snapshot_store.mode:
+            continue
+        for dest in backup_runner.pair_destinations(pair):
+            store = snapshot_store.SnapshotStore(
+                backup_runner.pair_destination(settings, pair["source"], dest)
+            )
+            for header in store.snapshots(pair["source"]):
+                found.append((pair, dest, store, header))
+    return found
+
+
+def list_snapshots(settings, pairs, json_output):
+    for pair, dest, store, header in pair_snapshots(settings, pairs):
+        if json_output:
+            print(json.dumps({**header, "destination": dest}))
+        else:
+            print(
+                f"{pair['name']}: {header['id']}  {header['files']} files, {size_cache.format_size(header['size'])}, "
+                f"{header['new_files']} new ({size_cache.format_size(header['new_bytes'])})  in '{dest}'"
+            )
+    return exit_ok
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        stream=sys.stderr,
+    )
+    data = backup_runner.DataDir(args.data_dir or default_data_dir())
+
+    try:
+        settings = backup_runner.load_settings(
+            data.settings_file, backup_runner.default_settings()
+        )
+        pairs = backup_runner.load_pairs(data.pairs_file)
+    except (OSError, ValueError, SyntaxError) as e:
+        print(f"Cannot read the configuration in '{data.path}': {e}", file=sys.stderr)
+        return exit_failed
+
+    for override in args.set:
+        key, _, value = override.partition("=")
+        if key not in settings:
+            print(f"Unknown setting '{key}'", file=sys.stderr)
+            return exit_usage
+        try:
+            settings[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            # Bare strings, like --set copy_backend=readinto
+            settings[key] = value
+
+    if args.list:
+        sizes = size_cache.SizeCache(data.size_cache)
+        for pair in pairs:
+            cached = sizes.get(pair["source"])
+            if args.json:
+                if cached is not None:
+                    pair = {**pair, "size": cached["size"], "files": cached["files"]}
+                print(json.dumps(pair))
+            else:
+                size = f", {size_cache.describe(cached)}" if cached else ""
+                print(
+                    f"{pair['name']}: {pair['source']} -> {', '.join(backup_runner.pair_destinations(pair))} ({pair['mode']}{size})"
+                )
+        return exit_ok
+
+    if args.pairs:
+        by_name = {pair["name"]: pair for pair in pairs}
+        unknown = [name for name in args.pairs if name not in by_name]
+        if unknown:
+            print(f"Unknown folder pairs: {', '.join(unknown)}", file=sys.stderr)
+            return exit_usage
+        pairs = [by_name[name] for name in dict.fromkeys(args.pairs)]
+
+    if args.snapshots:
+        return list_snapshots(settings, pairs, args.json)
+
+    reporter = Reporter(args.json, args.quiet, args.verbose)
+    progress_queue = queue.Queue()
+    cancel_flag = threading.Event()
+    progress = backup_runner.new_progress(settings, progress_queue, cancel_flag)
+    valid_pairs = []
+    skipped = []
+    if args.restore:
+        # The same snapshot may be in several destinations of one pair
+        matches = [
+            (pair, store, header)
+            for pair, dest, store, header in pair_snapshots(settings, pairs)
+            if header["id"] == args.restore
+        ]
+        if not matches:
+            print(f"Unknown snapshot '{args.restore}'", file=sys.stderr)
+            return exit_usage
+        if len({pair["name"] for pair, store, header in matches}) > 1:
+            print(
+                f"Several folder pairs have a snapshot '{args.restore}'; name the pair to restore",
+                file=sys.stderr,
+            )
+            return exit_usage
+        pair, store, header = matches[0]
+
+        def run():
+            return backup_runner.restore_snapshot(
+                settings, store, header, args.to, progress, cancel_flag
+            )
+
+    elif args.restore_file:
+        pair = pairs[0]
+
+        def run():
+            return backup_runner.restore_archive_file(
+                settings, pair, args.restore_file, args.to, progress, cancel_flag
+            )
+
+    else:
+        for pair in pairs:
+            problems = backup_runner.check_pair(pair, need_source=not args.verify)
+            for message in problems:
+                reporter.log(message, "error")
+            if problems:
+                skipped.append(pair["name"])
+            else:
+                valid_pairs.append(pair)
+        run_pairs = (
+            backup_runner.verify_pairs if args.verify else backup_runner.copy_pairs
+        )
+
+        def run():
+            return run_pairs(settings, data, valid_pairs, progress, cancel_flag)
+
+    results = []
+
+    def run_thread():
+        try:
+            results.append(run())
+            # Old generations are still being deleted
+            for thread in results[0].background:
+                thread.join()
+        finally:
+            progress_queue.put(("finished", None))
+
+    def cancel(signal_number, frame):
+        cancel_flag.set()
+
+    # Ctrl+C and schedulers stopping the task cancel like the Cancel button
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
+
+    start = time.monotonic()
+    threading.Thread(target=run_thread, daemon=True, name="backup").start()
+    while True:
+        try:
+            item_type, item_data = progress_queue.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        if item_type == "finished":
+            break
+        reporter.handle(item_type, item_data)
+
+    if not results:
+        # The run thread itself failed; the traceback was already printed
+        return exit_failed
+    result = results[0]
+    code = exit_code(result, skipped, reporter, args.verify)
+    summary = {
+        "status": result.status,
+        "message": result.message,
+        "exit_code": code,
+        "pairs_done": result.done,
+        "pairs_skipped": skipped + result.skipped,
+        "errors": reporter.errors,
+        "copied_bytes": progress.copied_bytes,
+        "unchanged_files": progress.unchanged_files,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    if args.verify:
+        summary["verify"] = {
+            "verified": result.verify.verified,
+            "mismatched": result.verify.mismatched,
+            "missing": result.verify.missing,
+            "unhashed": result.verify.unhashed,
+        }
+    if args.json:
+        reporter.emit("summary", **summary)
+    else:
+        reporter.line(
+            f"{len(result.done)} folder pairs done, {len(summary['pairs_skipped'])} skipped, "
+            f"{reporter.errors} errors, {size_cache.format_size(progress.copied_bytes)} in {summary['seconds']:.1f} s"
+        )
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,10 +17,16 @@ import ast
 import dxcam
 import cv2
 import logging
-import shutil
+import functools
 import pywinstyles
 from win32 import win32gui
-
+import copy_engine
+import file_walker
+import folder_watch
+import backup_runner
+import fan_out
+import ignore_rules
+import size_cache
 
 app_version: str = "2.6.2_Windows"
 release_date: str = "4/10/2025"
@@ -28,15 +34,25 @@ release_date: str = "4/10/2025"
 sources: list = []
 destinations: list = []
 names: list = []
+modes: list = []
+ignore_patterns: list = []  # per-pair ignore rules, see ignore_rules.py
+extra_destinations: list = []  # per-pair lists of further destinations, see fan_out.py
+pending_extra_destinations: list = []  # picked for the pair being added
+
+destination_modes: dict = {
+    "Copy files": "copy",
+    "Archive (.tar)": "tar",
+    "Archive (.tar.gz)": "tar.gz",
+    "Archive (.zip)": "zip",
+    "Archive (.zip, compressed)": "zip-deflated",
+    "Snapshots (deduplicated)": "snapshot",
+    "Generations (hardlinked folders)": "generations",
+}
 
 settings: dict = {
-    "copy_folder_checkbox_state": False,
-    "file_size_limit": 5,
+    **backup_runner.default_settings(),
     "show_image_status": False,
     "remember_window_pos": True,
-    "skip_existing_files": True,
-    "clear_destination_folder": False,
-    "skip_hidden_files": False,
     "file_extensions": [".sav", ".save", ".dat"],
     "folder_paths": [
         "C:\\Program Files",
@@ -47,7 +63,7 @@ settings: dict = {
         os.path.join(os.path.expanduser("~"), "Documents"),
         "C:\\Users\\Public\\Documents",
     ],
-    "ignored_folders": [],
+    "watch_mode": False,
 }
 
 recording_settings: dict = {
@@ -71,6 +87,10 @@ max_log_entries = 500
 config = configparser.ConfigParser()
 progress_queue = queue.Queue()
 cancel_flag = threading.Event()
+# Manual runs, verification and continuous backup copies take turns
+copy_run_lock = threading.Lock()
+watchers: list = []
+watch_cancel_flag = threading.Event()
 
 
 """def resource_path(relative_path):
@@ -105,8 +125,10 @@ data_dir = os.path.join(os.getenv("LOCALAPPDATA"), "SaveManager\\app_data")
 if not os.path.exists(data_dir):
     os.makedirs(data_dir, exist_ok=True)
 
-json_file_path = os.path.join(data_dir, "save_folders.json")
-config_file = os.path.join(data_dir, "settings.ini")
+data_paths = backup_runner.DataDir(data_dir)
+json_file_path = data_paths.pairs_file
+config_file = data_paths.settings_file
+manifest_dir = data_paths.manifests
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -194,27 +216,77 @@ def reset_settings():
                     logging.debug("Reset font_size from config file")
 
 
+def mode_label(mode):
+    for label, mode_id in destination_modes.items():
+        if mode_id == mode:
+            return label
+    return mode
+
+
+def pair_header_label(name, source, sizes):
+    # Headers show the source's size as of its last scan
+    summary = size_cache.describe(sizes.get(source))
+    if summary:
+        return f"Folder Pair: {name}  ({summary})"
+    return f"Folder Pair: {name}"
+
+
+def refresh_pair_headers():
+    sizes = size_cache.SizeCache(data_paths.size_cache)
+    headers = [
+        item
+        for item in dpg.get_item_children("entry_list", slot=1)
+        if dpg.get_item_type(item) == "mvAppItemType::mvCollapsingHeader"
+    ]
+    for item, name, source in zip(headers, names, sources):
+        dpg.configure_item(item, label=pair_header_label(name, source, sizes))
+
+
+def add_extra_destination_texts(extras, parent):
+    for extra in extras:
+        extra_item_id = dpg.add_text(
+            f" Also to: {extra}",
+            wrap=0,
+            color=(171, 71, 188),
+            parent=parent,
+            user_data=extra,
+        )
+        with dpg.item_handler_registry(tag=f"text_handler_{extra_item_id}"):
+            dpg.add_item_clicked_handler(user_data=extra, callback=text_click_handler)
+        dpg.bind_item_handler_registry(extra_item_id, f"text_handler_{extra_item_id}")
+
+
 def load_entries():
-    global sources, destinations, names
+    global sources, destinations, names, modes, ignore_patterns, extra_destinations
 
     sources.clear()
     destinations.clear()
     names.clear()
+    modes.clear()
+    ignore_patterns.clear()
+    extra_destinations.clear()
 
     if os.path.exists(json_file_path):
+        sizes = size_cache.SizeCache(data_paths.size_cache)
         with open(json_file_path, "r") as f:
             entries = json.load(f)
             for entry in entries:
                 entry_name = entry["name"]
                 entry_source = entry["source"]
                 entry_dest = entry["destination"]
+                entry_mode = entry.get("mode", "copy")
+                entry_ignore = entry.get("ignore", [])
+                entry_extras = entry.get("extra_destinations", [])
 
                 names.append(entry_name)
                 sources.append(entry_source)
                 destinations.append(entry_dest)
+                modes.append(entry_mode)
+                ignore_patterns.append(entry_ignore)
+                extra_destinations.append(entry_extras)
 
                 item_id = dpg.add_collapsing_header(
-                    label=f"Folder Pair: {entry_name}",
+                    label=pair_header_label(entry_name, entry_source, sizes),
                     parent="entry_list",
                 )
                 with dpg.theme() as entry_item_theme:
@@ -241,6 +313,21 @@ def load_entries():
                     parent=item_id,
                     user_data=entry_dest,
                 )
+                add_extra_destination_texts(entry_extras, item_id)
+                if entry_mode != "copy":
+                    dpg.add_text(
+                        f" Mode: {mode_label(entry_mode)}",
+                        wrap=0,
+                        color=(255, 140, 0),
+                        parent=item_id,
+                    )
+                if entry_ignore:
+                    dpg.add_text(
+                        f" Ignore: {', '.join(entry_ignore)}",
+                        wrap=0,
+                        color=(139, 140, 0),
+                        parent=item_id,
+                    )
 
                 with dpg.item_handler_registry(tag=f"text_handler_{source_item_id}"):
                     dpg.add_item_clicked_handler(
@@ -270,23 +357,38 @@ def load_entries():
 
 
 def save_entries():
-    global sources, destinations, names
+    global sources, destinations, names, modes, ignore_patterns, extra_destinations
 
     entries = []
-    for name, source, destination in zip(names, sources, destinations):
-        entries.append({"name": name, "source": source, "destination": destination})
+    for name, source, destination, extras, mode, ignore in zip(
+        names, sources, destinations, extra_destinations, modes, ignore_patterns
+    ):
+        entries.append(
+            {
+                "name": name,
+                "source": source,
+                "destination": destination,
+                "extra_destinations": extras,
+                "mode": mode,
+                "ignore": ignore,
+            }
+        )
     with open(json_file_path, "w") as f:
         json.dump(entries, f, indent=4)
     dpg.set_value("status_text", "Folder pairs saved successfully.")
     logging.debug("Copy Manager entries saved to JSON")
+    start_watchers()
 
 
 def clear_entries_callback(sender, app_data):
-    global sources, destinations, names
+    global sources, destinations, names, modes, ignore_patterns, extra_destinations
 
     sources.clear()
     destinations.clear()
     names.clear()
+    modes.clear()
+    ignore_patterns.clear()
+    extra_destinations.clear()
 
     dpg.delete_item("entry_list", children_only=True)
     dpg.set_value("status_text", "All folder pairs cleared.")
@@ -295,15 +397,19 @@ def clear_entries_callback(sender, app_data):
         os.remove(json_file_path)
         logging.debug("JSON file deleted upon clearing entries")
     load_entries()
+    start_watchers()
 
 
 def clear_latest_entry(sender, app_data):
-    global sources, destinations, names
+    global sources, destinations, names, modes, ignore_patterns, extra_destinations
 
     try:
         sources.pop()
         destinations.pop()
         names.pop()
+        modes.pop()
+        ignore_patterns.pop()
+        extra_destinations.pop()
     except IndexError:
         return
 
@@ -318,7 +424,7 @@ def clear_latest_entry(sender, app_data):
 
 
 def add_entry_callback(sender, app_data):
-    global sources, destinations, names
+    global sources, destinations, names, modes, ignore_patterns, extra_destinations
 
     name = dpg.get_value("name_input")
     if name in names:
@@ -331,10 +437,28 @@ def add_entry_callback(sender, app_data):
     if name and sources and destinations:
         current_source = sources[-1]
         current_destination = destinations[-1]
+        current_mode = destination_modes[dpg.get_value("mode_input")]
+        current_ignore = [
+            pattern.strip()
+            for pattern in dpg.get_value("ignore_input").split(",")
+            if pattern.strip()
+        ]
+
+        current_extras = [
+            extra
+            for extra in dict.fromkeys(pending_extra_destinations)
+            if extra != current_destination
+        ]
+        pending_extra_destinations.clear()
 
         names.append(name)
+        modes.append(current_mode)
+        ignore_patterns.append(current_ignore)
+        extra_destinations.append(current_extras)
         item_id = dpg.add_collapsing_header(
-            label=f"Folder Pair: {name}",
+            label=pair_header_label(
+                name, current_source, size_cache.SizeCache(data_paths.size_cache)
+            ),
             parent="entry_list",
         )
         with dpg.theme() as entry_item_theme:
@@ -359,6 +483,21 @@ def add_entry_callback(sender, app_data):
             parent=item_id,
             user_data=current_destination,
         )
+        add_extra_destination_texts(current_extras, item_id)
+        if current_mode != "copy":
+            dpg.add_text(
+                f" Mode: {mode_label(current_mode)}",
+                wrap=0,
+                color=(255, 140, 0),
+                parent=item_id,
+            )
+        if current_ignore:
+            dpg.add_text(
+                f" Ignore: {', '.join(current_ignore)}",
+                wrap=0,
+                color=(139, 140, 0),
+                parent=item_id,
+            )
 
         with dpg.item_handler_registry(tag=f"text_handler_{source_item_id}"):
             dpg.add_item_clicked_handler(
@@ -375,7 +514,9 @@ def add_entry_callback(sender, app_data):
 
         dpg.set_value("source_display", "")
         dpg.set_value("destination_display", "")
+        dpg.set_value("extra_destination_display", "")
         dpg.set_value("name_input", "")
+        dpg.set_value("ignore_input", "")
         dpg.set_value("status_text", f"Added folder pair: '{name}'")
         if dpg.does_item_exist("no_entries_text"):
             dpg.delete_item("no_entries_text")
@@ -587,261 +728,225 @@ def set_log_filter(sender, app_data):
         logging.error(f"Exception occurred with log filter: {e}")
 
 
-def delete_folder_with_children():
-    global destinations
+def pair_destination(source, dest):
+    return backup_runner.pair_destination(settings, source, dest)
 
-    dpg.set_value("status_text", "Clearing destination folders...")
-    for destination_folder in destinations:
-        if not os.path.exists(destination_folder):
-            logging.error(
-                f"The folder '{destination_folder}' does not exist. (this error should not be possible if everything above works correctly)"
-            )
-            return
 
-        for item in os.listdir(destination_folder):
-            item_path = os.path.join(destination_folder, item)
-            try:
-                if os.path.isfile(item_path) or os.path.islink(item_path):
-                    # Delete files and symbolic links
-                    os.unlink(item_path)
-                    dpg.add_text(
-                        f"Deleted file: '{item_path}'",
-                        color=(139, 140, 0),
-                        wrap=0,
-                        parent="copy_log",
-                        user_data="delete",
-                    )
-                elif os.path.isdir(item_path):
-                    # Optionally, delete subfolders and their contents
-                    shutil.rmtree(item_path)
-                    dpg.add_text(
-                        f"Deleted folder and its contents: '{item_path}'",
-                        color=(139, 140, 0),
-                        wrap=0,
-                        parent="copy_log",
-                        user_data="delete",
-                    )
-            except Exception as e:
-                dpg.add_text(
-                    f"Failed to delete '{item_path}': {e}",
-                    color=(229, 57, 53),
-                    wrap=0,
-                    parent="copy_log",
-                    user_data="error",
+def new_progress(target_queue=None, stop_flag=None):
+    return backup_runner.new_progress(
+        settings,
+        target_queue if target_queue is not None else progress_queue,
+        stop_flag if stop_flag is not None else cancel_flag,
+    )
+
+
+def folder_pairs(indexes):
+    return [
+        {
+            "name": names[index],
+            "source": sources[index],
+            "destination": destinations[index],
+            "extra_destinations": extra_destinations[index],
+            "mode": modes[index],
+            "ignore": ignore_patterns[index],
+        }
+        for index in indexes
+    ]
+
+
+def acquire_copy_lock(progress, message):
+    if not copy_run_lock.acquire(blocking=False):
+        progress.send("update", message)
+        copy_run_lock.acquire()
+
+
+def watch_copy(source, dests, name, ignore, files, dirs, rescan):
+    # Runs on a folder watcher thread with one debounced batch of changes
+    global settings, progress_queue, watch_cancel_flag
+
+    dests = [pair_destination(source, dest) for dest in dests if os.path.isdir(dest)]
+    if not dests:
+        return
+    rules = ignore_rules.IgnoreRules(settings["ignored_folders"] + ignore, source)
+    progress = new_progress(
+        folder_watch.LogOnlyQueue(progress_queue), watch_cancel_flag
+    )
+    if rescan:
+        # Events were lost: compare the whole source against the manifest
+        plan = copy_engine.scan_folder(
+            source,
+            rules,
+            settings["skip_hidden_files"],
+            watch_cancel_flag,
+            progress,
+        )
+    else:
+        plan = folder_watch.plan_changes(
+            source,
+            files,
+            dirs,
+            rules,
+            settings["skip_hidden_files"],
+        )
+    if plan is None or not (plan.files or plan.dirs):
+        return
+
+    acquire_copy_lock(progress, "Waiting for the running operation to finish...")
+    try:
+        progress.send(
+            "update",
+            f"Continuous backup: copying {len(plan.files)} changed files of '{name}'",
+        )
+        run = copy_engine.CopyRun(
+            progress,
+            watch_cancel_flag,
+            backend=settings["copy_backend"],
+            delta=backup_runner.new_delta_copier(settings, data_paths),
+            verify=settings["verify_copies"],
+        )
+        destinations = []
+        for dest in dests:
+            for rel_dir_path in plan.dirs:
+                run.dirs.make(os.path.join(dest, rel_dir_path))
+
+            manifest = None
+            if rescan or settings["incremental_copy"] or settings["verify_copies"]:
+                manifest = copy_engine.Manifest(
+                    os.path.join(manifest_dir, copy_engine.manifest_name(source, dest)),
+                    settings["incremental_hash"],
+                    rescan,
                 )
-                logging.error(f"Deleting files failed: {e}")
+                if not rescan:
+                    # Only the changed files are recorded; keep everything else
+                    manifest.current.update(manifest.previous)
+            destinations.append(fan_out.Destination(dest, manifest))
+        workers = backup_runner.worker_count(settings, source, dests[0])
+        if len(destinations) == 1:
+            completed = copy_engine.copy_files(
+                plan.jobs(dests[0]), run, workers, destinations[0].manifest
+            )
+        else:
+            completed = fan_out.FanOut(name, destinations, run, workers).copy_files(
+                plan
+            )
+        for destination in destinations:
+            if destination.manifest is not None:
+                destination.manifest.save()
+        if completed:
+            message = f"Continuous backup of '{name}': {len(plan.files) - progress.unchanged_files} changed files copied"
+            progress.log(message, (0, 140, 139), "copy")
+            progress.send("update", message)
+    finally:
+        progress.flush()
+        copy_run_lock.release()
 
 
-def get_folder_size(source):
-    global settings
+def stop_watchers():
+    global watchers, watch_cancel_flag
+
+    watch_cancel_flag.set()
+    for watcher in watchers:
+        watcher.stop()
+    watchers = []
+
 
-    total_size = 0
-    for root, dirs, files in os.walk(source):
-        # Check if the current folder should be ignored
-        current_folder_abs = os.path.abspath(root)
-        if current_folder_abs in settings["ignored_folders"]:
-            dirs[:] = []
+def start_watchers():
+    # (Re)starts continuous backup for the current folder pairs
+    global watchers, watch_cancel_flag, settings
+
+    stop_watchers()
+    if not settings["watch_mode"]:
+        return
+    watch_cancel_flag = threading.Event()
+    for name, source, dest, extras, mode, ignore in zip(
+        names, sources, destinations, extra_destinations, modes, ignore_patterns
+    ):
+        if mode != "copy":
+            progress_queue.put(
+                (
+                    "log_message",
+                    (
+                        f"Folder pair '{name}': Continuous backup is only available for plain copies. Skipping.",
+                        (139, 140, 0),
+                        "skip",
+                    ),
+                )
+            )
             continue
-        # Prevent hidden folders
-        if settings["skip_hidden_files"] and os.path.basename(root).startswith("."):
-            dirs[:] = []
+        dests = [dest, *extras]
+        if not os.path.isdir(source) or not any(map(os.path.isdir, dests)):
             continue
+        watcher = folder_watch.FolderWatcher(
+            source, functools.partial(watch_copy, source, dests, name, ignore)
+        )
+        watcher.start()
+        watchers.append(watcher)
+    logging.info(f"Continuous backup watching {len(watchers)} folder pairs")
 
-        # Add the size of files in non-ignored folders
-        for file in files:
-            if settings["skip_hidden_files"] and file.startswith("."):
-                continue
-            file_path = os.path.join(root, file)
-            try:
-                total_size += os.path.getsize(file_path)
-            except FileNotFoundError:
-                logging.error("File deleted during folder size calculation")
-                continue
-    return total_size
 
+def copy_thread(valid_entries):
+    global cancel_flag, settings
+    progress = new_progress()
+    acquire_copy_lock(progress, "Waiting for the continuous backup to finish...")
+    try:
+        backup_runner.copy_pairs(
+            settings, data_paths, folder_pairs(valid_entries), progress, cancel_flag
+        )
+    finally:
+        progress.send("copy_finished", None)
+        copy_run_lock.release()
 
-def copy_thread(valid_entries, total_bytes_to_copy):
-    global cancel_flag, settings, sources, destinations, names, progress_queue
-    copied_bytes = 0
-    total_bytes = total_bytes_to_copy
 
+def verify_thread(valid_entries):
+    global cancel_flag, settings
+    progress = new_progress()
+    acquire_copy_lock(progress, "Waiting for the continuous backup to finish...")
     try:
-        progress_queue.put(("start", total_bytes))
-        for index in valid_entries:
-            if cancel_flag.is_set():
-                progress_queue.put(("cancel", "Copy cancelled by user!"))
-                return
-            source = sources[index]
-            dest = destinations[index]
-            # name = names[index]
+        backup_runner.verify_pairs(
+            settings, data_paths, folder_pairs(valid_entries), progress, cancel_flag
+        )
+    finally:
+        progress.send("copy_finished", None)
+        copy_run_lock.release()
 
-            if settings["copy_folder_checkbox_state"]:
-                new_destination = os.path.join(dest, os.path.basename(source))
-                try:
-                    os.makedirs(new_destination, exist_ok=True)
-                    dest = new_destination
-                except OSError as e:
-                    progress_queue.put(
-                        (
-                            "log_error",
-                            (
-                                f"Cannot create destination subfolder '{new_destination}': {e}",
-                                "copy",
-                            ),
-                        )
-                    )
-                    continue
-
-            # Get all files with sizes
-            file_list = []
-            ignored_folders = settings["ignored_folders"]
-            for root, dirs, files in os.walk(source):
-                if cancel_flag.is_set():
-                    progress_queue.put(("cancel", "Copy cancelled by user!"))
-                    return
-
-                rel_dir_path = os.path.relpath(root, source)
-                current_folder_abs = os.path.abspath(root)
-
-                # Skip ignored folders
-                if current_folder_abs in ignored_folders:
-                    rel_ignored_path = os.path.relpath(current_folder_abs, source)
-                    progress_queue.put(
-                        (
-                            "log_message",
-                            (
-                                f"Ignored because of a setting: '{rel_ignored_path}'",
-                                (139, 140, 0),
-                                "ignore",
-                            ),
-                        )
-                    )
-                    # Skip this folder and its contents by clearing the dirs list
-                    dirs[:] = []
-                    continue
 
-                # Skip hidden folders
-                if settings["skip_hidden_files"] and os.path.basename(root).startswith(
-                    "."
-                ):
-                    progress_queue.put(
-                        (
-                            "log_message",
-                            (
-                                f"Skipped (hidden folder): '{rel_dir_path}'",
-                                (139, 140, 0),
-                                "skip",
-                            ),
-                        )
-                    )
-                    dirs[:] = []
-                    continue
+def verify_all_callback(sender, app_data):
+    global cancel_flag, destinations, names
 
-                # Ensure empty folders are copied
-                dest_dir_path = os.path.join(dest, rel_dir_path)
-                try:
-                    os.makedirs(dest_dir_path, exist_ok=True)
-                except OSError as e:
-                    progress_queue.put(
-                        (
-                            "log_error",
-                            (
-                                f"Cannot create destination directory '{dest_dir_path}': {e}",
-                                "copy",
-                            ),
-                        )
-                    )
-                    continue
-
-                # Collect files from non-ignored folders
-                for file in files:
-                    if settings["skip_hidden_files"] and file.startswith(
-                        "."
-                    ):  # Skip hidden files
-                        progress_queue.put(
-                            (
-                                "log_message",
-                                (
-                                    f"Skipped (hidden file): '{file}'",
-                                    (139, 140, 0),
-                                    "skip",
-                                ),
-                            )
-                        )
-                        continue
-                    path = os.path.join(root, file)
-                    file_list.append((path, os.path.getsize(path)))
-
-            # Copy files with progress
-            for src_path, size in file_list:
-                if cancel_flag.is_set():
-                    progress_queue.put(("cancel", "Copy cancelled by user!"))
-                    return
-                rel_path = os.path.relpath(src_path, source)
-                dest_path = os.path.join(dest, rel_path)
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-
-                if (
-                    os.path.exists(dest_path)
-                    and settings["skip_existing_files"] == True
-                ):
-                    progress_queue.put(
-                        (
-                            "log_message",
-                            (
-                                f"Skipped (already exists): '{rel_path}'",
-                                (139, 140, 0),
-                                "skip",
-                            ),
-                        )
-                    )
-                    total_bytes -= size
-                    progress_queue.put(("adjust_total", total_bytes))
-                    continue
+    dpg.hide_item("copy_button")
+    dpg.hide_item("verify_button")
+    dpg.show_item("cancel_button")
+    cancel_flag.clear()
+    dpg.delete_item("copy_log", children_only=True)
+    dpg.set_value("speed_text", "")
+    dpg.hide_item("speed_text")
+    dpg.set_value("progress_bar", 0.0)
+    dpg.hide_item("progress_bar")
 
-                try:
-                    with open(src_path, "rb") as f_src, open(dest_path, "wb") as f_dst:
-                        while chunk := f_src.read(1024 * 1024):  # 1MB chunks
-                            if cancel_flag.is_set():
-                                progress_queue.put(
-                                    ("cancel", "Copy cancelled by user!")
-                                )
-                                return
-                            f_dst.write(chunk)
-                            copied_bytes += len(chunk)
-                            progress_queue.put(("progress", copied_bytes))
-
-                    progress_queue.put(
-                        (
-                            "log_message",
-                            (f"Copied: '{rel_path}'", (0, 140, 139), "copy"),
-                        )
-                    )
-                except IOError as e:
-                    progress_queue.put(
-                        ("log_error", (f"I/O Error copying '{rel_path}': {e}", "copy"))
-                    )
-                except Exception as e:
-                    progress_queue.put(
-                        (
-                            "log_error",
-                            (f"Unexpected error copying '{rel_path}': {e}", "copy"),
-                        )
-                    )
+    valid_entries = []
+    for index, pair in enumerate(folder_pairs(range(len(destinations)))):
+        problems = backup_runner.check_pair(pair, need_source=False)
+        for message in problems:
+            add_log_message(message, (229, 57, 53), "error")
+        if not problems:
+            valid_entries.append(index)
 
-        progress_queue.put(("complete", "Copying completed."))
+    if not valid_entries:
+        dpg.set_value("status_text", "No folder pairs to verify (check log).")
+        dpg.show_item("copy_button")
+        dpg.show_item("verify_button")
+        dpg.hide_item("cancel_button")
+        return
 
-    except Exception as e:
-        progress_queue.put(("error", f"Error in copy thread: {str(e)}"))
-        logging.error(f"Error in copy thread: {e}", exc_info=True)
-    finally:
-        progress_queue.put(("copy_finished", None))
+    dpg.set_value("status_text", "Starting verification...")
+    threading.Thread(target=verify_thread, args=(valid_entries,), daemon=True).start()
 
 
 def copy_all_callback(sender, app_data):
     global settings, cancel_flag, sources, destinations, names, progress_queue
 
     dpg.hide_item("copy_button")
+    dpg.hide_item("verify_button")
     dpg.show_item("cancel_button")
     cancel_flag.clear()
     dpg.delete_item("copy_log", children_only=True)
@@ -856,97 +961,30 @@ def copy_all_callback(sender, app_data):
     if not sources or not destinations or not names:
         dpg.set_value("status_text", "No entries to copy.")
         dpg.show_item("copy_button")
+        dpg.show_item("verify_button")
         dpg.hide_item("cancel_button")
         return
 
-    # Calculate total size and valid entries
-    total_bytes = 0
+    # Only cheap checks here; sizes are calculated by the copy thread
     valid_entries = []
-    log_messages_to_add = []
-
-    for index in range(len(sources)):
-        source = sources[index]
-        dest = destinations[index]
-        name = names[index]
-        is_valid = True
-
-        if not os.path.exists(source):
-            log_messages_to_add.append(
-                (
-                    f"Folder pair '{name}': Source '{source}' does not exist. Skipping.",
-                    (229, 57, 53),
-                    "error",
-                )
-            )
-            is_valid = False
-
-        if not os.path.exists(dest):
-            log_messages_to_add.append(
-                (
-                    f"Folder pair '{name}': Destination '{dest}' does not exist. Skipping.",
-                    (229, 57, 53),
-                    "error",
-                )
-            )
-            if is_valid:
-                is_valid = False
-
-        if is_valid:
-            try:
-                # Implement async for get_folder_size() in the near future
-                folder_size = get_folder_size(source)
-                if folder_size > settings["file_size_limit"] * 1024**3:
-                    log_messages_to_add.append(
-                        (
-                            f"Folder pair '{name}': Exceeds size limit ({settings['file_size_limit']} GB). Skipping.",
-                            (139, 140, 0),
-                            "skip",
-                        )
-                    )
-                    is_valid = False
-                else:
-                    valid_entries.append(index)
-                    total_bytes += folder_size
-
-            except Exception as e:
-                log_messages_to_add.append(
-                    (
-                        f"Folder pair '{name}': Error calculating size for '{source}': {e}. Skipping.",
-                        (229, 57, 53),
-                        "error",
-                    )
-                )
-                logging.error(f"Error calculating size for {source}: {e}")
-                is_valid = False
-
-    for msg, color, tag in log_messages_to_add:
-        add_log_message(msg, color, tag)
+    for index, pair in enumerate(folder_pairs(range(len(sources)))):
+        problems = backup_runner.check_pair(pair)
+        for message in problems:
+            add_log_message(message, (229, 57, 53), "error")
+        if not problems:
+            valid_entries.append(index)
 
     if not valid_entries:
         dpg.set_value("status_text", "No valid folder pairs found to copy (check log).")
         dpg.show_item("copy_button")
+        dpg.show_item("verify_button")
         dpg.hide_item("cancel_button")
         return
 
-    if settings["clear_destination_folder"]:
-        dpg.set_value("status_text", "Clearing destination folders...")
-        # Make delete_folder_with_children use the queue
-        try:
-            delete_folder_with_children()
-            dpg.set_value("status_text", "Destination folders cleared.")
-        except Exception as e:
-            dpg.set_value("status_text", f"Error clearing destinations: {e}")
-            add_log_message(
-                f"Error during destination clear: {e}", (229, 57, 53), "error"
-            )
-            dpg.show_item("copy_button")
-            dpg.hide_item("cancel_button")
-            return
-
     dpg.set_value("status_text", "Starting copy operation...")
 
     copy_job_thread = threading.Thread(
-        target=copy_thread, args=(valid_entries, total_bytes), daemon=True
+        target=copy_thread, args=(valid_entries,), daemon=True
     )
     copy_job_thread.start()
 
@@ -967,6 +1005,17 @@ def destination_folder_select_callback(sender, app_data):
     dpg.set_value("status_text", "Folder selected")
 
 
+def extra_destination_folder_select_callback(sender, app_data):
+    global pending_extra_destinations
+
+    pending_extra_destinations.append(app_data["file_path_name"])
+    dpg.set_value(
+        "extra_destination_display",
+        "\n".join(dict.fromkeys(pending_extra_destinations)),
+    )
+    dpg.set_value("status_text", "Folder selected")
+
+
 def copy_manager_folder_cancel_callback():
     dpg.set_value("status_text", "Folder select canceled")
 
@@ -1033,9 +1082,9 @@ def search_files():
                 )
 
     total_dirs = sum(
-        len(dirs)
+        1
         for dirpath in directories_to_search
-        for _, dirs, _ in os.walk(dirpath)
+        for _ in file_walker.walk(dirpath, cancel_flag=cancel_flag)
     )
     dpg.set_value("finder_text", "Searching...")
 
@@ -1045,15 +1094,15 @@ def search_files():
     def process_directory(directory):
         nonlocal processed_dirs, total_files
         try:
-            for root, dirs, files in os.walk(directory):
-                if cancel_flag.is_set():
-                    return
+            for root, _, file_entries in file_walker.walk(
+                directory, cancel_flag=cancel_flag
+            ):
                 processed_dirs += 1
                 dpg.set_value("finder_progress_bar", processed_dirs / total_dirs)
 
                 # Add files that match extensions
-                for file in files:
-                    if file.endswith(file_extensions_tuple):
+                for entry in file_entries:
+                    if entry.name.endswith(file_extensions_tuple):
                         sav_directories.add(root)
                         total_files += 1
 
@@ -1488,6 +1537,22 @@ def ignored_folders_select_callback(sender, app_data):
         logging.debug("Trying to add already added folder to ignored folders")
 
 
+def add_ignore_pattern(sender, app_data):
+    global settings
+
+    pattern = dpg.get_value("ignore_pattern_input").strip()
+    dpg.set_value("ignore_pattern_input", "")
+    if pattern and pattern not in settings["ignored_folders"]:
+        settings["ignored_folders"].append(pattern)
+        save_settings("Settings", "ignored_folders", settings["ignored_folders"])
+
+        dpg.delete_item("ignored_folders_list", children_only=True)
+        for index, folderpath in enumerate(settings["ignored_folders"], start=1):
+            dpg.add_text(
+                f"{index}: {folderpath}", parent="ignored_folders_list", wrap=0
+            )
+
+
 def change_font_size(sender, app_data):
     global font_path
 
@@ -1521,8 +1586,40 @@ def settings_change_callback(sender, app_data):
         save_settings("Settings", "skip_existing_files", app_data)
     elif setting == "clear_destination_folder":
         save_settings("Settings", "clear_destination_folder", app_data)
+    elif setting == "mirror_destination":
+        save_settings("Settings", "mirror_destination", app_data)
     elif setting == "skip_hidden_files":
         save_settings("Settings", "skip_hidden_files", app_data)
+    elif setting == "copy_workers":
+        save_settings("Settings", "copy_workers", app_data)
+    elif setting == "incremental_copy":
+        save_settings("Settings", "incremental_copy", app_data)
+    elif setting == "incremental_hash":
+        save_settings("Settings", "incremental_hash", app_data)
+    elif setting == "delta_copy":
+        save_settings("Settings", "delta_copy", app_data)
+    elif setting == "delta_threshold_mb":
+        save_settings("Settings", "delta_threshold_mb", app_data)
+    elif setting == "verify_copies":
+        save_settings("Settings", "verify_copies", app_data)
+    elif setting == "throttle_mb_s":
+        save_settings("Settings", "throttle_mb_s", app_data)
+    elif setting == "low_priority":
+        save_settings("Settings", "low_priority", app_data)
+    elif setting == "generations_keep_last":
+        save_settings("Settings", "generations_keep_last", app_data)
+    elif setting == "generations_keep_daily":
+        save_settings("Settings", "generations_keep_daily", app_data)
+    elif setting == "generations_keep_weekly":
+        save_settings("Settings", "generations_keep_weekly", app_data)
+    elif setting == "watch_mode":
+        save_settings("Settings", "watch_mode", app_data)
+        settings["watch_mode"] = app_data
+        start_watchers()
+    elif setting == "parallel_pairs":
+        save_settings("Settings", "parallel_pairs", app_data)
+    elif setting == "copy_backend":
+        save_settings("Settings", "copy_backend", f'"{app_data}"')
     else:
         dpg.set_value(
             "status_text", "Changing setting failed; user_data incorrect or missing"
@@ -1586,6 +1683,16 @@ def add_log_message(message, color, tag):
             dpg.hide_item(item_id)
 
 
+def handle_log_event(item_type, data):
+    if item_type == "log_message":
+        msg, color, tag = data
+        add_log_message(msg, color, tag)
+    elif item_type == "log_error":
+        msg, context_tag = data
+        add_log_message(f"ERROR ({context_tag}): {msg}", (229, 57, 53), "error")
+        logging.error(f"Logged Error ({context_tag}): {msg}")
+
+
 def setup_settings_window(font_size):
     global settings, recording_settings
 
@@ -1672,6 +1779,80 @@ def setup_settings_window(font_size):
             user_data="skip_existing_files",
         )
     dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Incremental copy",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Only copy files whose size or modification time changed since the last run (replaces 'Skip existing files')",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["incremental_copy"],
+            callback=settings_change_callback,
+            user_data="incremental_copy",
+        )
+        dpg.add_spacer(width=10)
+        dpg.add_text(
+            "Compare contents",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Store file hashes so files that were only touched are not copied again",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["incremental_hash"],
+            callback=settings_change_callback,
+            user_data="incremental_hash",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Verify copies",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Hash files while they are copied so 'Verify Backups' can check the destinations later",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["verify_copies"],
+            callback=settings_change_callback,
+            user_data="verify_copies",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Delta copy for large files",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Only rewrite the changed parts of files above the set size (useful for big save databases)",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["delta_copy"],
+            callback=settings_change_callback,
+            user_data="delta_copy",
+        )
+        dpg.add_input_int(
+            label="MB",
+            min_value=1,
+            max_value=100000,
+            default_value=settings["delta_threshold_mb"],
+            step=64,
+            step_fast=256,
+            width=200,
+            callback=settings_change_callback,
+            user_data="delta_threshold_mb",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
     with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
         dpg.add_text(
             "Clear destination",
@@ -1685,6 +1866,38 @@ def setup_settings_window(font_size):
             user_data="clear_destination_folder",
         )
     dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Mirror source",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "After copying, delete files and folders in the destination that no longer exist in the source (ignored and skipped items are kept)",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["mirror_destination"],
+            callback=settings_change_callback,
+            user_data="mirror_destination",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Continuous backup",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Watch the source folders and copy changed files a few seconds after they were saved, without scanning the whole folder",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["watch_mode"],
+            callback=settings_change_callback,
+            user_data="watch_mode",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
     with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
         dpg.add_text(
             "Skip hidden files",
@@ -1698,14 +1911,124 @@ def setup_settings_window(font_size):
             user_data="skip_hidden_files",
         )
     dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Speed limit",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Limit copying, verifying and archiving to this many MB per second so games running at the same time don't stutter (0 = no limit)",
+                wrap=400,
+            )
+        dpg.add_input_int(
+            label="MB/s",
+            min_value=0,
+            max_value=10000,
+            default_value=settings["throttle_mb_s"],
+            step=5,
+            step_fast=50,
+            width=200,
+            callback=settings_change_callback,
+            user_data="throttle_mb_s",
+        )
+        dpg.add_spacer(width=10)
+        dpg.add_text(
+            "Low priority",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Run copy, hash and delete work at background I/O priority",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["low_priority"],
+            callback=settings_change_callback,
+            user_data="low_priority",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text("Keep generations", wrap=0)
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "For folder pairs in generations mode: keep the newest generations, plus the newest one of each recent day and week; older ones are deleted after each run (all 0 = keep everything)",
+                wrap=400,
+            )
+        for key, label in (
+            ("generations_keep_last", "last"),
+            ("generations_keep_daily", "daily"),
+            ("generations_keep_weekly", "weekly"),
+        ):
+            dpg.add_input_int(
+                label=label,
+                min_value=0,
+                max_value=1000,
+                default_value=settings[key],
+                step=1,
+                step_fast=10,
+                width=120,
+                callback=settings_change_callback,
+                user_data=key,
+            )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text("Copy threads", wrap=0)
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "How many files are copied at the same time (0 = pick automatically based on the drives)",
+                wrap=400,
+            )
+        dpg.add_input_int(
+            min_value=0,
+            max_value=copy_engine.max_workers,
+            default_value=settings["copy_workers"],
+            step=1,
+            step_fast=4,
+            width=200,
+            callback=settings_change_callback,
+            user_data="copy_workers",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text(
+            "Copy pairs on different drives in parallel",
+            wrap=0,
+        )
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "Folder pairs that share a drive are still copied one after another",
+                wrap=400,
+            )
+        dpg.add_checkbox(
+            default_value=settings["parallel_pairs"],
+            callback=settings_change_callback,
+            user_data="parallel_pairs",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
+    with dpg.group(horizontal=True, parent="copy_manager_settings_child_window"):
+        dpg.add_text("Copy method", wrap=0)
+        with dpg.tooltip(dpg.last_item()):
+            dpg.add_text(
+                "How file data is transferred (auto = fastest method supported by both drives; reflink clones files without copying their data when source and destination are on the same btrfs or XFS volume)",
+                wrap=400,
+            )
+        dpg.add_combo(
+            items=copy_engine.available_backends(),
+            default_value=settings["copy_backend"],
+            width=250,
+            callback=settings_change_callback,
+            user_data="copy_backend",
+        )
+    dpg.add_spacer(height=20, parent="copy_manager_settings_child_window")
     with dpg.tree_node(
-        label="Manage ignored folders",
+        label="Manage ignored folders and patterns",
         parent="copy_manager_settings_child_window",
         # span_full_width=True,
     ):
         with dpg.tooltip(dpg.last_item()):
             dpg.add_text(
-                "Skip these folders when copying (note that this only affects subfolders)",
+                "Skip these folders and patterns when copying. Folders only affect pairs whose source contains them; patterns like *.tmp, **/cache/ or shader*/ apply to every pair",
                 wrap=400,
             )
         dpg.add_spacer(height=5)
@@ -1725,6 +2048,15 @@ def setup_settings_window(font_size):
                     callback=remove_ignored_folders,
                     tag="ignored_folders_remove_button",
                 )
+            with dpg.group(horizontal=True):
+                dpg.add_input_text(
+                    tag="ignore_pattern_input",
+                    width=300,
+                    hint="or a pattern, e.g. *.tmp",
+                    on_enter=True,
+                    callback=add_ignore_pattern,
+                )
+                dpg.add_button(label="Add pattern", callback=add_ignore_pattern)
             dpg.add_text(
                 "Select an item to remove:",
                 tag="select_ignored_folders_text",
@@ -1785,6 +2117,18 @@ def setup_settings_window(font_size):
     ):
         pass
 
+    with dpg.file_dialog(
+        directory_selector=True,
+        show=False,
+        callback=extra_destination_folder_select_callback,
+        tag="extra_destination_file_dialog",
+        cancel_callback=copy_manager_folder_cancel_callback,
+        width=dpg.get_viewport_width() / 1.5,
+        height=dpg.get_viewport_height() / 1.5,
+        label="Select another destination",
+    ):
+        pass
+
     with dpg.file_dialog(
         directory_selector=True,
         show=False,
@@ -2002,6 +2346,51 @@ def show_windows():
                                 dpg.add_text("", tag="destination_display", wrap=0)
                                 dpg.add_spacer(height=5)
 
+                                dpg.add_button(
+                                    label="Add Another Destination",
+                                    callback=lambda: dpg.show_item(
+                                        "extra_destination_file_dialog"
+                                    ),
+                                )
+                                with dpg.tooltip(dpg.last_item()):
+                                    dpg.add_text(
+                                        "Optional. The source is read once and written to every destination at the same time; a slow or failing destination does not hold up the others",
+                                        wrap=400,
+                                    )
+                                dpg.add_text(
+                                    "", tag="extra_destination_display", wrap=0
+                                )
+                                dpg.add_spacer(height=5)
+
+                                with dpg.group(horizontal=True):
+                                    dpg.add_text("Destination mode:")
+                                    dpg.add_combo(
+                                        items=list(destination_modes),
+                                        default_value="Copy files",
+                                        tag="mode_input",
+                                        width=400,
+                                    )
+                                    with dpg.tooltip(dpg.last_item()):
+                                        dpg.add_text(
+                                            "Archive modes write the whole folder into one file, which is much faster for many small files on USB sticks and network shares. Snapshots keep every run; files are stored once by content, across all folder pairs using the same destination (restore with SaveManager_cli.py --restore). Generations add a dated folder per run in which unchanged files are hardlinks to the previous one; old ones are removed as set in the settings",
+                                            wrap=400,
+                                        )
+                                dpg.add_spacer(height=5)
+
+                                with dpg.group(horizontal=True):
+                                    dpg.add_text("Ignore:")
+                                    dpg.add_input_text(
+                                        tag="ignore_input",
+                                        width=400,
+                                        hint="optional, e.g. **/cache/, *.tmp, shader*/",
+                                    )
+                                    with dpg.tooltip(dpg.last_item()):
+                                        dpg.add_text(
+                                            "Comma separated patterns for this folder pair, relative to its source. * and ? match within a name, ** any number of folders, a trailing / only matches folders, and a pattern with a / inside starts at the source folder",
+                                            wrap=400,
+                                        )
+                                dpg.add_spacer(height=5)
+
                                 dpg.add_button(
                                     label="Add folder pair", callback=add_entry_callback
                                 )
@@ -2037,6 +2426,11 @@ def show_windows():
                                 callback=copy_all_callback,
                                 tag="copy_button",
                             )
+                            dpg.add_button(
+                                label="Verify Backups",
+                                callback=verify_all_callback,
+                                tag="verify_button",
+                            )
                             dpg.add_button(
                                 label="Cancel Copy Operation",
                                 callback=set_cancel_to_true,
@@ -2401,6 +2795,7 @@ def main():
     setup_viewport()
     show_windows()
     load_entries()
+    start_watchers()
 
     dpg.setup_dearpygui()
     dpg.show_viewport()
@@ -2449,6 +2844,14 @@ def main():
                             if elapsed > 0:
                                 speed = copied_bytes / elapsed
                                 speed_mb = speed / (1024**2)
+                                limit_text = ""
+                                if settings["throttle_mb_s"] > 0:
+                                    # The initial burst would make the ETA too short
+                                    speed = min(
+                                        speed, settings["throttle_mb_s"] * 1024**2
+                                    )
+                                    speed_mb = speed / (1024**2)
+                                    limit_text = f" (limited to {settings['throttle_mb_s']} MB/s)"
                                 remaining_bytes = total_bytes_global - copied_bytes
                                 eta_secs = (
                                     remaining_bytes / speed
@@ -2464,23 +2867,26 @@ def main():
 
                                 dpg.set_value(
                                     "speed_text",
-                                    f"Speed: {speed_mb:.1f} MB/s | ETA: {eta_str}",
+                                    f"Speed: {speed_mb:.1f} MB/s{limit_text} | ETA: {eta_str}",
                                 )
                             last_update_time = current_time
 
                 elif item_type == "adjust_total":
                     total_bytes_global = data if data else 0
 
-                elif item_type == "log_message":
-                    msg, color, tag = data
-                    add_log_message(msg, color, tag)
-
-                elif item_type == "log_error":
-                    msg, context_tag = data
-                    add_log_message(
-                        f"ERROR ({context_tag}): {msg}", (229, 57, 53), "error"
-                    )
-                    logging.error(f"Logged Error ({context_tag}): {msg}")
+                elif item_type in ("log_message", "log_error"):
+                    handle_log_event(item_type, data)
+
+                elif item_type == "log_batch":
+                    # Older entries would be trimmed by the log limit anyway
+                    dropped = len(data) - max_log_entries
+                    for index, (log_type, log_data) in enumerate(data):
+                        if index >= dropped:
+                            handle_log_event(log_type, log_data)
+                        elif log_type == "log_error":
+                            logging.error(
+                                f"Logged Error ({log_data[1]}): {log_data[0]}"
+                            )
 
                 elif item_type == "complete":
                     dpg.set_value("status_text", data)
@@ -2502,8 +2908,10 @@ def main():
 
                 elif item_type == "copy_finished":
                     dpg.show_item("copy_button")
+                    dpg.show_item("verify_button")
                     dpg.hide_item("cancel_button")
                     cancel_flag.clear()
+                    refresh_pair_headers()
 
                 elif item_type == "update":
                     dpg.set_value("status_text", data)
@@ -2530,6 +2938,7 @@ def main():
 
         logging.info("Application exited")
         cancel_flag.set()
+        stop_watchers()
 
         # If you have non-daemon threads, add join logic here:
         # for thread in threading.enumerate():
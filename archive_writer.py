@@ -0,0 +1,218 @@
+import os
+import zlib
+import json
+import struct
+import tarfile
+import zipfile
+
+import copy_engine
+import copy_journal
+
+# Archive destination mode: a whole folder pair is streamed into one archive
+# with a single sequential write. Next to it, "<archive>.index.json" maps every
+# file to its data offset so one file can be restored without unpacking. The
+# index records the archive's size; an index left over from another version
+# of the archive (a crash between the two renames) is never used.
+
+archive_formats: dict = {
+    "tar": ".tar",
+    "tar.gz": ".tar.gz",
+    "zip": ".zip",
+    "zip-deflated": ".zip",
+}
+
+
+class ArchiveCancelled(Exception):
+    pass
+
+
+class IndexMismatch(OSError):
+    # The index describes another version of the archive
+    pass
+
+
+class _ProgressReader:
+    # Feeds tarfile while reporting progress and honoring cancel_flag per chunk
+
+    def __init__(self, f, progress, cancel_flag):
+        self.f = f
+        self.progress = progress
+        self.cancel_flag = cancel_flag
+
+    def read(self, size=-1):
+        if self.cancel_flag.is_set():
+            raise ArchiveCancelled()
+        data = self.f.read(size)
+        self.progress.add_copied(len(data))
+        return data
+
+
+def archive_path_for(source, dest, archive_format):
+    name = os.path.basename(os.path.normpath(source)) or "archive"
+    return os.path.join(dest, name + archive_formats[archive_format])
+
+
+def _arcname(rel_path):
+    return rel_path.replace(os.sep, "/")
+
+
+def _write_tar(plan, temp_path, archive_format, progress, cancel_flag, index):
+    mode = "w:gz" if archive_format == "tar.gz" else "w"
+    with tarfile.open(temp_path, mode, format=tarfile.PAX_FORMAT) as tar:
+        tar.copybufsize = copy_engine.chunk_size
+        for rel_dir_path in plan.dirs:
+            if rel_dir_path != ".":
+                tar.add(
+                    os.path.join(plan.source, rel_dir_path),
+                    _arcname(rel_dir_path),
+                    recursive=False,
+                )
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            if cancel_flag.is_set():
+                raise ArchiveCancelled()
+            with open(src_path, "rb") as f:
+                tarinfo = tar.gettarinfo(arcname=_arcname(rel_path), fileobj=f)
+                tar.addfile(tarinfo, _ProgressReader(f, progress, cancel_flag))
+            # Data ends on the last full block written for this member
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            data_offset = tar.offset - (blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+            index[rel_path] = [data_offset, tarinfo.size, mtime_ns]
+
+
+def _write_zip(plan, temp_path, archive_format, progress, cancel_flag, index):
+    compression = (
+        zipfile.ZIP_DEFLATED if archive_format == "zip-deflated" else zipfile.ZIP_STORED
+    )
+    with zipfile.ZipFile(temp_path, "w", compression, allowZip64=True) as archive:
+        for rel_dir_path in plan.dirs:
+            if rel_dir_path != ".":
+                archive.write(
+                    os.path.join(plan.source, rel_dir_path), _arcname(rel_dir_path)
+                )
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            if cancel_flag.is_set():
+                raise ArchiveCancelled()
+            zinfo = zipfile.ZipInfo.from_file(src_path, _arcname(rel_path))
+            zinfo.compress_type = compression
+            with open(src_path, "rb") as f_src, archive.open(
+                zinfo, "w", force_zip64=True
+            ) as f_dst:
+                while chunk := f_src.read(copy_engine.chunk_size):
+                    if cancel_flag.is_set():
+                        raise ArchiveCancelled()
+                    f_dst.write(chunk)
+                    progress.add_copied(len(chunk))
+            index[rel_path] = [
+                zinfo.header_offset,
+                zinfo.file_size,
+                mtime_ns,
+                zinfo.compress_size,
+            ]
+
+
+def write_archive(plan, archive_path, archive_format, progress, cancel_flag):
+    # Returns False if cancelled; the previous archive is kept until the new
+    # one is complete
+    progress.background_worker()
+    temp_path = f"{archive_path}.partial"
+    index: dict = {}
+    writer = _write_zip if archive_format.startswith("zip") else _write_tar
+    try:
+        writer(plan, temp_path, archive_format, progress, cancel_flag, index)
+    except ArchiveCancelled:
+        os.remove(temp_path)
+        return False
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    archive_size = os.path.getsize(temp_path)
+    with open(f"{archive_path}.index.json.partial", "w") as f:
+        json.dump({"format": archive_format, "size": archive_size, "files": index}, f)
+    os.replace(temp_path, archive_path)
+    os.replace(f"{archive_path}.index.json.partial", f"{archive_path}.index.json")
+    return True
+
+
+def _load_index(archive_path):
+    with open(f"{archive_path}.index.json", "r") as f:
+        index = json.load(f)
+    # Indexes written before the size was recorded are trusted as they are
+    if index.get("size") not in (None, os.path.getsize(archive_path)):
+        raise IndexMismatch(f"the index of '{archive_path}' is out of date")
+    return index
+
+
+def index_matches(archive_path):
+    # True if the archive has an index that belongs to it
+    try:
+        _load_index(archive_path)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+_zip_local_header = struct.Struct("<4s5H3L2H")
+_zip_utf8_flag = 0x800
+
+
+def _copy_range(f_src, f_dst, length, decompressor):
+    while length and (chunk := f_src.read(min(length, copy_engine.chunk_size))):
+        length -= len(chunk)
+        f_dst.write(decompressor.decompress(chunk) if decompressor else chunk)
+    if decompressor:
+        f_dst.write(decompressor.flush())
+
+
+def restore_file(archive_path, rel_path, target_path):
+    # Restores one file using the index instead of scanning the archive.
+    # Returns its size; KeyError if the archive has no such file.
+    index = _load_index(archive_path)
+    offset, size, mtime_ns = index["files"][rel_path][:3]
+    archive_format = index["format"]
+
+    os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+    temp_path = target_path + copy_journal.partial_suffix
+    try:
+        _extract(archive_path, archive_format, index, rel_path, offset, size, temp_path)
+        os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+        os.replace(temp_path, target_path)
+    except BaseException:
+        copy_engine.remove_partial(temp_path)
+        raise
+    return size
+
+
+def _extract(archive_path, archive_format, index, rel_path, offset, size, temp_path):
+    with open(temp_path, "wb") as f_dst:
+        if archive_format == "tar.gz":
+            # Compressed streams cannot seek, so fall back to tarfile
+            with tarfile.open(archive_path, "r:gz") as tar:
+                with tar.extractfile(_arcname(rel_path)) as f_src:
+                    while chunk := f_src.read(copy_engine.chunk_size):
+                        f_dst.write(chunk)
+        else:
+            with open(archive_path, "rb") as f_src:
+                f_src.seek(offset)
+                if archive_format == "tar":
+                    _copy_range(f_src, f_dst, size, None)
+                else:
+                    # Skip the zip local file header to reach the member data
+                    header = _zip_local_header.unpack(
+                        f_src.read(_zip_local_header.size)
+                    )
+                    signature, flags = header[0], header[2]
+                    name_length, extra_length = header[-2:]
+                    name = f_src.read(name_length).decode(
+                        "utf-8" if flags & _zip_utf8_flag else "cp437"
+                    )
+                    if signature != b"PK\x03\x04" or name != _arcname(rel_path):
+                        raise IndexMismatch(
+                            f"the index of '{archive_path}' does not match it"
+                        )
+                    f_src.seek(extra_length, os.SEEK_CUR)
+                    decompressor = None
+                    if archive_format == "zip-deflated":
+                        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    _copy_range(f_src, f_dst, index["files"][rel_path][3], decompressor)
@@ -0,0 +1,950 @@
+import os
+import ast
+import json
+import time
+import shutil
+import logging
+import threading
+import configparser
+
+import copy_engine
+import file_walker
+import archive_writer
+import delta_copy
+import copy_journal
+import mirror
+import tree_delete
+import throttle
+import size_cache
+import fan_out
+import snapshot_store
+import generations
+import file_stream
+
+# Copy and verify runs over a list of folder pairs, without any UI. Everything
+# is reported through a CopyProgress (progress queue events), so the same runs
+# back the app's Copy/Verify buttons and the headless SaveManager_cli.py.
+# Nothing here may import dearpygui or other GUI-only packages.
+
+skip_color = (139, 140, 0)
+copy_color = (0, 140, 139)
+error_color = (229, 57, 53)
+
+
+def default_settings():
+    # Settings that affect copying; the app adds its own on top
+    return {
+        "copy_folder_checkbox_state": False,
+        "file_size_limit": 5,
+        "skip_existing_files": True,
+        "clear_destination_folder": False,
+        "skip_hidden_files": False,
+        "ignored_folders": [],
+        "copy_workers": 0,
+        "copy_backend": "auto",
+        "incremental_copy": False,
+        "incremental_hash": False,
+        "parallel_pairs": True,
+        "delta_copy": False,
+        "delta_threshold_mb": 256,
+        "verify_copies": False,
+        "mirror_destination": False,
+        "throttle_mb_s": 0,
+        "low_priority": False,
+        "generations_keep_last": 10,
+        "generations_keep_daily": 7,
+        "generations_keep_weekly": 4,
+    }
+
+
+class DataDir:
+    # Where the app keeps its folder pairs, settings and per-pair state
+
+    def __init__(self, path):
+        self.path = path
+        self.pairs_file = os.path.join(path, "save_folders.json")
+        self.settings_file = os.path.join(path, "settings.ini")
+        self.manifests = os.path.join(path, "manifests")
+        self.signatures = os.path.join(path, "signatures")
+        self.journals = os.path.join(path, "journals")
+        self.size_cache = os.path.join(path, "folder_sizes.json")
+
+
+def load_settings(settings_file, settings):
+    # Reads the [Settings] values the app saved; unknown keys are ignored
+    config = configparser.ConfigParser()
+    config.read(settings_file)
+    if config.has_section("Settings"):
+        for key in settings:
+            value = config.get("Settings", key, fallback=None)
+            if value is not None:
+                settings[key] = ast.literal_eval(value)
+    return settings
+
+
+def load_pairs(pairs_file):
+    # [{"name", "source", "destination", "extra_destinations", "mode", "ignore"}]
+    # as saved by the app
+    with open(pairs_file, "r") as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry.setdefault("extra_destinations", [])
+        entry.setdefault("mode", "copy")
+        entry.setdefault("ignore", [])
+    return entries
+
+
+def pair_destinations(pair):
+    # The main destination first, then the ones the pair also copies to
+    return list(
+        dict.fromkeys([pair["destination"], *pair.get("extra_destinations", [])])
+    )
+
+
+def check_pair(pair, need_source=True):
+    # Cheap checks before a run; returns log messages for the problems found.
+    # A pair with several destinations only needs one of them; the missing
+    # ones are left out when it runs.
+    problems = []
+    if need_source and not os.path.exists(pair["source"]):
+        problems.append(
+            f"Folder pair '{pair['name']}': Source '{pair['source']}' does not exist. Skipping."
+        )
+    destinations = pair_destinations(pair)
+    if not any(os.path.exists(dest) for dest in destinations):
+        for dest in destinations:
+            problems.append(
+                f"Folder pair '{pair['name']}': Destination '{dest}' does not exist. Skipping."
+            )
+    return problems
+
+
+def pair_destination(settings, source, dest):
+    # Where the files of a folder pair end up
+    if settings["copy_folder_checkbox_state"]:
+        return os.path.join(dest, os.path.basename(source))
+    return dest
+
+
+def worker_count(settings, source, dest):
+    return settings["copy_workers"] or copy_engine.default_worker_count(source, dest)
+
+
+def new_progress(settings, progress_queue, cancel_flag):
+    # Progress sink for the copy, verify and delete stages, with the I/O limits
+    io_limit = None
+    if settings["throttle_mb_s"] > 0:
+        io_limit = throttle.TokenBucket(settings["throttle_mb_s"] * 1024**2)
+    return copy_engine.CopyProgress(
+        progress_queue,
+        0,
+        throttle=io_limit,
+        low_priority=settings["low_priority"],
+        cancel_flag=cancel_flag,
+    )
+
+
+def new_delta_copier(settings, data):
+    if settings["delta_copy"]:
+        return delta_copy.DeltaCopier(
+            data.signatures, settings["delta_threshold_mb"] * 1024**2
+        )
+    return None
+
+
+class RunResult:
+    # Outcome of copy_pairs or verify_pairs, besides the events sent
+
+    def __init__(self):
+        self.status = None  # "complete", "cancel" or "error"
+        self.message = ""
+        self.done: list = []  # names of the pairs that finished
+        self.skipped: list = []  # names of the pairs left out
+        self.verify = copy_engine.VerifyResult()
+        self.background: list = []  # threads still cleaning up after the run
+
+    def finish(self, progress, status, message):
+        self.status = status
+        self.message = message
+        progress.send(status, message)
+
+
+def clear_destinations(settings, data, pairs, progress, cancel_flag):
+    # Returns False if cancelled. Snapshot and generation destinations are
+    # history, so they (and folders overlapping them) are never cleared.
+    history_dests = [
+        dest
+        for pair in pairs
+        if pair["mode"] in (snapshot_store.mode, generations.mode)
+        for dest in pair_destinations(pair)
+    ]
+    cleared = []
+    for pair in pairs:
+        if pair["mode"] in (snapshot_store.mode, generations.mode):
+            progress.log(
+                f"Folder pair '{pair['name']}': Destinations with a history are not cleared.",
+                skip_color,
+                "skip",
+            )
+            continue
+        dests = []
+        for dest in pair_destinations(pair):
+            if mirror.overlaps(dest, history_dests):
+                progress.log(
+                    f"Folder pair '{pair['name']}': Destination '{dest}' holds another folder pair's history; not clearing it.",
+                    skip_color,
+                    "skip",
+                )
+                continue
+            dests.append(dest)
+        cleared.append((pair, dests))
+
+    # Manifests and journals describe the destinations being wiped; those of
+    # other pairs stay
+    for pair, dests in cleared:
+        source = pair["source"]
+        for dest in dests:
+            dest = pair_destination(settings, source, dest)
+            paths = [
+                os.path.join(data.manifests, copy_engine.manifest_name(source, dest)),
+                os.path.join(data.journals, copy_engine.journal_name(source, dest)),
+            ]
+            if pair["mode"] in archive_writer.archive_formats:
+                archive_path = archive_writer.archive_path_for(
+                    source, dest, pair["mode"]
+                )
+                paths.append(
+                    os.path.join(
+                        data.manifests, copy_engine.manifest_name(source, archive_path)
+                    )
+                )
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Delta signatures are named after the destination files they describe
+    signatures = None
+    if os.path.isdir(data.signatures) and os.listdir(data.signatures):
+        signatures = delta_copy.DeltaCopier(data.signatures, 0)
+    stats = tree_delete.DeleteStats(progress, "Clearing destination folders...")
+    start = time.perf_counter()
+    for destination_folder in dict.fromkeys(
+        dest for pair, dests in cleared for dest in dests
+    ):
+        if not os.path.isdir(destination_folder):
+            continue
+        if signatures is not None:
+            for dir_path, rel_dir_path, file_entries in file_walker.walk(
+                destination_folder, cancel_flag=cancel_flag
+            ):
+                for entry in file_entries:
+                    signatures.remove_signature(entry.path)
+        workers = worker_count(settings, destination_folder, destination_folder)
+        if not tree_delete.delete_tree(
+            destination_folder, stats, cancel_flag, workers, keep_root=True
+        ):
+            return False
+
+    progress.log(
+        f"Cleared destination folders: {stats.files} files and {stats.dirs} folders deleted in {time.perf_counter() - start:.2f} s",
+        skip_color,
+        "delete",
+    )
+    return True
+
+
+def copy_pairs(settings, data, pairs, progress, cancel_flag):
+    # Copies (or archives) every pair; sends "start" and then one of
+    # "complete", "cancel" or "error"
+    result = RunResult()
+    run = copy_engine.CopyRun(
+        progress,
+        cancel_flag,
+        settings["skip_existing_files"],
+        settings["copy_backend"],
+        new_delta_copier(settings, data),
+        settings["verify_copies"],
+    )
+
+    try:
+        if settings["clear_destination_folder"]:
+            progress.send("update", "Clearing destination folders...")
+            try:
+                if not clear_destinations(settings, data, pairs, progress, cancel_flag):
+                    result.finish(progress, "cancel", "Copy cancelled by user!")
+                    return result
+            except Exception as e:
+                result.finish(progress, "error", f"Error clearing destinations: {e}")
+                logging.error(f"Deleting files failed: {e}", exc_info=True)
+                return result
+
+        # Scan every pair once; the same plan is used for the size check and the copy
+        plans = []
+        sizes = size_cache.SizeCache(data.size_cache)
+        rules_keys = {}  # name: size cache key, for the streamed pairs
+
+        def save_sizes():
+            try:
+                sizes.save()
+            except OSError as e:
+                logging.warning(f"Cannot save the folder size cache: {e}")
+
+        size_limit = settings["file_size_limit"] * 1024**3
+        for pair in pairs:
+            source = pair["source"]
+            name = pair["name"]
+            rules = settings["ignored_folders"] + pair.get("ignore", [])
+            rules_key = size_cache.rules_key(rules, settings["skip_hidden_files"])
+            cached = sizes.lookup(source, rules_key)
+            if cached is not None and cached["size"] > size_limit:
+                # Known to be too big and unchanged since; no need to walk it
+                progress.log(
+                    f"Folder pair '{name}': Exceeds size limit ({settings['file_size_limit']} GB, {size_cache.describe(cached)} when last scanned). Skipping.",
+                    skip_color,
+                    "skip",
+                )
+                result.skipped.append(name)
+                continue
+
+            if pair["mode"] == "copy" and not settings["mirror_destination"]:
+                # Plain copies start while the source is still being scanned,
+                # once the size limit is known to hold (see file_stream.py)
+                plan = file_stream.FileStream(
+                    source,
+                    rules,
+                    settings["skip_hidden_files"],
+                    cancel_flag,
+                    progress,
+                    size_limit,
+                    (
+                        cached["size"]
+                        if cached is not None and cached["complete"]
+                        else None
+                    ),
+                )
+                rules_keys[name] = rules_key
+                plans.append((pair, plan))
+                progress.total_bytes += plan.counted
+                continue
+
+            progress.send("update", f"Scanning folder pair '{name}'...")
+            try:
+                # Global rules plus the pair's own, compiled once for the run
+                plan = copy_engine.scan_folder(
+                    source,
+                    rules,
+                    settings["skip_hidden_files"],
+                    cancel_flag,
+                    progress,
+                    size_limit,
+                )
+            except Exception as e:
+                progress.log(
+                    f"Folder pair '{name}': Error calculating size for '{source}': {e}. Skipping.",
+                    error_color,
+                    "error",
+                )
+                logging.error(f"Error calculating size for {source}: {e}")
+                result.skipped.append(name)
+                continue
+            if plan is None:
+                result.finish(progress, "cancel", "Copy cancelled by user!")
+                return result
+
+            sizes.store(plan, rules_key)
+            if plan.over_limit:
+                progress.log(
+                    f"Folder pair '{name}': Exceeds size limit ({settings['file_size_limit']} GB). Skipping.",
+                    skip_color,
+                    "skip",
+                )
+                result.skipped.append(name)
+                continue
+            plans.append((pair, plan))
+            if pair["mode"] in (snapshot_store.mode, generations.mode):
+                # Every destination has its own history and reads the source
+                progress.total_bytes += plan.total_size * len(pair_destinations(pair))
+            else:
+                progress.total_bytes += plan.total_size
+
+        save_sizes()
+
+        if not plans:
+            result.finish(
+                progress, "complete", "No valid folder pairs found to copy (check log)."
+            )
+            return result
+
+        progress.send("start", progress.total_bytes)
+
+        def create_dirs(rel_dir_paths, dest):
+            # Ensure empty folders are copied
+            for rel_dir_path in rel_dir_paths:
+                dest_dir_path = os.path.join(dest, rel_dir_path)
+                try:
+                    run.dirs.make(dest_dir_path)
+                except OSError as e:
+                    progress.log_error(
+                        f"Cannot create destination directory '{dest_dir_path}': {e}",
+                        "copy",
+                    )
+
+        def open_destination(source, dest):
+            manifest = None
+            if settings["incremental_copy"] or settings["verify_copies"]:
+                manifest = copy_engine.Manifest(
+                    os.path.join(
+                        data.manifests, copy_engine.manifest_name(source, dest)
+                    ),
+                    settings["incremental_hash"],
+                    settings["incremental_copy"],
+                )
+
+            # Picks up where a cancelled or crashed run of this pair stopped
+            journal = copy_journal.CopyJournal(
+                os.path.join(data.journals, copy_engine.journal_name(source, dest))
+            )
+            if journal.resuming:
+                progress.log(
+                    f"Resuming interrupted copy to '{dest}' ({len(journal.completed)} files already copied)",
+                    copy_color,
+                    "copy",
+                )
+                journal.discard_partials(dest)
+            return fan_out.Destination(dest, manifest, journal)
+
+        def copy_pair_files(plan, source, dests, name):
+            destinations = []
+            for dest in dests:
+                create_dirs(plan.dirs, dest)
+                destinations.append(open_destination(source, dest))
+            if isinstance(plan, file_stream.FileStream):
+
+                def create_streamed_dir(rel_dir_path):
+                    # Called by the scan as it reaches each folder
+                    for dest in dests:
+                        create_dirs([rel_dir_path], dest)
+
+                plan.on_dir = create_streamed_dir
+
+            # Copy files with progress
+            workers = worker_count(settings, source, dests[0])
+            completed = False
+            try:
+                if len(destinations) == 1:
+                    destination = destinations[0]
+                    completed = copy_engine.copy_files(
+                        plan.jobs(destination.path),
+                        run,
+                        workers,
+                        destination.manifest,
+                        destination.journal,
+                    )
+                else:
+                    # One read of the source for all destinations
+                    completed = fan_out.FanOut(
+                        name, destinations, run, workers
+                    ).copy_files(plan)
+                    for destination in destinations:
+                        progress.log(
+                            f"Folder pair '{name}': '{destination.path}': {destination.describe()}",
+                            copy_color,
+                            "copy",
+                        )
+            finally:
+                # A stream stopped at the size limit left files out; the
+                # journal stays open for them and the manifest keeps its hashes
+                finished = completed and not plan.over_limit
+                for destination in destinations:
+                    destination.journal.close(finished)
+                    if destination.manifest is not None and not plan.over_limit:
+                        destination.manifest.save()
+            return completed
+
+        def archive_pair(plan, source, dest, mode):
+            archive_path = archive_writer.archive_path_for(source, dest, mode)
+            archive_name = os.path.basename(archive_path)
+            manifest = None
+            if settings["incremental_copy"]:
+                manifest = copy_engine.Manifest(
+                    os.path.join(
+                        data.manifests, copy_engine.manifest_name(source, archive_path)
+                    )
+                )
+                if archive_writer.index_matches(
+                    archive_path
+                ) and manifest.check_plan_unchanged(plan):
+                    for src_path, rel_path, size, mtime_ns in plan.files:
+                        progress.skip_unchanged(size)
+                    progress.log(
+                        f"Skipped (unchanged archive): '{archive_name}'",
+                        skip_color,
+                        "skip",
+                    )
+                    return archive_path
+
+            if not archive_writer.write_archive(
+                plan, archive_path, mode, progress, cancel_flag
+            ):
+                return None
+            if manifest is not None:
+                manifest.record_plan(plan)
+                manifest.save()
+            progress.log(
+                f"Archived {len(plan.files)} files: '{archive_name}'",
+                copy_color,
+                "copy",
+            )
+            return archive_path
+
+        def copy_archive(archive_path, dest):
+            # Archives are written once and then copied, with their index, to
+            # the other destinations
+            copied = False
+            try:
+                for path in (archive_path, f"{archive_path}.index.json"):
+                    target_path = os.path.join(dest, os.path.basename(path))
+                    path_stat = os.stat(path)
+                    try:
+                        target_stat = os.stat(target_path)
+                        if (target_stat.st_size, target_stat.st_mtime_ns) == (
+                            path_stat.st_size,
+                            path_stat.st_mtime_ns,
+                        ):
+                            continue
+                    except FileNotFoundError:
+                        pass
+                    temp_path = target_path + copy_journal.partial_suffix
+                    try:
+                        shutil.copy2(path, temp_path)
+                        os.replace(temp_path, target_path)
+                    except OSError:
+                        copy_engine.remove_partial(temp_path)
+                        raise
+                    copied = True
+            except OSError as e:
+                progress.log_error(
+                    f"I/O Error copying '{archive_path}' to '{dest}': {e}", "copy"
+                )
+                return
+            if copied:
+                progress.log(
+                    f"Copied archive to '{dest}': '{os.path.basename(archive_path)}'",
+                    copy_color,
+                    "copy",
+                )
+
+        def snapshot_pair(plan, pair, dest):
+            # Returns False if cancelled
+            header = snapshot_store.take_snapshot(
+                plan,
+                dest,
+                pair["name"],
+                progress,
+                cancel_flag,
+                worker_count(settings, pair["source"], dest),
+            )
+            if header is None:
+                return False
+            progress.log(
+                f"Folder pair '{pair['name']}': Snapshot '{header['id']}' in '{dest}': {header['files']} files, {header['new_files']} new ({size_cache.format_size(header['new_bytes'])} stored)",
+                copy_color,
+                "copy",
+            )
+            return True
+
+        def generation_pair(plan, pair, dest):
+            # Returns False if cancelled
+            name = pair["name"]
+            others = list(mirror_guard)
+            others.remove(dest)
+            if mirror.overlaps(dest, others):
+                # Pruning would delete the other pair's generations
+                progress.log(
+                    f"Folder pair '{name}': Destination '{dest}' is shared with another folder pair; generations need a folder of their own. Skipping.",
+                    skip_color,
+                    "skip",
+                )
+                progress.remove_from_total(plan.total_size)
+                return True
+            workers = worker_count(settings, pair["source"], dest)
+            generation_path = generations.write_generation(plan, dest, run, workers)
+            if generation_path is None:
+                return False
+            progress.log(
+                f"Folder pair '{name}': New generation '{generation_path}'",
+                copy_color,
+                "copy",
+            )
+            pruning = generations.prune(
+                dest,
+                settings["generations_keep_last"],
+                settings["generations_keep_daily"],
+                settings["generations_keep_weekly"],
+                progress,
+                cancel_flag,
+                workers,
+            )
+            if pruning is not None:
+                result.background.append(pruning)
+            return True
+
+        # Mirroring a folder that another pair writes to (or reads from) would
+        # delete that pair's files
+        mirror_guard = [pair["source"] for pair in pairs] + [
+            pair_destination(settings, pair["source"], dest)
+            for pair, plan in plans
+            for dest in pair_destinations(pair)
+        ]
+
+        def mirror_pair(plan, pair, dest):
+            # Returns False if cancelled
+            name = pair["name"]
+            # The pair's own source is kept in the list: it must not lie inside dest
+            others = list(mirror_guard)
+            others.remove(dest)
+            if mirror.overlaps(dest, others):
+                progress.log(
+                    f"Folder pair '{name}': Destination is shared with another folder pair; not removing stale files.",
+                    skip_color,
+                    "skip",
+                )
+                return True
+            progress.send("update", f"Removing stale files: {name}")
+            removed = mirror.remove_stale(
+                plan,
+                dest,
+                settings["skip_hidden_files"],
+                progress,
+                cancel_flag,
+                worker_count(settings, dest, dest),
+            )
+            if removed is None:
+                return False
+            if removed:
+                progress.log(
+                    f"Folder pair '{name}': Removed {removed} items no longer in the source",
+                    skip_color,
+                    "delete",
+                )
+            return True
+
+        active_pairs = []
+        active_lock = threading.Lock()
+
+        def usable_destinations(pair):
+            # Missing extra destinations are left out, not fatal
+            dests = []
+            for dest in pair_destinations(pair):
+                if not os.path.exists(dest):
+                    progress.log(
+                        f"Folder pair '{pair['name']}': Destination '{dest}' does not exist. Leaving it out.",
+                        skip_color,
+                        "skip",
+                    )
+                    continue
+                if settings["copy_folder_checkbox_state"]:
+                    new_destination = pair_destination(settings, pair["source"], dest)
+                    try:
+                        os.makedirs(new_destination, exist_ok=True)
+                    except OSError as e:
+                        progress.log_error(
+                            f"Cannot create destination subfolder '{new_destination}': {e}",
+                            "copy",
+                        )
+                        continue
+                    dest = new_destination
+                dests.append(dest)
+            return dests
+
+        def copy_pair(item):
+            # Returns False if the copy was cancelled
+            pair, plan = item
+            if cancel_flag.is_set():
+                return False
+            source = pair["source"]
+            name = pair["name"]
+            copy_start = time.perf_counter()
+            with active_lock:
+                active_pairs.append(name)
+                progress.send("update", f"Copying: {', '.join(active_pairs)}")
+
+            try:
+                dests = usable_destinations(pair)
+                if not dests:
+                    result.skipped.append(name)
+                    return True
+
+                mode = pair["mode"]
+                if mode in (snapshot_store.mode, generations.mode):
+                    for missing in pair_destinations(pair)[len(dests) :]:
+                        progress.remove_from_total(plan.total_size)
+                    add_to_history = (
+                        snapshot_pair
+                        if mode == snapshot_store.mode
+                        else generation_pair
+                    )
+                    for dest in dests:
+                        if not add_to_history(plan, pair, dest):
+                            return False
+                elif mode in archive_writer.archive_formats:
+                    archive_path = archive_pair(plan, source, dests[0], mode)
+                    if archive_path is None:
+                        return False
+                    for dest in dests[1:]:
+                        copy_archive(archive_path, dest)
+                else:
+                    if isinstance(plan, file_stream.FileStream):
+                        if not plan.check_size():
+                            # Nothing was opened or copied for this pair yet
+                            progress.remove_from_total(plan.counted)
+                            progress.log(
+                                f"Folder pair '{name}': Exceeds size limit ({settings['file_size_limit']} GB). Skipping.",
+                                skip_color,
+                                "skip",
+                            )
+                            result.skipped.append(name)
+                            return True
+                    if not copy_pair_files(plan, source, dests, name):
+                        return False
+                    if isinstance(plan, file_stream.FileStream):
+                        if plan.over_limit:
+                            progress.log(
+                                f"Folder pair '{name}': Exceeds size limit ({settings['file_size_limit']} GB). Stopped after copying {plan.file_count} files.",
+                                skip_color,
+                                "skip",
+                            )
+                            result.skipped.append(name)
+                            return True
+                        sizes.store(plan, rules_keys[name])
+                    if settings["mirror_destination"]:
+                        for dest in dests:
+                            if not mirror_pair(plan, pair, dest):
+                                return False
+
+                copy_time = time.perf_counter() - copy_start
+                timing_message = f"Folder pair '{name}': scanned {plan.file_count} files in {plan.scan_time:.2f} s, copied in {copy_time:.2f} s"
+                progress.log(timing_message, copy_color, "copy")
+                logging.info(timing_message)
+                result.done.append(name)
+                return True
+            finally:
+                with active_lock:
+                    active_pairs.remove(name)
+
+        # Pairs sharing a disk run one after another, independent disks in parallel
+        if settings["parallel_pairs"]:
+            lanes = copy_engine.schedule_by_device(
+                plans,
+                lambda item: (item[0]["source"], *pair_destinations(item[0])),
+            )
+        else:
+            lanes = [plans]
+        completed = copy_engine.run_lanes(lanes, copy_pair)
+        if rules_keys:
+            save_sizes()
+        if not completed:
+            result.finish(progress, "cancel", "Copy cancelled by user!")
+            return result
+
+        if not result.done:
+            # Every pair was skipped once its copy was due (size limit, no
+            # usable destination)
+            result.finish(
+                progress, "complete", "No valid folder pairs found to copy (check log)."
+            )
+        elif settings["incremental_copy"]:
+            result.finish(
+                progress,
+                "complete",
+                f"Copying completed. {progress.unchanged_files} unchanged files skipped.",
+            )
+        else:
+            result.finish(progress, "complete", "Copying completed.")
+
+    except Exception as e:
+        result.finish(progress, "error", f"Error in copy thread: {str(e)}")
+        logging.error(f"Error in copy thread: {e}", exc_info=True)
+    finally:
+        if run.buffers.peak:
+            buffer_message = f"Copy buffers: {run.buffers.peak / 1024**2:.1f} MB peak (at most {copy_engine.max_chunk_size // 1024**2} MB per worker)"
+            progress.log(buffer_message, copy_color, "copy")
+            logging.info(buffer_message)
+        progress.flush()
+        logging.debug(
+            f"Progress events: {progress.published_events} published, {progress.suppressed_events} suppressed"
+        )
+    return result
+
+
+def verify_pairs(settings, data, pairs, progress, cancel_flag):
+    # Re-hashes the destinations against the recorded manifests
+    result = RunResult()
+
+    try:
+        checks = []
+        for pair in pairs:
+            source = pair["source"]
+            name = pair["name"]
+            if pair["mode"] != "copy":
+                progress.log(
+                    f"Folder pair '{name}': Verification is only available for plain copies. Skipping.",
+                    skip_color,
+                    "skip",
+                )
+                result.skipped.append(name)
+                continue
+            # Every destination is checked against its own manifest
+            targets = []
+            for dest in pair_destinations(pair):
+                dest = pair_destination(settings, source, dest)
+                manifest_path = os.path.join(
+                    data.manifests, copy_engine.manifest_name(source, dest)
+                )
+                if not os.path.exists(manifest_path):
+                    continue
+                manifest = copy_engine.Manifest(manifest_path)
+                targets.append((dest, manifest))
+                progress.total_bytes += sum(
+                    entry[0] for entry in manifest.previous.values()
+                )
+            if not targets:
+                progress.log(
+                    f"Folder pair '{name}': No hashes recorded yet; copy it with 'Verify copies' enabled first. Skipping.",
+                    skip_color,
+                    "skip",
+                )
+                result.skipped.append(name)
+                continue
+            checks.append((pair, targets))
+
+        if not checks:
+            result.finish(
+                progress, "complete", "No folder pairs to verify (check log)."
+            )
+            return result
+
+        progress.send("start", progress.total_bytes)
+        for pair, targets in checks:
+            for dest, manifest in targets:
+                progress.send("update", f"Verifying: {pair['name']} ({dest})")
+                workers = worker_count(settings, pair["source"], dest)
+                if not copy_engine.verify_files(
+                    manifest, dest, progress, cancel_flag, workers, result.verify
+                ):
+                    result.finish(progress, "cancel", "Verification cancelled by user!")
+                    return result
+            result.done.append(pair["name"])
+
+        verify = result.verify
+        message = f"Verification completed: {verify.verified} files match, {verify.mismatched} differ, {verify.missing} missing."
+        if verify.unhashed:
+            message += f" {verify.unhashed} files had no recorded hash."
+        result.finish(progress, "complete", message)
+
+    except Exception as e:
+        result.finish(progress, "error", f"Error in verify thread: {str(e)}")
+        logging.error(f"Error in verify thread: {e}", exc_info=True)
+    return result
+
+
+def restore_snapshot(settings, store, header, target, progress, cancel_flag):
+    # Restores one snapshot of a folder pair into target; existing files with
+    # the same paths are replaced
+    result = RunResult()
+    try:
+        progress.total_bytes = header["size"]
+        progress.send("start", progress.total_bytes)
+        progress.send(
+            "update", f"Restoring snapshot '{header['id']}' of '{header['name']}'"
+        )
+        workers = worker_count(settings, store.root, target)
+        if not snapshot_store.restore_snapshot(
+            store, header, target, progress, cancel_flag, workers
+        ):
+            result.finish(progress, "cancel", "Restore cancelled by user!")
+            return result
+        result.done.append(header["name"])
+        result.finish(
+            progress,
+            "complete",
+            f"Restored {header['files']} files of snapshot '{header['id']}' to '{target}'.",
+        )
+    except Exception as e:
+        result.finish(progress, "error", f"Error in restore thread: {str(e)}")
+        logging.error(f"Error in restore thread: {e}", exc_info=True)
+    finally:
+        progress.flush()
+    return result
+
+
+def pair_archives(settings, pair):
+    # Paths of the pair's archives that have an index, one per destination
+    archives = []
+    if pair["mode"] not in archive_writer.archive_formats:
+        return archives
+    for dest in pair_destinations(pair):
+        archive_path = archive_writer.archive_path_for(
+            pair["source"],
+            pair_destination(settings, pair["source"], dest),
+            pair["mode"],
+        )
+        if os.path.exists(f"{archive_path}.index.json"):
+            archives.append(archive_path)
+    return archives
+
+
+def restore_archive_file(settings, pair, rel_path, target, progress, cancel_flag):
+    # Restores one file of an archived folder pair to the same relative path
+    # under target, read straight from the archive through its index
+    result = RunResult()
+    try:
+        archives = pair_archives(settings, pair)
+        if not archives:
+            result.finish(
+                progress,
+                "error",
+                f"Folder pair '{pair['name']}' has no indexed archive to restore from.",
+            )
+            return result
+        rel_path = os.path.normpath(rel_path)
+        progress.send("start", 0)
+        progress.send("update", f"Restoring '{rel_path}' of '{pair['name']}'")
+        target_path = os.path.join(target, rel_path)
+        unreadable = False
+        for archive_path in archives:
+            try:
+                size = archive_writer.restore_file(archive_path, rel_path, target_path)
+            except KeyError:
+                continue
+            except OSError as e:
+                # Another destination may still have a readable copy
+                unreadable = True
+                progress.log_error(
+                    f"Cannot restore '{rel_path}' from '{archive_path}': {e}", "restore"
+                )
+                continue
+            progress.add_to_total(size)
+            progress.add_copied(size)
+            result.done.append(pair["name"])
+            result.finish(
+                progress,
+                "complete",
+                f"Restored '{rel_path}' from '{archive_path}' to '{target_path}'.",
+            )
+            return result
+        if unreadable:
+            message = f"Could not restore '{rel_path}' of folder pair '{pair['name']}'."
+        else:
+            message = (
+                f"'{rel_path}' is not in the archive of folder pair '{pair['name']}'."
+            )
+        result.finish(progress, "error", message)
+    except Exception as e:
+        result.finish(progress, "error", f"Error in restore thread: {str(e)}")
+        logging.error(f"Error in restore thread: {e}", exc_info=True)
+    finally:
+        progress.flush()
+    return result
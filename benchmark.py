@@ -0,0 +1,1817 @@
+import os
+import sys
+import time
+import queue
+import random
+import fnmatch
+import shutil
+import argparse
+import resource
+import multiprocessing
+import datetime
+import tempfile
+import stat
+import types
+import threading
+
+import copy_engine
+import file_walker
+import archive_writer
+import delta_copy
+import copy_journal
+import mirror
+import tree_delete
+import throttle
+import folder_watch
+import ignore_rules
+import size_cache
+import fan_out
+import snapshot_store
+import file_stream
+import generations
+
+# Benchmarks for the copy engine; run with: python benchmark.py <name> [--keep]
+
+
+def make_tree(root, file_count, file_size, files_per_dir=200):
+    data = os.urandom(file_size)
+    for index in range(file_count):
+        folder = os.path.join(root, f"dir_{index // files_per_dir:05d}")
+        if index % files_per_dir == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"file_{index:07d}.sav"), "wb") as f:
+            f.write(data)
+
+
+class DrainedQueue:
+    # Stand-in for the UI queue: counts events instead of storing them
+
+    def __init__(self):
+        self.events = 0
+
+    def put(self, item):
+        self.events += 1
+
+
+def list_jobs(source, dest):
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    plan = copy_engine.scan_folder(source, [], False, threading.Event(), progress)
+    return plan.jobs(dest)
+
+
+def timed_copy(source, dest, workers):
+    shutil.rmtree(dest, ignore_errors=True)
+    jobs = list_jobs(source, dest)
+    total = sum(job[3] for job in jobs)
+    progress = copy_engine.CopyProgress(DrainedQueue(), total)
+    start = time.perf_counter()
+    copy_engine.copy_files(
+        jobs, copy_engine.CopyRun(progress, threading.Event()), workers
+    )
+    elapsed = time.perf_counter() - start
+    assert progress.copied_bytes == total
+    return elapsed, total
+
+
+def report(label, elapsed, total_bytes, file_count):
+    mb = total_bytes / 1024**2
+    print(
+        f"  {label:<24} {elapsed:8.3f} s  {mb / elapsed:9.1f} MB/s  "
+        f"{file_count / elapsed:10.0f} files/s"
+    )
+
+
+def bench_workers(work_dir, args):
+    trees = {
+        "many small files": (args.small_count, 4 * 1024),
+        "few large files": (args.large_count, 64 * 1024**2),
+    }
+    worker_counts = sorted(
+        {1, args.workers or copy_engine.default_worker_count("", "")}
+    )
+    for label, (count, size) in trees.items():
+        source = os.path.join(work_dir, "source")
+        dest = os.path.join(work_dir, "dest")
+        shutil.rmtree(source, ignore_errors=True)
+        make_tree(source, count, size)
+        print(f"{label}: {count} x {size // 1024} KB")
+        for workers in worker_counts:
+            elapsed, total = timed_copy(source, dest, workers)
+            report(f"{workers} worker(s)", elapsed, total, count)
+
+
+def classic_copy(src_path, dest_path, progress):
+    # The original loop: a fresh bytes object per 1MB chunk
+    with open(src_path, "rb") as f_src, open(dest_path, "wb") as f_dst:
+        while chunk := f_src.read(copy_engine.chunk_size):
+            f_dst.write(chunk)
+            progress.add_copied(len(chunk))
+
+
+def bench_backends(work_dir, args):
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.large_count, 64 * 1024**2)
+    jobs = list_jobs(source, dest)
+    total = sum(job[3] for job in jobs)
+    print(f"{args.large_count} x 64 MB, single worker")
+
+    methods = ["classic"] + copy_engine.available_backends()[1:]
+    for method in methods:
+        shutil.rmtree(dest, ignore_errors=True)
+        progress = copy_engine.CopyProgress(DrainedQueue(), total)
+        run = copy_engine.CopyRun(progress, threading.Event(), backend=method)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        for src_path, dest_path, rel_path, size, mtime_ns in jobs:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if method == "classic":
+                classic_copy(src_path, dest_path, progress)
+            else:
+                copy_engine.copy_file(src_path, dest_path, run)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        assert progress.copied_bytes == total
+        print(
+            f"  {method:<16} {elapsed:8.3f} s  {total / 1024**2 / elapsed:9.1f} MB/s"
+            f"  cpu {cpu:7.3f} s"
+        )
+
+
+def bench_incremental(work_dir, args):
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    manifest_path = os.path.join(work_dir, "manifest.json")
+    make_tree(source, args.small_count, 4 * 1024)
+    print(f"{args.small_count} x 4 KB, {args.workers or 1} worker(s)")
+
+    for label in (
+        "first run",
+        "nothing changed",
+        "one file changed",
+        "one backup deleted",
+    ):
+        if label == "one file changed":
+            with open(list_jobs(source, dest)[0][0], "ab") as f:
+                f.write(b"new data")
+        if label == "one backup deleted":
+            # The manifest still has it; the missing copy must be noticed
+            os.remove(list_jobs(source, dest)[-1][1])
+        start = time.perf_counter()
+        jobs = list_jobs(source, dest)
+        manifest = copy_engine.Manifest(manifest_path)
+        progress = copy_engine.CopyProgress(DrainedQueue(), sum(j[3] for j in jobs))
+        run = copy_engine.CopyRun(progress, threading.Event())
+        copy_engine.copy_files(jobs, run, args.workers or 1, manifest)
+        manifest.save()
+        elapsed = time.perf_counter() - start
+        copied = len(jobs) - progress.unchanged_files
+        print(f"  {label:<18} {elapsed:8.3f} s  {copied:7d} copied")
+        if label != "first run":
+            assert copied == (label != "nothing changed"), label
+
+
+def walk_sizes(source):
+    # What the size check and the copy thread each did before sharing a plan
+    sizes = []
+    for root, dirs, files in os.walk(source):
+        for file in files:
+            sizes.append(os.path.getsize(os.path.join(root, file)))
+    return sizes
+
+
+def bench_scan(work_dir, args):
+    source = os.path.join(work_dir, "source")
+    make_tree(source, args.small_count, 1)
+    print(f"{args.small_count} files")
+
+    start = time.perf_counter()
+    walk_sizes(source)
+    walk_sizes(source)
+    print(f"  two walks    {time.perf_counter() - start:8.3f} s")
+
+    start = time.perf_counter()
+    list_jobs(source, "")
+    print(f"  shared plan  {time.perf_counter() - start:8.3f} s")
+
+
+class SyscallCounter:
+    # Instrumented os shim: counts stat-family and directory listing calls
+
+    def __init__(self):
+        self.counts = {"stat": 0, "scandir": 0, "DirEntry.stat": 0}
+        self.originals = {}
+
+    def __enter__(self):
+        counter = self
+
+        class CountingEntry:
+            def __init__(self, entry):
+                self.entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def is_dir(self):
+                return self.entry.is_dir()
+
+            def is_symlink(self):
+                return self.entry.is_symlink()
+
+            def stat(self):
+                # Cached by os.DirEntry: a syscall on POSIX, free on Windows
+                counter.counts["DirEntry.stat"] += 1
+                return self.entry.stat()
+
+        class CountingScandir:
+            def __init__(self, path):
+                counter.counts["scandir"] += 1
+                self.iterator = counter.originals["scandir"](path)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self.iterator.close()
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                return CountingEntry(next(self.iterator))
+
+            def close(self):
+                self.iterator.close()
+
+        def counting_stat(*args, **kwargs):
+            counter.counts["stat"] += 1
+            return counter.originals["stat"](*args, **kwargs)
+
+        self.originals = {"stat": os.stat, "scandir": os.scandir}
+        os.stat = counting_stat
+        os.scandir = CountingScandir
+        return self
+
+    def __exit__(self, *exc):
+        os.stat = self.originals["stat"]
+        os.scandir = self.originals["scandir"]
+
+
+def old_walk_scan(source, ignored_folders):
+    # get_folder_size/copy_thread before the shared walker
+    sizes = []
+    for root, dirs, files in os.walk(source):
+        if os.path.abspath(root) in ignored_folders:
+            dirs[:] = []
+            continue
+        for file in files:
+            sizes.append(os.path.getsize(os.path.join(root, file)))
+    return sizes
+
+
+def walker_scan(source, ignored_folders):
+    sizes = []
+    for _, _, file_entries in file_walker.walk(source, ignored_folders):
+        for entry in file_entries:
+            sizes.append(entry.stat().st_size)
+    return sizes
+
+
+def bench_walker(work_dir, args):
+    source = os.path.join(work_dir, "source")
+    make_tree(source, args.small_count, 1, files_per_dir=100)
+    ignored = [os.path.join(source, "dir_00000")]
+    print(f"{args.small_count} files in {args.small_count // 100} folders")
+
+    for label, scan in (
+        ("os.walk + getsize", old_walk_scan),
+        ("scandir walker", walker_scan),
+    ):
+        start = time.perf_counter()
+        scan(source, ignored)
+        elapsed = time.perf_counter() - start
+        with SyscallCounter() as counter:
+            scan(source, ignored)
+        counts = ", ".join(f"{name} {count}" for name, count in counter.counts.items())
+        print(f"  {label:<20} {elapsed:8.3f} s  ({counts})")
+
+
+def bench_progress(work_dir, args):
+    # A 50 GB copy in 1MB chunks, one log line per 1000 chunks, from 4 workers
+    chunks = args.chunks
+    print(f"{chunks} chunk updates from 4 workers")
+
+    for label, interval in (("every chunk", 0), ("coalesced", None)):
+        events = queue.Queue()
+        progress = copy_engine.CopyProgress(
+            events, chunks * copy_engine.chunk_size, interval
+        )
+
+        def worker():
+            for index in range(chunks // 4):
+                progress.add_copied(copy_engine.chunk_size)
+                if index % 1000 == 0:
+                    progress.log(f"Copied: 'file_{index}'", (0, 140, 139), "copy")
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        progress.flush()
+        produce_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        drained = 0
+        while not events.empty():
+            events.get_nowait()
+            drained += 1
+        drain_time = time.perf_counter() - start
+        print(
+            f"  {label:<12} workers {produce_time:6.3f} s  UI drain {drain_time:6.3f} s  "
+            f"queue events {drained:7d}  (published {progress.published_events}, "
+            f"suppressed {progress.suppressed_events})"
+        )
+
+
+def bench_pairs(work_dir, args):
+    # Simulated disks: each pair takes 0.2 s on its devices, 3 disk pairs x 2 pairs
+    devices = {"C:/saves": 1, "D:/backup": 2, "E:/saves": 3, "F:/backup": 4}
+    pairs = [
+        ("C:/saves", "D:/backup"),
+        ("C:/saves", "D:/backup"),
+        ("E:/saves", "F:/backup"),
+        ("E:/saves", "F:/backup"),
+        ("//nas/saves", "//nas/backup"),
+        ("//nas/saves", "//nas/backup"),
+    ]
+    busy = {}
+    busy_lock = threading.Lock()
+
+    def copy_pair(pair):
+        with busy_lock:
+            for path in pair:
+                key = devices.get(path, path)
+                assert key not in busy, "two pairs used the same device at once"
+                busy[key] = True
+        time.sleep(0.2)
+        with busy_lock:
+            for path in pair:
+                busy.pop(devices.get(path, path))
+        return True
+
+    original_device_of = copy_engine.device_of
+    copy_engine.device_of = lambda path: devices.get(path, path)
+    try:
+        for label, lanes in (
+            ("one after another", [pairs]),
+            ("scheduled", copy_engine.schedule_by_device(pairs, lambda pair: pair)),
+        ):
+            start = time.perf_counter()
+            copy_engine.run_lanes(lanes, copy_pair)
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<18} {elapsed:6.2f} s  ({len(lanes)} lane(s))")
+    finally:
+        copy_engine.device_of = original_device_of
+
+
+def bench_archive(work_dir, args):
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.small_count, 4 * 1024)
+    plan = copy_engine.scan_folder(
+        source,
+        [],
+        False,
+        threading.Event(),
+        copy_engine.CopyProgress(DrainedQueue(), 0),
+    )
+    print(f"{args.small_count} x 4 KB")
+
+    elapsed, total = timed_copy(source, dest, 1)
+    report("plain copy", elapsed, total, args.small_count)
+
+    rel_path = plan.files[len(plan.files) // 2][1]
+    for archive_format in archive_writer.archive_formats:
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+        archive_path = archive_writer.archive_path_for(source, dest, archive_format)
+        progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+        start = time.perf_counter()
+        archive_writer.write_archive(
+            plan, archive_path, archive_format, progress, threading.Event()
+        )
+        elapsed = time.perf_counter() - start
+        assert progress.copied_bytes == plan.total_size
+        report(f"archive {archive_format}", elapsed, plan.total_size, args.small_count)
+
+        restored = os.path.join(work_dir, "restored.sav")
+        start = time.perf_counter()
+        archive_writer.restore_file(archive_path, rel_path, restored)
+        restore_time = time.perf_counter() - start
+        with open(restored, "rb") as f_a, open(
+            os.path.join(source, rel_path), "rb"
+        ) as f_b:
+            assert f_a.read() == f_b.read()
+        print(f"    single-file restore {restore_time * 1000:7.2f} ms")
+
+        # A crash between the archive's and the index's rename: the new
+        # archive next to the old index must not be read with its offsets
+        index_path = f"{archive_path}.index.json"
+        shutil.copy2(index_path, f"{index_path}.old")
+        smaller = copy_engine.FilePlan(source)
+        smaller.dirs = plan.dirs
+        smaller.files = plan.files[1:]
+        archive_writer.write_archive(
+            smaller,
+            archive_path,
+            archive_format,
+            copy_engine.CopyProgress(DrainedQueue(), 0),
+            threading.Event(),
+        )
+        os.replace(f"{index_path}.old", index_path)
+        assert not archive_writer.index_matches(archive_path)
+        try:
+            archive_writer.restore_file(archive_path, rel_path, restored)
+            raise AssertionError("restored through an out of date index")
+        except archive_writer.IndexMismatch:
+            pass
+
+
+class CancellingProgress(copy_engine.CopyProgress):
+    # Cancels the run once stop_after = (bytes, cancel_flag) were copied
+    stop_after = None
+
+    def add_copied(self, size):
+        super().add_copied(size)
+        if self.stop_after is not None and self.copied_bytes >= self.stop_after[0]:
+            self.stop_after[1].set()
+
+
+def bench_delta(work_dir, args):
+    # One large save file with 1% of its bytes rewritten in random 64 KB extents
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    size = args.delta_mb * 1024**2
+    make_tree(source, 1, size)
+    jobs = list_jobs(source, dest)
+    os.makedirs(os.path.dirname(jobs[0][1]), exist_ok=True)
+    delta = delta_copy.DeltaCopier(os.path.join(work_dir, "signatures"), 0)
+    print(f"1 x {args.delta_mb} MB, 1% changed between runs")
+
+    def run_copy(label, copier):
+        progress = copy_engine.CopyProgress(DrainedQueue(), size)
+        run = copy_engine.CopyRun(progress, threading.Event(), delta=copier)
+        start = time.perf_counter()
+        copy_engine.copy_files(list_jobs(source, dest), run, 1)
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {label:<22} {elapsed:8.3f} s  "
+            f"{progress.copied_bytes / 1024**2:9.1f} MB written"
+        )
+
+    run_copy("initial (signature)", delta)
+    extent = 64 * 1024
+    with open(jobs[0][0], "r+b") as f:
+        for _ in range(size // 100 // extent):
+            f.seek(random.randrange(0, size - extent))
+            f.write(os.urandom(extent))
+    shutil.copyfile(os.path.join(dest, jobs[0][2]), os.path.join(work_dir, "full"))
+
+    run_copy("delta copy", delta)
+    with open(jobs[0][0], "rb") as f_a, open(jobs[0][1], "rb") as f_b:
+        assert f_a.read() == f_b.read(), "delta copy produced a different file"
+    os.replace(os.path.join(work_dir, "full"), jobs[0][1])
+    run_copy("full copy", None)
+
+    # Interrupted delta copies must never leave a damaged file that the next
+    # run skips as already existing
+    journal_path = os.path.join(work_dir, "journal")
+
+    def interrupted_copy(copier, stop_after, skip_existing):
+        progress = CancellingProgress(DrainedQueue(), size)
+        run = copy_engine.CopyRun(
+            progress, threading.Event(), skip_existing=skip_existing, delta=copier
+        )
+        progress.stop_after = (stop_after, run.cancel_flag)
+        journal = copy_journal.CopyJournal(journal_path)
+        completed = copy_engine.copy_files(
+            list_jobs(source, dest), run, 1, None, journal
+        )
+        journal.close(completed)
+        return completed
+
+    def resumed_copy(copier):
+        progress = copy_engine.CopyProgress(DrainedQueue(), size)
+        run = copy_engine.CopyRun(
+            progress, threading.Event(), skip_existing=True, delta=copier
+        )
+        journal = copy_journal.CopyJournal(journal_path)
+        assert copy_engine.copy_files(list_jobs(source, dest), run, 1, None, journal)
+        journal.close(True)
+        with open(jobs[0][0], "rb") as f_a, open(jobs[0][1], "rb") as f_b:
+            assert f_a.read() == f_b.read(), "resumed copy left a different file"
+
+    # A new file (no signature) cancelled after a few blocks
+    os.remove(jobs[0][1])
+    assert not interrupted_copy(delta, 2 * 1024**2, True)
+    assert not os.path.exists(jobs[0][1]), "partial delta copy under the final name"
+    resumed_copy(delta)
+    # An in-place update cancelled halfway
+    with open(jobs[0][0], "r+b") as f:
+        f.write(os.urandom(size))
+    assert not interrupted_copy(delta, size // 2, False)
+    assert not os.path.exists(jobs[0][1]), "damaged in-place update kept"
+    resumed_copy(delta)
+    # A crash during an in-place update: only the journal knows
+    journal = copy_journal.CopyJournal(journal_path)
+    journal.started(jobs[0][2], in_place=True)
+    journal.close(False)
+    journal = copy_journal.CopyJournal(journal_path)
+    run = copy_engine.CopyRun(
+        copy_engine.CopyProgress(DrainedQueue(), size),
+        threading.Event(),
+        skip_existing=True,
+    )
+    assert copy_engine.existing_copy(jobs[0], run, None, journal) is None
+    journal.close(True)
+    print("  interrupted delta copies are copied again")
+
+
+def bench_verify(work_dir, args):
+    # Hashing during the copy against a plain copy and a separate hashing pass
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.large_count, 64 * 1024**2)
+    make_tree(os.path.join(source, "small"), args.small_count // 10, 64 * 1024)
+    jobs = list_jobs(source, dest)
+    total = sum(job[3] for job in jobs)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    manifest_path = os.path.join(work_dir, "manifest.json")
+    print(f"{len(jobs)} files, {total / 1024**2:.0f} MB, {workers} worker(s)")
+
+    def run_copy(label, verify, separate_hash):
+        shutil.rmtree(dest, ignore_errors=True)
+        for job in jobs:
+            os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+        progress = copy_engine.CopyProgress(DrainedQueue(), total)
+        run = copy_engine.CopyRun(progress, threading.Event(), verify=verify)
+        manifest = copy_engine.Manifest(manifest_path, incremental=False)
+        start = time.perf_counter()
+        copy_engine.copy_files(jobs, run, workers, manifest)
+        if separate_hash:
+            # What a hash needed before: a second read of every source file
+            copy_engine.run_parallel(
+                jobs,
+                lambda job: bool(copy_engine.hash_file(job[0])),
+                workers,
+                threading.Event(),
+            )
+        elapsed = time.perf_counter() - start
+        manifest.save()
+        report(label, elapsed, total, len(jobs))
+
+    run_copy("plain copy", False, False)
+    run_copy("copy, then hash source", False, True)
+    run_copy("hash while copying", True, False)
+
+    result = copy_engine.VerifyResult()
+    progress = copy_engine.CopyProgress(DrainedQueue(), total)
+    start = time.perf_counter()
+    copy_engine.verify_files(
+        copy_engine.Manifest(manifest_path),
+        dest,
+        progress,
+        threading.Event(),
+        workers,
+        result,
+    )
+    report("verify destination", time.perf_counter() - start, total, len(jobs))
+    assert result.verified == len(jobs), "verification reported differences"
+
+    with open(jobs[0][1], "r+b") as f:
+        f.write(b"corrupted")
+    result = copy_engine.VerifyResult()
+    copy_engine.verify_files(
+        copy_engine.Manifest(manifest_path),
+        dest,
+        copy_engine.CopyProgress(DrainedQueue(), total),
+        threading.Event(),
+        workers,
+        result,
+    )
+    assert result.mismatched == 1, "corrupted file was not detected"
+    print("  corrupted file detected by verify")
+
+
+class CancelAfter(copy_engine.CopyProgress):
+    # Trips the cancel flag once a given number of bytes was copied
+
+    def __init__(self, total_bytes, limit, cancel_flag):
+        super().__init__(DrainedQueue(), total_bytes)
+        self.limit = limit
+        self.cancel_flag = cancel_flag
+
+    def add_copied(self, size):
+        super().add_copied(size)
+        if self.copied_bytes >= self.limit:
+            self.cancel_flag.set()
+
+
+def bench_resume(work_dir, args):
+    # A run interrupted halfway, then resumed from its journal
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.large_count, 64 * 1024**2)
+    make_tree(os.path.join(source, "small"), args.small_count, 4 * 1024)
+    jobs = list_jobs(source, dest)
+    total = sum(job[3] for job in jobs)
+    journal_path = os.path.join(work_dir, "journals", "pair.journal")
+    print(f"{len(jobs)} files, {total / 1024**2:.0f} MB, interrupted at 50%")
+
+    def run_copy(label, progress, cancel_flag):
+        for job in jobs:
+            os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+        journal = copy_journal.CopyJournal(journal_path)
+        journal.discard_partials(dest)
+        run = copy_engine.CopyRun(progress, cancel_flag)
+        start = time.perf_counter()
+        completed = copy_engine.copy_files(jobs, run, 1, journal=journal)
+        journal.close(completed)
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {label:<22} {elapsed:8.3f} s  "
+            f"{progress.copied_bytes / 1024**2:9.1f} MB written"
+        )
+        return completed
+
+    cancel_flag = threading.Event()
+    assert not run_copy(
+        "interrupted run", CancelAfter(total, total // 2, cancel_flag), cancel_flag
+    )
+    # No file under its final name may be incomplete
+    for src_path, dest_path, rel_path, size, mtime_ns in jobs:
+        if os.path.exists(dest_path):
+            assert os.path.getsize(dest_path) == size, f"partial file '{rel_path}'"
+    # A crash can leave half a line at the end of the journal
+    with open(journal_path, "a") as f:
+        f.write('["d", "torn')
+
+    progress = copy_engine.CopyProgress(DrainedQueue(), total)
+    assert run_copy("resumed run", progress, threading.Event())
+    assert not os.path.exists(journal_path), "journal kept after a finished run"
+    for src_path, dest_path, rel_path, size, mtime_ns in jobs:
+        assert os.path.getsize(dest_path) == size, f"missing data in '{rel_path}'"
+        assert not os.path.exists(dest_path + copy_journal.partial_suffix)
+
+    shutil.rmtree(dest)
+    run_copy(
+        "full run", copy_engine.CopyProgress(DrainedQueue(), total), threading.Event()
+    )
+
+
+def bench_mirror(work_dir, args):
+    # Wiping the destination and copying everything against an incremental
+    # copy that removes only the files deleted from the source
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.small_count, 64 * 1024)
+    manifest_path = os.path.join(work_dir, "manifest.json")
+    cancel_flag = threading.Event()
+    print(f"{args.small_count} x 64 KB, 1% of the files deleted from the source")
+
+    def scan():
+        progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+        return copy_engine.scan_folder(
+            source, [os.path.join(source, "dir_00000")], False, cancel_flag, progress
+        )
+
+    def copy(plan, manifest):
+        for rel_dir_path in plan.dirs:
+            os.makedirs(os.path.join(dest, rel_dir_path), exist_ok=True)
+        progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+        run = copy_engine.CopyRun(progress, cancel_flag)
+        copy_engine.copy_files(plan.jobs(dest), run, args.workers or 1, manifest)
+        return progress
+
+    copy(scan(), None)
+    # The ignored folder's backup must survive the mirror
+    shutil.copytree(os.path.join(source, "dir_00000"), os.path.join(dest, "dir_00000"))
+    manifest = copy_engine.Manifest(manifest_path)
+    copy(scan(), manifest)
+    manifest.save()
+    plan = scan()
+    removed = random.sample(plan.files, max(1, len(plan.files) // 100))
+    for src_path, rel_path, size, mtime_ns in removed:
+        os.remove(src_path)
+    shutil.rmtree(os.path.join(source, plan.dirs[-1]))
+
+    start = time.perf_counter()
+    plan = scan()
+    progress = copy(plan, copy_engine.Manifest(manifest_path))
+    deleted = mirror.remove_stale(plan, dest, False, progress, cancel_flag)
+    mirror_time = time.perf_counter() - start
+    print(
+        f"  {'incremental + mirror':<24} {mirror_time:8.3f} s  "
+        f"{progress.copied_bytes / 1024**2:9.1f} MB written  {deleted} deleted"
+    )
+    expected = {os.path.normcase(rel_path) for _, rel_path, _, _ in plan.files}
+    for dir_path, rel_dir_path, file_entries in file_walker.walk(dest):
+        for entry in file_entries:
+            rel_path = file_walker.join_rel(rel_dir_path, entry.name)
+            assert os.path.normcase(rel_path) in expected or rel_path.startswith(
+                "dir_00000"
+            ), f"stale file left: '{rel_path}'"
+    assert os.listdir(os.path.join(dest, "dir_00000")), "ignored folder was removed"
+    # A source that cannot be listed must not empty the destination
+    plan = copy_engine.scan_folder(
+        os.path.join(work_dir, "missing"),
+        [],
+        False,
+        cancel_flag,
+        copy_engine.CopyProgress(DrainedQueue(), 0),
+    )
+    assert plan.unreadable == ["."]
+    kept = len(os.listdir(dest))
+    assert mirror.remove_stale(plan, dest, False, progress, cancel_flag) == 0
+    assert len(os.listdir(dest)) == kept, "unreadable source emptied the mirror"
+
+    start = time.perf_counter()
+    for item in os.listdir(dest):
+        shutil.rmtree(os.path.join(dest, item))
+    plan = scan()
+    progress = copy(plan, None)
+    clear_time = time.perf_counter() - start
+    print(
+        f"  {'clear + full copy':<24} {clear_time:8.3f} s  "
+        f"{progress.copied_bytes / 1024**2:9.1f} MB written"
+    )
+
+
+def bench_delete(work_dir, args):
+    # Clearing a destination: the old per-item rmtree against the parallel deleter
+    tree = os.path.join(work_dir, "dest")
+    workers = args.workers or copy_engine.default_worker_count(tree, tree)
+    print(f"{args.delete_count} files of 1 KB in {args.delete_count // 200} folders")
+
+    def serial(path):
+        for item in os.listdir(path):
+            item_path = os.path.join(path, item)
+            if os.path.isfile(item_path) or os.path.islink(item_path):
+                os.unlink(item_path)
+            elif os.path.isdir(item_path):
+                shutil.rmtree(item_path)
+
+    def parallel(path):
+        progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+        stats = tree_delete.DeleteStats(progress, "Clearing...")
+        tree_delete.delete_tree(path, stats, threading.Event(), workers, True)
+        assert stats.files == args.delete_count and stats.errors == 0
+
+    for label, delete in (
+        ("serial rmtree", serial),
+        (f"parallel, {workers} worker(s)", parallel),
+    ):
+        make_tree(tree, args.delete_count, 1024)
+        start = time.perf_counter()
+        delete(tree)
+        elapsed = time.perf_counter() - start
+        assert os.path.isdir(tree) and not os.listdir(tree)
+        print(
+            f"  {label:<24} {elapsed:8.3f} s  "
+            f"{args.delete_count / elapsed:10.0f} files/s"
+        )
+
+    # Links to folders are removed, never entered: a symlink here, and a
+    # Windows junction (a reparse point that is_dir() reports as a folder)
+    outside = os.path.join(work_dir, "outside")
+    make_tree(outside, 10, 1024)
+    os.symlink(outside, os.path.join(tree, "link"), target_is_directory=True)
+    stats = tree_delete.DeleteStats(copy_engine.CopyProgress(DrainedQueue(), 0), "")
+    assert tree_delete.delete_tree(tree, stats, threading.Event(), workers)
+    assert not os.path.lexists(tree) and len(os.listdir(outside)) > 0
+
+    class JunctionEntry:
+        def is_dir(self, follow_symlinks=True):
+            return True
+
+        def stat(self, follow_symlinks=True):
+            return types.SimpleNamespace(
+                st_mode=stat.S_IFDIR,
+                st_file_attributes=stat.FILE_ATTRIBUTE_REPARSE_POINT,
+            )
+
+    assert not tree_delete.is_real_dir(JunctionEntry())
+    print("  links to folders are unlinked, not entered")
+
+
+def bench_chunks(work_dir, args):
+    # The original read() loop against readinto with a fixed 1 MB chunk and
+    # with adaptive chunk sizes, on small and large files
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    trees = {
+        "small files": (args.small_count, 16 * 1024),
+        "large files": (args.large_count, 256 * 1024**2),
+    }
+    for label, (count, size) in trees.items():
+        source = os.path.join(work_dir, "source")
+        dest = os.path.join(work_dir, "dest")
+        shutil.rmtree(source, ignore_errors=True)
+        make_tree(source, count, size)
+        jobs = list_jobs(source, dest)
+        total = count * size
+        print(f"{label}: {count} x {size // 1024} KB, {workers} worker(s)")
+
+        def classic(jobs, progress):
+            def copy(job):
+                classic_copy(job[0], job[1], progress)
+                return True
+
+            copy_engine.run_parallel(jobs, copy, workers, threading.Event())
+            return None
+
+        def readinto(jobs, progress, sizer):
+            run = copy_engine.CopyRun(
+                progress, threading.Event(), backend="readinto", chunk_sizer=sizer
+            )
+            copy_engine.copy_files(jobs, run, workers)
+            return run
+
+        variants = (
+            ("read() per chunk", classic),
+            (
+                "readinto, fixed 1 MB",
+                lambda jobs, progress: readinto(
+                    jobs,
+                    progress,
+                    copy_engine.ChunkSizer(
+                        copy_engine.chunk_size, copy_engine.chunk_size
+                    ),
+                ),
+            ),
+            (
+                "readinto, adaptive",
+                lambda jobs, progress: readinto(jobs, progress, None),
+            ),
+        )
+        for variant, copy in variants:
+            for repeat in range(args.repeat):
+                shutil.rmtree(dest, ignore_errors=True)
+                for job in jobs:
+                    os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+                progress = copy_engine.CopyProgress(DrainedQueue(), total)
+                start = time.perf_counter()
+                run = copy(jobs, progress)
+                elapsed = time.perf_counter() - start
+                assert progress.copied_bytes == total
+            memory = ""
+            if run is not None:
+                learned = max(run.chunk_sizer.learned.values(), default=0)
+                if run.chunk_sizer.min_size == run.chunk_sizer.max_size:
+                    learned = run.chunk_sizer.max_size
+                chunk = f"{learned // 1024} KB" if learned else "sized per file"
+                memory = (
+                    f"  buffers peak {run.buffers.peak / 1024**2:5.1f} MB"
+                    f"  chunk {chunk}"
+                )
+            report(variant, elapsed, total, count)
+            if memory:
+                print(f"  {'':<24}{memory}")
+
+
+def bench_throttle(work_dir, args):
+    # Achieved throughput under a bandwidth limit must stay near the target
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    target = args.throttle_mb * 1024**2
+    # Enough data for about four seconds at the limit, in mixed file sizes
+    make_tree(source, 3, int(target))
+    make_tree(os.path.join(source, "small"), 200, int(target) // 200)
+    jobs = list_jobs(source, dest)
+    total = sum(job[3] for job in jobs)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    print(f"{total / 1024**2:.0f} MB limited to {args.throttle_mb} MB/s")
+
+    for low_priority in (False, True):
+        shutil.rmtree(dest, ignore_errors=True)
+        for job in jobs:
+            os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+        cancel_flag = threading.Event()
+        progress = copy_engine.CopyProgress(
+            DrainedQueue(),
+            total,
+            throttle=throttle.TokenBucket(target),
+            low_priority=low_priority,
+            cancel_flag=cancel_flag,
+        )
+        run = copy_engine.CopyRun(progress, cancel_flag)
+        start = time.perf_counter()
+        copy_engine.copy_files(jobs, run, workers)
+        elapsed = time.perf_counter() - start
+        # The bucket starts full, so a quarter second of data is free
+        achieved = (total - progress.throttle.burst) / elapsed
+        label = "low priority" if low_priority else "normal priority"
+        deviation = achieved / target - 1
+        print(
+            f"  {label:<16} {elapsed:7.2f} s  {achieved / 1024**2:7.2f} MB/s  "
+            f"{deviation:+.1%} from target"
+        )
+        assert abs(deviation) <= args.tolerance, "throughput outside tolerance"
+
+
+def bench_watch(work_dir, args):
+    # Time from saving a file to its backup with continuous backup, against
+    # the full scan a manual incremental run needs to find the same change
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(source, args.small_count, 4 * 1024)
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    cancel_flag = threading.Event()
+    plan = copy_engine.scan_folder(source, [], False, cancel_flag, progress)
+    for rel_dir_path in plan.dirs:
+        os.makedirs(os.path.join(dest, rel_dir_path), exist_ok=True)
+    copy_engine.copy_files(
+        plan.jobs(dest), copy_engine.CopyRun(progress, cancel_flag), 1
+    )
+    folder_watch.debounce_seconds = 0.5
+    print(
+        f"{args.small_count} x 4 KB, 3 files saved 5 times each, "
+        f"debounce {folder_watch.debounce_seconds} s"
+    )
+
+    batches = []
+    copied = threading.Event()
+
+    def on_changes(files, dirs, rescan):
+        changed = folder_watch.plan_changes(source, files, dirs, [], False)
+        run = copy_engine.CopyRun(
+            copy_engine.CopyProgress(DrainedQueue(), 0), cancel_flag
+        )
+        copy_engine.copy_files(changed.jobs(dest), run, 1)
+        batches.append(len(changed.files))
+        copied.set()
+
+    watcher = folder_watch.FolderWatcher(source, on_changes)
+    watcher.start()
+    time.sleep(1)
+    changed = [job for job in plan.jobs(dest)[:: max(1, len(plan.files) // 3)]][:3]
+    start = time.perf_counter()
+    for _ in range(5):
+        for src_path, dest_path, rel_path, size, mtime_ns in changed:
+            with open(src_path, "ab") as f:
+                f.write(os.urandom(512))
+    assert copied.wait(30), "no change batch was delivered"
+    latency = time.perf_counter() - start
+    watcher.stop()
+    for src_path, dest_path, rel_path, size, mtime_ns in changed:
+        assert os.path.getsize(dest_path) == os.path.getsize(src_path)
+    print(
+        f"  {watcher.backend + ' watch':<24} {latency:8.3f} s to backup  "
+        f"{len(batches)} batch(es), {sum(batches)} files copied"
+    )
+
+    start = time.perf_counter()
+    copy_engine.scan_folder(source, [], False, cancel_flag, progress)
+    print(
+        f"  {'full scan (manual run)':<24} {time.perf_counter() - start:8.3f} s to find"
+    )
+
+
+def bench_ignore(work_dir, args):
+    # 500 ignore rules of every kind on a large tree: compiled matcher against
+    # checking each rule in turn, and the walk with and without the rules
+    source = os.path.join(work_dir, "source")
+    make_tree(source, args.entries, 1, files_per_dir=100)
+    dir_count = args.entries // 100
+    rules = (
+        [os.path.join(source, f"dir_{index:05d}") for index in range(0, 150)]
+        + [f"file_{index:07d}.bak" for index in range(150)]
+        + [f"*.tmp{index}" for index in range(100)]
+        + [f"dir_{index:03d}*/cache_*/" for index in range(99)]
+        + ["**/file_00012*.sav"]
+    )
+    print(f"{args.entries} files in {dir_count} folders, {len(rules)} rules")
+
+    # A trailing ** ignores what is inside a folder, never a file of that name
+    trailing = ignore_rules.IgnoreRules(["**/cache/**", "logs/**"], source)
+    cases = [
+        ("cache", True, True),
+        ("cache", False, False),
+        (os.path.join("a", "cache"), True, True),
+        (os.path.join("a", "cache"), False, False),
+        (os.path.join("a", "cache", "file"), False, True),
+        ("logs", True, True),
+        ("logs", False, False),
+        (os.path.join("logs", "x", "file"), False, True),
+    ]
+    for rel_path, is_dir, expected in cases:
+        assert trailing.match(rel_path, is_dir) == expected, (rel_path, is_dir)
+    # An absolute rule for the source ignores it all, one for a folder above it
+    # nothing
+    assert ignore_rules.IgnoreRules([source], source).everything
+    above = ignore_rules.IgnoreRules([os.path.dirname(source)], source)
+    assert not above.everything and not above
+
+    entries = []
+    for dir_path, rel_dir_path, file_entries in file_walker.walk(source):
+        if rel_dir_path != ".":
+            entries.append((rel_dir_path, True))
+        entries.extend(
+            (file_walker.join_rel(rel_dir_path, entry.name), False)
+            for entry in file_entries
+        )
+
+    start = time.perf_counter()
+    compiled = ignore_rules.IgnoreRules(rules, source)
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    matched = sum(compiled.match(rel_path, is_dir) for rel_path, is_dir in entries)
+    match_time = time.perf_counter() - start
+    print(f"  {'compile rules':<24} {compile_time * 1000:8.2f} ms")
+    print(
+        f"  {'compiled matcher':<24} {match_time / len(entries) * 1e6:8.2f} us/entry  ({matched} of {len(entries)} matched)"
+    )
+
+    def rule_by_rule(rel_path, is_dir):
+        path = os.path.normcase(os.path.join(source, rel_path))
+        name = os.path.basename(rel_path)
+        for rule in rules:
+            if os.path.isabs(rule):
+                if path == os.path.normcase(rule):
+                    return True
+            elif rule.endswith("/"):
+                if is_dir and fnmatch.fnmatch(rel_path, "*" + rule[:-1]):
+                    return True
+            elif fnmatch.fnmatch(name, rule) or fnmatch.fnmatch(rel_path, rule):
+                return True
+        return False
+
+    sample = entries[:: max(1, len(entries) // 5000)]
+    start = time.perf_counter()
+    for rel_path, is_dir in sample:
+        rule_by_rule(rel_path, is_dir)
+    naive_time = time.perf_counter() - start
+    print(
+        f"  {'rule by rule (fnmatch)':<24} {naive_time / len(sample) * 1e6:8.2f} us/entry  (sampled {len(sample)})"
+    )
+
+    for label, walk_rules in (("walk, no rules", []), ("walk, 500 rules", rules)):
+        start = time.perf_counter()
+        plan = copy_engine.scan_folder(
+            source,
+            walk_rules,
+            False,
+            threading.Event(),
+            copy_engine.CopyProgress(DrainedQueue(), 0),
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {label:<24} {elapsed:8.3f} s  ({len(plan.files)} files, {len(plan.excluded)} ignored)"
+        )
+
+
+def bench_sizes(work_dir, args):
+    # Deciding whether a pair is over the size limit: full scan, scan that
+    # stops at the limit, and the size cache of an unchanged tree
+    source = os.path.join(work_dir, "source")
+    make_tree(source, args.entries, 4 * 1024, files_per_dir=100)
+    total = args.entries * 4 * 1024
+    limit = total // 10
+    cache = size_cache.SizeCache(os.path.join(work_dir, "folder_sizes.json"))
+    key = size_cache.rules_key([], False)
+    print(
+        f"{args.entries} x 4 KB in {args.entries // 100} folders, limit {size_cache.format_size(limit)}"
+    )
+
+    def scan(size_limit):
+        return copy_engine.scan_folder(
+            source,
+            [],
+            False,
+            threading.Event(),
+            copy_engine.CopyProgress(DrainedQueue(), 0),
+            size_limit,
+        )
+
+    plans = []
+    for label, size_limit in (("full scan", None), ("stop at the limit", limit)):
+        start = time.perf_counter()
+        plan = scan(size_limit)
+        elapsed = time.perf_counter() - start
+        plans.append((label, plan))
+        print(
+            f"  {label:<24} {elapsed:8.3f} s  ({len(plan.files)} files counted, over limit: {plan.total_size > limit})"
+        )
+
+    for label, plan in plans:
+        cache.store(plan, key)
+        cache.save()
+        start = time.perf_counter()
+        entry = size_cache.SizeCache(cache.path).lookup(source, key)
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {'cache of ' + label:<26} {elapsed:8.3f} s  ({len(entry['dirs'])} folders checked, over limit: {entry['size'] > limit})"
+        )
+
+
+def bytes_read():
+    # Bytes this process read through read() calls so far (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class SlowDestination(fan_out.Destination):
+    # A destination that only takes rate bytes per second, like a busy NAS
+
+    def __init__(self, path, rate):
+        super().__init__(path)
+        self.bucket = throttle.TokenBucket(rate)
+
+    def add_written(self, size):
+        super().add_written(size)
+        self.bucket.consume(size)
+
+
+class HungDestination(fan_out.Destination):
+    # A destination that stops answering after its first write, like a share
+    # whose server went away; released sets it free again
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.released = threading.Event()
+
+    def add_written(self, size):
+        super().add_written(size)
+        self.released.wait()
+
+
+def bench_fanout(work_dir, args):
+    # One folder pair with two destinations: two separate copies read the
+    # source twice, the fan-out reads it once and writes both at the same time
+    source = os.path.join(work_dir, "source")
+    make_tree(source, args.large_count, 64 * 1024**2)
+    make_tree(os.path.join(source, "small"), args.small_count, 4 * 1024)
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    plan = copy_engine.scan_folder(source, [], False, threading.Event(), progress)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    print(
+        f"{len(plan.files)} files, {plan.total_size / 1024**2:.0f} MB to 2 destinations, {workers} workers"
+    )
+
+    def prepare(dests):
+        for dest in dests:
+            shutil.rmtree(dest, ignore_errors=True)
+            for rel_dir_path in plan.dirs:
+                os.makedirs(os.path.join(dest, rel_dir_path), exist_ok=True)
+
+    def check(dest):
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            assert os.path.getsize(os.path.join(dest, rel_path)) == size, rel_path
+
+    def measure(label, copy):
+        before = bytes_read()
+        start = time.perf_counter()
+        copy()
+        elapsed = time.perf_counter() - start
+        read = (
+            ""
+            if before is None
+            else f"  {(bytes_read() - before) / 1024**2:9.1f} MB read"
+        )
+        print(f"  {label:<26} {elapsed:8.3f} s{read}")
+
+    dests = [os.path.join(work_dir, "dest_a"), os.path.join(work_dir, "dest_b")]
+
+    def separate_pairs():
+        # What two folder pairs with the same source do; readinto so the
+        # source reads are visible in the read counter
+        for dest in dests:
+            progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+            run = copy_engine.CopyRun(progress, threading.Event(), backend="readinto")
+            copy_engine.copy_files(plan.jobs(dest), run, workers)
+            assert progress.copied_bytes == plan.total_size
+
+    def fanned(label, destinations):
+        def copy():
+            progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+            run = copy_engine.CopyRun(progress, threading.Event())
+            fan_out.FanOut("bench", destinations, run, workers).copy_files(plan)
+            # Every source byte is counted once, however many destinations
+            assert progress.copied_bytes == plan.total_size
+
+        measure(label, copy)
+        for destination in destinations:
+            name = os.path.basename(destination.path)
+            print(f"    {name:<14} {destination.describe()}")
+
+    prepare(dests)
+    measure("two separate pairs", separate_pairs)
+    for dest in dests:
+        check(dest)
+
+    prepare(dests)
+    fanned("fan-out", [fan_out.Destination(dest) for dest in dests])
+    for dest in dests:
+        check(dest)
+
+    # The slow destination holds the reader back once its queue is full, but
+    # never makes the other one fail
+    prepare(dests)
+    slow_rate = args.throttle_mb * 1024**2
+    fanned(
+        f"fan-out, one at {args.throttle_mb:g} MB/s",
+        [fan_out.Destination(dests[0]), SlowDestination(dests[1], slow_rate)],
+    )
+    for dest in dests:
+        check(dest)
+
+    # A destination that cannot be written is dropped after its first error
+    prepare(dests[:1])
+    broken = os.path.join(work_dir, "not_a_folder")
+    with open(broken, "w") as f:
+        f.write("in the way")
+    destinations = [fan_out.Destination(dests[0]), fan_out.Destination(broken)]
+    fanned("fan-out, one failing", destinations)
+    check(dests[0])
+    assert not destinations[1].available and destinations[1].files == 0
+
+    # A hung destination is given up on after stall_timeout and left out from
+    # then on; the run ends without waiting for its stuck writers
+    prepare(dests)
+    hung = HungDestination(dests[1])
+    stall_timeout = fan_out.stall_timeout
+    fan_out.stall_timeout = 1.0
+    try:
+        start = time.perf_counter()
+        fanned("fan-out, one hung", [fan_out.Destination(dests[0]), hung])
+        assert time.perf_counter() - start < 10, "the hung destination held up the run"
+        check(dests[0])
+        assert not hung.available and hung.files == 0
+
+        # Hung on the first chunk with the rest of the file filling its queue:
+        # ending the file must not block either
+        hung_source = os.path.join(work_dir, "hung_source")
+        os.makedirs(hung_source)
+        with open(os.path.join(hung_source, "large.bin"), "wb") as f:
+            f.write(os.urandom((fan_out.queue_depth + 1) * copy_engine.chunk_size))
+        large_plan = copy_engine.scan_folder(
+            hung_source, [], False, threading.Event(), progress
+        )
+        prepare(dests)
+        hung = HungDestination(dests[1])
+        progress = copy_engine.CopyProgress(DrainedQueue(), large_plan.total_size)
+        run = copy_engine.CopyRun(progress, threading.Event())
+        start = time.perf_counter()
+        destinations = [fan_out.Destination(dests[0]), hung]
+        assert fan_out.FanOut("bench", destinations, run, 1).copy_files(large_plan)
+        assert time.perf_counter() - start < 10, "a full queue held up the run"
+        assert os.path.getsize(os.path.join(dests[0], "large.bin")) == (
+            large_plan.total_size
+        )
+        assert not hung.available and hung.files == 0
+        print(
+            f"  {'fan-out, hung with a full queue':<26} {time.perf_counter() - start:8.3f} s"
+        )
+    finally:
+        fan_out.stall_timeout = stall_timeout
+        hung.released.set()
+
+
+def folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dir_path, name))
+        for dir_path, dir_names, file_names in os.walk(path)
+        for name in file_names
+    )
+
+
+def bench_snapshots(work_dir, args):
+    # 50 snapshots of a tree where about 1% of the small files change between
+    # runs and one large file is touched without changing its contents
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(os.path.join(source, "small"), args.small_count, 16 * 1024)
+    make_tree(source, args.large_count, 64 * 1024**2)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    rng = random.Random(1)
+    snapshot_count = 50
+
+    def scan():
+        progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+        return copy_engine.scan_folder(source, [], False, threading.Event(), progress)
+
+    plan = scan()
+    small_files = [entry[0] for entry in plan.files if entry[2] == 16 * 1024]
+    large_files = [entry[0] for entry in plan.files if entry[2] > 16 * 1024]
+    print(
+        f"{len(plan.files)} files, {plan.total_size / 1024**2:.0f} MB, {snapshot_count} snapshots"
+    )
+
+    times = []
+    read = []
+    for run_index in range(snapshot_count):
+        if run_index:
+            for path in rng.sample(small_files, max(1, len(small_files) // 100)):
+                with open(path, "wb") as f:
+                    f.write(os.urandom(16 * 1024))
+            # New mtime, same contents: read again, stored once
+            touched = rng.choice(large_files)
+            os.utime(touched, ns=(time.time_ns(), time.time_ns()))
+        plan = scan()
+        progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+        start = time.perf_counter()
+        header = snapshot_store.take_snapshot(
+            plan, dest, "bench", progress, threading.Event(), workers
+        )
+        times.append(time.perf_counter() - start)
+        read.append(progress.copied_bytes)
+        assert header["files"] == len(plan.files)
+    print(
+        f"  first snapshot           {times[0]:8.3f} s  {read[0] / 1024**2:9.1f} MB read"
+    )
+    later = times[1:]
+    print(
+        f"  later snapshots (avg)    {sum(later) / len(later):8.3f} s  {sum(read[1:]) / len(later) / 1024**2:9.1f} MB read"
+    )
+
+    store = snapshot_store.SnapshotStore(dest)
+    stored = folder_size(store.objects)
+    indexes = folder_size(store.indexes)
+    full_copies = plan.total_size * snapshot_count
+    print(
+        f"  store                    {stored / 1024**2:8.1f} MB objects + {indexes / 1024**2:.1f} MB indexes "
+        f"({(stored + indexes) / full_copies:.1%} of {full_copies / 1024**2:.0f} MB for full copies)"
+    )
+
+    start = time.perf_counter()
+    headers = store.snapshots(source)
+    print(
+        f"  list {len(headers)} snapshots         {time.perf_counter() - start:8.3f} s"
+    )
+    assert len(headers) == snapshot_count
+
+    # The oldest snapshot must come back exactly as the tree was then
+    target = os.path.join(work_dir, "restore")
+    progress = copy_engine.CopyProgress(DrainedQueue(), headers[0]["size"])
+    start = time.perf_counter()
+    assert snapshot_store.restore_snapshot(
+        store, headers[0], target, progress, threading.Event(), workers
+    )
+    print(
+        f"  restore first snapshot   {time.perf_counter() - start:8.3f} s  {progress.copied_bytes / 1024**2:9.1f} MB"
+    )
+    files, dirs = store.read_index(headers[0]["path"])
+    for rel_path, (size, mtime_ns, file_hash) in files.items():
+        restored = os.path.join(target, rel_path)
+        assert copy_engine.hash_file(restored) == file_hash, rel_path
+        assert os.stat(restored).st_mtime_ns == mtime_ns, rel_path
+
+
+def unique_size(path):
+    # Bytes on disk with every hardlinked file counted once
+    inodes = {}
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            stat = os.lstat(os.path.join(dir_path, name))
+            inodes[stat.st_ino] = stat.st_blocks * 512
+    return sum(inodes.values())
+
+
+def bench_generations(work_dir, args):
+    # 20 generations of a tree where about 1% of the small files change
+    # between runs, then pruning of a long fake history
+    source = os.path.join(work_dir, "source")
+    dest = os.path.join(work_dir, "dest")
+    make_tree(os.path.join(source, "small"), args.small_count, 16 * 1024)
+    make_tree(source, args.large_count, 64 * 1024**2)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    rng = random.Random(1)
+    generation_count = 20
+
+    def scan():
+        progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+        return copy_engine.scan_folder(source, [], False, threading.Event(), progress)
+
+    plan = scan()
+    small_files = [entry[0] for entry in plan.files if entry[2] == 16 * 1024]
+    print(
+        f"{len(plan.files)} files, {plan.total_size / 1024**2:.0f} MB, {generation_count} generations"
+    )
+
+    times = []
+    written = []
+    changed_bytes = 0
+    for run_index in range(generation_count):
+        changed = []
+        if run_index:
+            changed = rng.sample(small_files, max(1, len(small_files) // 100))
+            for path in changed:
+                with open(path, "wb") as f:
+                    f.write(os.urandom(16 * 1024))
+            changed_bytes += len(changed) * 16 * 1024
+        plan = scan()
+        progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+        run = copy_engine.CopyRun(progress, threading.Event())
+        start = time.perf_counter()
+        path = generations.write_generation(plan, dest, run, workers)
+        times.append(time.perf_counter() - start)
+        written.append(progress.copied_bytes)
+        assert path is not None
+        # Unchanged files are links to the previous generation, changed ones not
+        if run_index:
+            for src_path, rel_path, size, mtime_ns in plan.files:
+                stat = os.stat(os.path.join(path, rel_path))
+                previous_stat = os.stat(os.path.join(previous, rel_path))
+                assert (stat.st_ino == previous_stat.st_ino) == (
+                    src_path not in changed
+                ), rel_path
+                assert src_path in changed or stat.st_nlink > 1, rel_path
+        previous = path
+    print(
+        f"  first generation         {times[0]:8.3f} s  {written[0] / 1024**2:9.1f} MB written"
+    )
+    later = times[1:]
+    print(
+        f"  later generations (avg)  {sum(later) / len(later):8.3f} s  {sum(written[1:]) / len(later) / 1024**2:9.1f} MB written"
+    )
+    used = unique_size(dest)
+    full_copies = plan.total_size * generation_count
+    print(
+        f"  disk usage               {used / 1024**2:8.1f} MB "
+        f"({(used - unique_size(previous)) / 1024**2:.1f} MB beyond the newest generation for "
+        f"{changed_bytes / 1024**2:.1f} MB changed; {full_copies / 1024**2:.0f} MB for full copies)"
+    )
+    assert len(generations.list_generations(dest)) == generation_count
+    assert not generations.leftovers(dest)
+
+    # Retention on a fake history: one generation every 6 hours for 60 days
+    history = [
+        generations.generation_time("2025-01-01_00-00-00")
+        + datetime.timedelta(hours=6 * index)
+        for index in range(240)
+    ]
+    names = [moment.strftime(generations.name_format) for moment in history]
+    pruned = generations.select_pruned(names, 10, 7, 4)
+    kept = sorted(set(names) - set(pruned))
+    newest = names[-1]
+    assert newest in kept
+    assert set(names[-10:]) <= set(kept)
+    # The last 7 days each keep their newest generation
+    assert {name[:10] for name in names[-7 * 4 :]} <= {name[:10] for name in kept}
+    kept_weeks = {generations.generation_time(name).strftime("%G-%V") for name in kept}
+    assert len(kept_weeks) == 4, kept_weeks
+    assert generations.select_pruned(names, 0, 0, 0) == []
+    print(f"  keep 10 / 7 days / 4 weeks of {len(names)}: {len(kept)} kept")
+
+    # Prune for real: fake names for the generations made above
+    for index, name in enumerate(generations.list_generations(dest)):
+        os.rename(os.path.join(dest, name), os.path.join(dest, names[index]))
+    os.makedirs(os.path.join(dest, names[-1] + generations.partial_suffix))
+    names = generations.list_generations(dest)
+    expected = sorted(set(names) - set(generations.select_pruned(names, 3, 0, 0)))
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    start = time.perf_counter()
+    thread = generations.prune(dest, 3, 0, 0, progress, threading.Event(), workers)
+    returned = time.perf_counter() - start
+    # Pruned generations are out of the way before the thread deletes them
+    assert generations.list_generations(dest) == expected
+    thread.join()
+    print(
+        f"  prune to 3 generations   {returned:8.3f} s to return, {time.perf_counter() - start:.3f} s to delete"
+    )
+    assert sorted(os.listdir(dest)) == expected
+
+    # More than 10 generations within one second: "_10" is newer than "_9"
+    burst_source = os.path.join(work_dir, "burst_source")
+    burst_dest = os.path.join(work_dir, "burst_dest")
+    os.makedirs(burst_source)
+    with open(os.path.join(burst_source, "save.dat"), "wb") as f:
+        f.write(os.urandom(1024))
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    plan = copy_engine.scan_folder(burst_source, [], False, threading.Event(), progress)
+    time.sleep(1 - time.time() % 1)
+    created = []
+    for run_index in range(12):
+        run = copy_engine.CopyRun(progress, threading.Event())
+        created.append(
+            os.path.basename(generations.write_generation(plan, burst_dest, run, 1))
+        )
+    assert len({name[:19] for name in created}) == 1, "the burst took over a second"
+    assert generations.list_generations(burst_dest) == created
+    assert generations.select_pruned(created, 1, 0, 0) == created[:-1]
+    print(f"  {len(created)} generations in one second, newest '{created[-1]}'")
+
+
+def bench_reflink(work_dir, args):
+    # Copies within one file system (where btrfs / XFS clone), within tmpfs
+    # and across file systems; every case must fall back to a byte copy
+    # wherever cloning is not supported and produce identical files
+    shm = tempfile.mkdtemp(prefix="savemanager_bench_", dir="/dev/shm")
+    try:
+        source = os.path.join(work_dir, "source")
+        make_tree(os.path.join(source, "small"), args.small_count, 16 * 1024)
+        make_tree(source, args.large_count, 64 * 1024**2)
+        shm_source = os.path.join(shm, "source")
+        shutil.copytree(source, shm_source)
+        print(
+            f"{args.small_count} x 16 KB + {args.large_count} x 64 MB, {os.path.realpath(work_dir)}"
+        )
+        cases = [
+            ("same file system", source, os.path.join(work_dir, "dest")),
+            ("tmpfs", shm_source, os.path.join(shm, "dest")),
+            ("across file systems", source, os.path.join(shm, "cross")),
+        ]
+        for label, case_source, dest in cases:
+            for backend in ("reflink", "auto"):
+                shutil.rmtree(dest, ignore_errors=True)
+                jobs = list_jobs(case_source, dest)
+                total = sum(job[3] for job in jobs)
+                progress = copy_engine.CopyProgress(DrainedQueue(), total)
+                run = copy_engine.CopyRun(progress, threading.Event(), backend=backend)
+                start = time.perf_counter()
+                for src_path, dest_path, rel_path, size, mtime_ns in jobs:
+                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                    assert copy_engine.copy_file(src_path, dest_path, run)
+                elapsed = time.perf_counter() - start
+                assert progress.copied_bytes == total
+                key = (os.stat(case_source).st_dev, os.stat(dest).st_dev)
+                used = run.selector.chosen.get(key, run.selector.candidates[0])
+                print(
+                    f"  {label:<20} {backend:<8} {elapsed:8.3f} s  {total / 1024**2 / elapsed:9.1f} MB/s  used {used}"
+                )
+                for src_path, dest_path, rel_path, size, mtime_ns in jobs:
+                    with open(src_path, "rb") as f_src, open(dest_path, "rb") as f_dst:
+                        assert f_src.read() == f_dst.read(), rel_path
+    finally:
+        shutil.rmtree(shm, ignore_errors=True)
+
+
+class FirstByteProgress(copy_engine.CopyProgress):
+    first_byte = None
+
+    def add_copied(self, size):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+        super().add_copied(size)
+
+
+def stream_variant(variant, source, dest, tree_size, workers, results):
+    # Runs in a process of its own so its peak RSS is its own
+    progress = FirstByteProgress(DrainedQueue(), 0)
+    run = copy_engine.CopyRun(progress, threading.Event())
+    start = time.perf_counter()
+    if variant == "idle":
+        results.put(
+            (
+                variant,
+                0,
+                0,
+                0,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                0,
+            )
+        )
+        return
+    if variant == "scan, then copy":
+        plan = copy_engine.scan_folder(source, [], False, run.cancel_flag, progress)
+        progress.add_to_total(plan.total_size)
+        for rel_dir_path in plan.dirs:
+            os.makedirs(os.path.join(dest, rel_dir_path), exist_ok=True)
+    else:
+        plan = file_stream.FileStream(
+            source,
+            [],
+            False,
+            run.cancel_flag,
+            progress,
+            size_limit=tree_size if variant == "stream, size limit" else None,
+            known_size=tree_size if variant == "stream, cached size" else None,
+        )
+        progress.add_to_total(plan.counted)
+        plan.on_dir = lambda rel_dir_path: os.makedirs(
+            os.path.join(dest, rel_dir_path), exist_ok=True
+        )
+
+    # When the progress bar got its final total
+    total_known = [None]
+
+    def watch_total():
+        while total_known[0] is None and not run.cancel_flag.is_set():
+            if progress.total_bytes >= tree_size:
+                total_known[0] = time.perf_counter() - start
+            time.sleep(0.005)
+
+    watcher = threading.Thread(target=watch_total, daemon=True)
+    watcher.start()
+    assert copy_engine.copy_files(plan.jobs(dest), run, workers)
+    elapsed = time.perf_counter() - start
+    run.cancel_flag.set()
+    assert progress.copied_bytes == tree_size == progress.total_bytes
+    results.put(
+        (
+            variant,
+            progress.first_byte - start,
+            total_known[0],
+            elapsed,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            plan.file_count,
+        )
+    )
+
+
+def bench_stream(work_dir, args):
+    # Time to the first copied byte and peak memory of a copy of a tree with
+    # many small files: scanning it all first against streaming the scan,
+    # with the total from a size pass (run first under a size limit) or from
+    # the size cache
+    source = os.path.join(work_dir, "source")
+    start = time.perf_counter()
+    make_tree(source, args.stream_files, 64, files_per_dir=1000)
+    tree_size = args.stream_files * 64
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    print(
+        f"{args.stream_files} files of 64 B in {args.stream_files // 1000} folders (made in {time.perf_counter() - start:.0f} s), {workers} workers"
+    )
+    context = multiprocessing.get_context("spawn")
+    variants = [
+        "idle",
+        "scan, then copy",
+        "stream, size pass",
+        "stream, size limit",
+        "stream, cached size",
+    ]
+    for index, variant in enumerate(variants):
+        dest = os.path.join(work_dir, f"dest_{index}")
+        # Write back the previous copy first; it would slow this one down
+        os.sync()
+        results = context.Queue()
+        process = context.Process(
+            target=stream_variant,
+            args=(variant, source, dest, tree_size, workers, results),
+        )
+        process.start()
+        variant, first_byte, total_known, elapsed, peak_rss, file_count = results.get()
+        process.join()
+        if variant == "idle":
+            print(
+                f"  {'interpreter and modules':<22} peak RSS {peak_rss / 1024**2:7.1f} MB"
+            )
+            continue
+        assert file_count == args.stream_files
+        print(
+            f"  {variant:<22} first byte {first_byte:7.3f} s  total known {total_known:7.3f} s  "
+            f"done {elapsed:7.1f} s  peak RSS {peak_rss / 1024**2:7.1f} MB"
+        )
+        # Each copy is deleted before the next one to keep the disk usage down
+        shutil.rmtree(dest)
+
+    # A source over the size limit must not reach the destination at all
+    dest = os.path.join(work_dir, "dest_over_limit")
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    run = copy_engine.CopyRun(progress, threading.Event())
+    plan = file_stream.FileStream(
+        source, [], False, run.cancel_flag, progress, size_limit=tree_size // 2
+    )
+    plan.on_dir = lambda rel_dir_path: os.makedirs(
+        os.path.join(dest, rel_dir_path), exist_ok=True
+    )
+    assert copy_engine.copy_files(plan.jobs(dest), run, workers)
+    assert plan.over_limit and plan.file_count == 0 and not os.path.exists(dest)
+    print("  over the size limit: nothing copied")
+
+
+class MakedirsEveryTime:
+    # The old behaviour: os.makedirs for every folder and every file
+    def make(self, path):
+        os.makedirs(path, exist_ok=True)
+
+
+class SyscallCounter:
+    # Counts the folder related calls that reach the os module while active;
+    # os.path.exists / isdir and os.makedirs go through these too
+    names = ("stat", "lstat", "mkdir")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.names, 0)
+        self.originals = {name: getattr(os, name) for name in self.names}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        for name, original in self.originals.items():
+            setattr(os, name, self.counting(name, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self.originals.items():
+            setattr(os, name, original)
+
+    def counting(self, name, original):
+        def call(*args, **kwargs):
+            with self.lock:
+                self.counts[name] += 1
+            return original(*args, **kwargs)
+
+        return call
+
+
+def bench_dirs(work_dir, args):
+    # stat / mkdir calls of a copy of a nested tree into an empty destination
+    # and again into the complete one, with and without the folder cache
+    source = os.path.join(work_dir, "source")
+    for branch in range(10):
+        make_tree(
+            os.path.join(source, f"branch_{branch}", "nested", "deeper"),
+            args.dirs_files // 10,
+            64,
+            files_per_dir=50,
+        )
+    progress = copy_engine.CopyProgress(DrainedQueue(), 0)
+    plan = copy_engine.scan_folder(source, [], False, threading.Event(), progress)
+    workers = args.workers or copy_engine.default_worker_count("", "")
+    print(f"{len(plan.files)} files in {len(plan.dirs)} folders, {workers} workers")
+    for label, make_dirs in (
+        ("makedirs every time", MakedirsEveryTime),
+        ("folder cache", copy_engine.DirCache),
+    ):
+        dest = os.path.join(work_dir, "dest")
+        shutil.rmtree(dest, ignore_errors=True)
+        for run_label in ("empty destination", "complete destination"):
+            progress = copy_engine.CopyProgress(DrainedQueue(), plan.total_size)
+            run = copy_engine.CopyRun(progress, threading.Event(), skip_existing=True)
+            run.dirs = make_dirs()
+            start = time.perf_counter()
+            with SyscallCounter() as counter:
+                for rel_dir_path in plan.dirs:
+                    run.dirs.make(os.path.join(dest, rel_dir_path))
+                assert copy_engine.copy_files(plan.jobs(dest), run, workers)
+            elapsed = time.perf_counter() - start
+            counts = "  ".join(
+                f"{name} {count:7d}" for name, count in counter.counts.items()
+            )
+            print(f"  {label:<20} {run_label:<21} {elapsed:7.3f} s  {counts}")
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            assert os.path.getsize(os.path.join(dest, rel_path)) == size, rel_path
+
+
+benchmarks = {
+    "dirs": bench_dirs,
+    "stream": bench_stream,
+    "reflink": bench_reflink,
+    "generations": bench_generations,
+    "snapshots": bench_snapshots,
+    "fanout": bench_fanout,
+    "delta": bench_delta,
+    "verify": bench_verify,
+    "resume": bench_resume,
+    "mirror": bench_mirror,
+    "delete": bench_delete,
+    "chunks": bench_chunks,
+    "throttle": bench_throttle,
+    "watch": bench_watch,
+    "ignore": bench_ignore,
+    "sizes": bench_sizes,
+    "archive": bench_archive,
+    "pairs": bench_pairs,
+    "progress": bench_progress,
+    "walker": bench_walker,
+    "scan": bench_scan,
+    "incremental": bench_incremental,
+    "workers": bench_workers,
+    "backends": bench_backends,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save Manager copy benchmarks")
+    parser.add_argument("name", choices=sorted(benchmarks))
+    parser.add_argument("--dir", help="Where to create test trees (default: temp)")
+    parser.add_argument("--keep", action="store_true", help="Keep test trees")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--small-count", type=int, default=10000)
+    parser.add_argument("--large-count", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--delta-mb", type=int, default=512)
+    parser.add_argument("--delete-count", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=2, help="Runs per variant")
+    parser.add_argument("--throttle-mb", type=float, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--stream-files", type=int, default=1000000)
+    parser.add_argument("--dirs-files", type=int, default=50000)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="savemanager_bench_", dir=args.dir)
+    try:
+        benchmarks[args.name](work_dir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
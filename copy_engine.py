@@ -0,0 +1,960 @@
+import os
+import sys
+import json
+import errno
+import hashlib
+import time
+import logging
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    wait,
+    as_completed,
+    FIRST_COMPLETED,
+)
+
+import throttle
+import file_walker
+import ignore_rules
+import copy_journal
+
+if sys.platform.startswith("linux"):
+    import fcntl
+
+    # fcntl only names it from Python 3.12 on
+    _FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+chunk_size: int = 1024 * 1024  # 1MB chunks
+min_chunk_size: int = 64 * 1024  # adaptive read sizes (readinto backend)
+max_chunk_size: int = 16 * 1024 * 1024
+max_workers: int = 32
+
+
+def default_worker_count(source, dest):
+    # Network shares are latency-bound, so more files in flight pay off there
+    if any(path.startswith(("\\\\", "//")) for path in (source, dest)):
+        return 16
+    return min(8, (os.cpu_count() or 1) * 2)
+
+
+publish_interval: float = 1 / 15  # seconds between UI updates
+
+
+class CopyProgress:
+    # Shared between copy workers so the UI still sees a single progress stream.
+    # Counters are aggregated here and published at most every publish_interval;
+    # log messages are sent as one "log_batch" per publish.
+
+    def __init__(
+        self,
+        progress_queue,
+        total_bytes,
+        interval=None,
+        throttle=None,
+        low_priority=False,
+        cancel_flag=None,
+    ):
+        self.progress_queue = progress_queue
+        self.total_bytes = total_bytes
+        # Every stage reports its I/O here, so the bandwidth limit
+        # (throttle.TokenBucket) and the priority setting are applied here too
+        self.throttle = throttle
+        self.low_priority = low_priority
+        self.cancel_flag = cancel_flag
+        self.copied_bytes = 0
+        self.unchanged_files = 0
+        self.interval = publish_interval if interval is None else interval
+        self.published_events = 0
+        self.suppressed_events = 0
+        self.lock = threading.Lock()
+        self._pending_logs: list = []
+        self._pending_status = None
+        self._copied_dirty = False
+        self._total_dirty = False
+        self._last_publish = 0.0
+
+    def add_copied(self, size):
+        with self.lock:
+            self.copied_bytes += size
+            self._copied_dirty = True
+            self._changed()
+        self.throttle_io(size)
+
+    def add_cloned(self, size):
+        # Reflinked files share the source's blocks; no data moved, so the
+        # bandwidth limit does not apply
+        with self.lock:
+            self.copied_bytes += size
+            self._copied_dirty = True
+            self._changed()
+
+    def throttle_io(self, size):
+        # For I/O that is not progress, like reading unchanged delta blocks
+        if self.throttle is not None:
+            self.throttle.consume(size, self.cancel_flag)
+
+    def background_worker(self):
+        # Called by stage workers before they touch the disk
+        if self.low_priority:
+            throttle.lower_thread_priority()
+
+    def add_to_total(self, size):
+        with self.lock:
+            self.total_bytes += size
+            self._total_dirty = True
+            self._changed()
+
+    def remove_from_total(self, size):
+        with self.lock:
+            self.total_bytes -= size
+            self._total_dirty = True
+            self._changed()
+
+    def skip_unchanged(self, size):
+        with self.lock:
+            self.unchanged_files += 1
+            self.total_bytes -= size
+            self._total_dirty = True
+            self._changed()
+
+    def log(self, message, color, tag):
+        with self.lock:
+            self._pending_logs.append(("log_message", (message, color, tag)))
+            self._changed()
+
+    def log_error(self, message, context_tag):
+        with self.lock:
+            self._pending_logs.append(("log_error", (message, context_tag)))
+            self._changed()
+
+    def set_status(self, message):
+        # Status line updates are coalesced like counters; only the latest counts
+        with self.lock:
+            self._pending_status = message
+            self._changed()
+
+    def send(self, item_type, data):
+        # Control events go out immediately, after everything queued before them
+        with self.lock:
+            self._publish()
+            self.progress_queue.put((item_type, data))
+
+    def flush(self):
+        with self.lock:
+            self._publish()
+
+    def _changed(self):
+        now = time.monotonic()
+        if now - self._last_publish >= self.interval:
+            self._last_publish = now
+            self._publish()
+        else:
+            self.suppressed_events += 1
+
+    def _publish(self):
+        if self._total_dirty:
+            self.progress_queue.put(("adjust_total", self.total_bytes))
+            self._total_dirty = False
+            self.published_events += 1
+        if self._copied_dirty:
+            self.progress_queue.put(("progress", self.copied_bytes))
+            self._copied_dirty = False
+            self.published_events += 1
+        if self._pending_status is not None:
+            self.progress_queue.put(("update", self._pending_status))
+            self._pending_status = None
+            self.published_events += 1
+        if self._pending_logs:
+            self.progress_queue.put(("log_batch", self._pending_logs))
+            self._pending_logs = []
+            self.published_events += 1
+
+
+class FilePlan:
+    # Result of scanning a source once; reused for the size check and the copy
+
+    def __init__(self, source):
+        self.source = source
+        self.files: list = []  # (src_path, rel_path, size, mtime_ns)
+        self.dirs: list = []  # relative folder paths, parents before children
+        self.excluded: list = []  # relative paths of ignored or hidden items
+        self.unreadable: list = []  # relative paths of folders that failed to list
+        self.ignore = None  # the compiled ignore rules of the scan
+        self.dir_mtimes: dict = {}  # relative folder path: mtime_ns
+        self.total_size = 0
+        self.over_limit = False  # the scan stopped early at the size limit
+        self.scan_time = 0.0
+
+    @property
+    def file_count(self):
+        return len(self.files)
+
+    def jobs(self, dest):
+        return [
+            (src_path, os.path.join(dest, rel_path), rel_path, size, mtime_ns)
+            for src_path, rel_path, size, mtime_ns in self.files
+        ]
+
+
+_skip_messages: dict = {
+    "ignored": ("Ignored because of a setting: '{}'", "ignore"),
+    "hidden_folder": ("Skipped (hidden folder): '{}'", "skip"),
+    "hidden_file": ("Skipped (hidden file): '{}'", "skip"),
+    "unreadable": ("Cannot list folder: '{}'", "copy"),
+}
+
+
+def log_skip(progress, reason, rel_path):
+    message, tag = _skip_messages[reason]
+    if reason == "unreadable":
+        progress.log_error(message.format(rel_path), tag)
+        return
+    if reason == "hidden_file":
+        rel_path = os.path.basename(rel_path)
+    progress.log(message.format(rel_path), (139, 140, 0), tag)
+
+
+def scan_folder(
+    source, ignored_folders, skip_hidden, cancel_flag, progress, size_limit=None
+):
+    # Returns None if cancelled. With size_limit the scan stops as soon as the
+    # files found add up to more than that; the plan is then only good for
+    # telling that it is too big.
+    plan = FilePlan(source)
+    plan.ignore = ignore_rules.compiled(ignored_folders, source)
+    start = time.perf_counter()
+
+    def on_skip(reason, rel_path):
+        plan.excluded.append(rel_path)
+        if reason == "unreadable":
+            plan.unreadable.append(rel_path)
+        log_skip(progress, reason, rel_path)
+
+    for dir_path, rel_dir_path, file_entries in file_walker.walk(
+        source, plan.ignore, skip_hidden, on_skip, cancel_flag
+    ):
+        # Empty folders are copied too
+        plan.dirs.append(rel_dir_path)
+        try:
+            plan.dir_mtimes[rel_dir_path] = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            pass
+
+        for entry in file_entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                logging.error("File deleted during folder scan")
+                continue
+            rel_path = file_walker.join_rel(rel_dir_path, entry.name)
+            plan.files.append((entry.path, rel_path, stat.st_size, stat.st_mtime_ns))
+            plan.total_size += stat.st_size
+
+        if size_limit is not None and plan.total_size > size_limit:
+            plan.over_limit = True
+            break
+
+    if cancel_flag.is_set():
+        return None
+    plan.scan_time = time.perf_counter() - start
+    return plan
+
+
+class BackendUnsupported(Exception):
+    # Raised before any byte was transferred, so the next backend can take over
+    pass
+
+
+_fallback_errnos = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+    getattr(errno, "EOPNOTSUPP", errno.EINVAL),
+    getattr(errno, "ENOTSUP", errno.EINVAL),
+    errno.ENOTTY,
+}
+
+
+def _fitting_chunk(size):
+    # Smallest power of two chunk that holds size bytes, within the limits
+    chunk = min_chunk_size
+    while chunk < size and chunk < max_chunk_size:
+        chunk *= 2
+    return chunk
+
+
+class ChunkSizer:
+    # Picks the read size per (source fs, destination fs) pair by hill climbing
+    # on measured throughput: the chunk keeps doubling while every step up was
+    # faster than the one below it, and goes back down when the smaller size
+    # turns out faster
+
+    def __init__(self, min_size=min_chunk_size, max_size=max_chunk_size):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.learned: dict = {}
+        self.rates: dict = {}  # (key, chunk): smoothed bytes per second
+        self.lock = threading.Lock()
+
+    def first_chunk(self, key, file_size):
+        with self.lock:
+            learned = self.learned.get(key, chunk_size)
+        # Small files are read in one go, with a buffer no larger than needed
+        return max(
+            self.min_size, min(learned, _fitting_chunk(file_size), self.max_size)
+        )
+
+    def next_chunk(self, key, chunk, length, seconds):
+        # Called after every read; returns the size for the next one
+        if length < chunk or seconds <= 0 or self.min_size == self.max_size:
+            return chunk
+        rate = length / seconds
+        with self.lock:
+            previous = self.rates.get((key, chunk))
+            if previous is not None:
+                rate = previous * 0.75 + rate * 0.25
+            self.rates[(key, chunk)] = rate
+            larger = self.rates.get((key, chunk * 2))
+            smaller = self.rates.get((key, chunk // 2))
+            if chunk > self.min_size and smaller is not None and smaller > rate * 1.05:
+                chunk //= 2
+            elif chunk < self.max_size and (
+                (larger is None and (smaller is None or rate > smaller))
+                or (larger is not None and larger > rate * 1.05)
+            ):
+                chunk *= 2
+            self.learned[key] = chunk
+        return chunk
+
+
+class _WorkerBuffer:
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.data = bytearray(size)
+        pool._track(size)
+
+    def __del__(self):
+        # Runs when the buffer is replaced or its worker thread ends
+        self.pool._track(-len(self.data))
+
+
+class BufferPool:
+    # One reusable buffer per worker thread, grown on demand up to the largest
+    # chunk, so buffer memory stays below workers x max_chunk_size
+
+    def __init__(self):
+        self.local = threading.local()
+        self.in_use = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None or len(buffer.data) < size:
+            # Drop the old buffer before the larger one is allocated
+            buffer = self.local.buffer = None
+            buffer = self.local.buffer = _WorkerBuffer(self, size)
+        return buffer.data
+
+    def _track(self, size):
+        with self.lock:
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+
+
+def _reflink(f_src, f_dst, run, key):
+    # Copy-on-write clone (btrfs, XFS, bcachefs...): the new file shares the
+    # source's blocks until either is changed. Only possible within one file
+    # system, so other pairs go straight to the next backend.
+    if key[0] != key[1]:
+        raise BackendUnsupported("different file systems")
+    if run.cancel_flag.is_set():
+        return False
+    try:
+        fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+    except OSError as e:
+        if e.errno in _fallback_errnos:
+            raise BackendUnsupported(e)
+        raise
+    run.progress.add_cloned(os.fstat(f_src.fileno()).st_size)
+    return True
+
+
+def _copy_file_range_loop(f_src, f_dst, run, key):
+    src_fd, dst_fd = f_src.fileno(), f_dst.fileno()
+    progress = run.progress
+    transferred = 0
+    while not run.cancel_flag.is_set():
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, chunk_size)
+        except OSError as e:
+            if transferred == 0 and e.errno in _fallback_errnos:
+                raise BackendUnsupported(e)
+            raise
+        if copied == 0:
+            return True
+        transferred += copied
+        progress.add_copied(copied)
+    return False
+
+
+def _sendfile_loop(f_src, f_dst, run, key):
+    src_fd, dst_fd = f_src.fileno(), f_dst.fileno()
+    progress = run.progress
+    offset = 0
+    while not run.cancel_flag.is_set():
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, chunk_size)
+        except OSError as e:
+            if offset == 0 and e.errno in _fallback_errnos:
+                raise BackendUnsupported(e)
+            raise
+        if sent == 0:
+            return True
+        offset += sent
+        progress.add_copied(sent)
+    return False
+
+
+def _readinto_loop(f_src, f_dst, run, key, digest=None):
+    sizer = run.chunk_sizer
+    chunk = sizer.first_chunk(key, os.fstat(f_src.fileno()).st_size)
+    view = None
+    while True:
+        if view is None or len(view) < chunk:
+            # The worker's buffer is reused for every file it copies
+            view = block = None
+            view = memoryview(run.buffers.get(chunk))
+        start = time.perf_counter()
+        size = f_src.readinto(view[:chunk])
+        if not size:
+            return True
+        if run.cancel_flag.is_set():
+            return False
+        block = view[:size]
+        if digest is None:
+            f_dst.write(block)
+        else:
+            # Hash the block while it is written; both release the GIL
+            hashed = _hash_pool().submit(digest.update, block)
+            f_dst.write(block)
+            hashed.result()
+        # Measured before add_copied, which may sleep for the bandwidth limit
+        elapsed = time.perf_counter() - start
+        run.progress.add_copied(size)
+        chunk = sizer.next_chunk(key, chunk, size, elapsed)
+
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+
+def _hash_pool():
+    global _hash_executor
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="hasher"
+            )
+        return _hash_executor
+
+
+copy_backends: dict = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range_loop,
+    "sendfile": _sendfile_loop,
+    "readinto": _readinto_loop,
+}
+
+
+def available_backends():
+    available = ["auto"]
+    if sys.platform.startswith("linux"):
+        available.append("reflink")
+    if hasattr(os, "copy_file_range"):
+        available.append("copy_file_range")
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        # Only Linux sendfile() accepts a regular file as the output
+        available.append("sendfile")
+    available.append("readinto")
+    return available
+
+
+class BackendSelector:
+    # Remembers which backend works for each (source fs, destination fs) pair
+
+    def __init__(self, preferred="auto"):
+        available = available_backends()
+        if preferred == "auto" or preferred not in available:
+            self.candidates = available[1:]
+        else:
+            self.candidates = [preferred, "readinto"]
+        self.chosen: dict = {}
+        self.lock = threading.Lock()
+
+    def backends_for(self, f_src, f_dst):
+        key = (os.fstat(f_src.fileno()).st_dev, os.fstat(f_dst.fileno()).st_dev)
+        with self.lock:
+            start = self.chosen.get(key, self.candidates[0])
+        return key, self.candidates[self.candidates.index(start) :]
+
+    def mark_unsupported(self, key, backend):
+        with self.lock:
+            remaining = self.candidates[self.candidates.index(backend) + 1 :]
+            if remaining:
+                self.chosen[key] = remaining[0]
+
+
+class DirCache:
+    # Destination folders known to exist in this run. A folder is looked at
+    # once, parents first; after that neither it nor anything created under it
+    # is checked again. Folders deleted behind the run's back are not noticed.
+
+    def __init__(self):
+        self.known: set = set()
+        self.created: set = set()  # made by this run, so their children are new
+        self.lock = threading.Lock()
+
+    def make(self, path):
+        if path in self.known:
+            return
+        with self.lock:
+            normalized = os.path.normpath(path)
+            missing = []
+            folder = normalized
+            while folder not in self.known:
+                parent = os.path.dirname(folder)
+                if parent in self.created:
+                    missing.append(folder)
+                    break
+                if os.path.isdir(folder):
+                    self.known.add(folder)
+                    break
+                missing.append(folder)
+                if parent == folder:
+                    break
+                folder = parent
+            for folder in reversed(missing):
+                try:
+                    os.mkdir(folder)
+                except FileExistsError:
+                    # Made by someone else meanwhile; a file there is an error
+                    if not os.path.isdir(folder):
+                        raise
+                else:
+                    self.created.add(folder)
+                self.known.add(folder)
+            self.known.add(path)
+
+
+class CopyRun:
+    # Options and shared state of one copy operation, used by every worker
+
+    def __init__(
+        self,
+        progress,
+        cancel_flag,
+        skip_existing=False,
+        backend="auto",
+        delta=None,
+        verify=False,
+        chunk_sizer=None,
+    ):
+        self.progress = progress
+        self.cancel_flag = cancel_flag
+        self.skip_existing = skip_existing
+        self.selector = BackendSelector(backend)
+        # Optional block-level delta copier for large files (see delta_copy.py)
+        self.delta = delta
+        # Hash every copied file in the same read pass, for later verification
+        self.verify = verify
+        self.chunk_sizer = chunk_sizer if chunk_sizer is not None else ChunkSizer()
+        self.buffers = BufferPool()
+        self.dirs = DirCache()
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+def copy_file(src_path, dest_path, run, digest=None):
+    # With a digest the data has to pass through user space, so the kernel
+    # copy backends are bypassed
+    with open(src_path, "rb") as f_src, open(dest_path, "wb") as f_dst:
+        key, backends = run.selector.backends_for(f_src, f_dst)
+        if digest is not None:
+            return _readinto_loop(f_src, f_dst, run, key, digest)
+        for backend in backends:
+            try:
+                return copy_backends[backend](f_src, f_dst, run, key)
+            except BackendUnsupported:
+                run.selector.mark_unsupported(key, backend)
+    return True
+
+
+def pair_id(source, dest):
+    return hashlib.sha1(f"{source}|{dest}".encode("utf-8")).hexdigest()[:16]
+
+
+def manifest_name(source, dest):
+    return f"{pair_id(source, dest)}.json"
+
+
+def journal_name(source, dest):
+    return f"{pair_id(source, dest)}.journal"
+
+
+def hash_file(path, progress=None, cancel_flag=None):
+    # Returns None if cancelled
+    digest = new_digest()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while size := f.readinto(buffer):
+            if cancel_flag is not None and cancel_flag.is_set():
+                return None
+            digest.update(view[:size])
+            if progress is not None:
+                progress.add_copied(size)
+    return digest.hexdigest()
+
+
+class Manifest:
+    # Per folder pair record of what the last run left in the destination:
+    # {rel_path: [size, mtime_ns, hash or None]}. Without incremental, the
+    # manifest is only written (for verification) and never used to skip files.
+
+    def __init__(self, path, use_hash=False, incremental=True):
+        self.path = path
+        self.use_hash = use_hash
+        self.incremental = incremental
+        self.previous: dict = {}
+        self.current: dict = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.previous = json.load(f)["files"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable manifest '{path}': {e}")
+
+    def check_unchanged(self, job):
+        # Returns True if the destination copy is known to match the source.
+        # The copy itself is looked at too (one stat), so deleted or replaced
+        # backups are copied again.
+        src_path, dest_path, rel_path, size, mtime_ns = job
+        try:
+            dest_stat = os.stat(dest_path)
+        except OSError:
+            return False
+        if dest_stat.st_size != size:
+            return False
+        entry = self.previous.get(rel_path)
+        if entry is None:
+            # Bootstrap from an existing destination with preserved mtimes
+            if dest_stat.st_mtime_ns == mtime_ns:
+                self.record(rel_path, size, mtime_ns)
+                return True
+            return False
+
+        if entry[0] != size or dest_stat.st_mtime_ns != entry[1]:
+            # Not the copy the manifest recorded
+            return False
+        if entry[1] == mtime_ns:
+            self.record(rel_path, size, mtime_ns, entry[2])
+            return True
+        if self.use_hash and entry[2] is not None:
+            # Only the timestamp changed; compare contents before copying
+            file_hash = hash_file(src_path)
+            if file_hash == entry[2]:
+                try:
+                    os.utime(dest_path, ns=(mtime_ns, mtime_ns))
+                except OSError:
+                    return False
+                self.record(rel_path, size, mtime_ns, file_hash)
+                return True
+        return False
+
+    def check_plan_unchanged(self, plan):
+        # For destinations written as a whole (archives), every file must match
+        if len(self.previous) != len(plan.files):
+            return False
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            entry = self.previous.get(rel_path)
+            if entry is None or entry[0] != size or entry[1] != mtime_ns:
+                return False
+        return True
+
+    def record_plan(self, plan):
+        for src_path, rel_path, size, mtime_ns in plan.files:
+            self.record(rel_path, size, mtime_ns)
+
+    def record(self, rel_path, size, mtime_ns, file_hash=None):
+        with self.lock:
+            self.current[rel_path] = [size, mtime_ns, file_hash]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(temp_path, "w") as f:
+                json.dump({"version": 1, "files": self.current}, f)
+        os.replace(temp_path, self.path)
+
+
+def remove_partial(temp_path):
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+
+def existing_copy(job, run, manifest=None, journal=None):
+    # Why the destination needs no new copy of the job's file: "interrupted",
+    # "unchanged" or "existing"; None if it has to be copied
+    src_path, dest_path, rel_path, size, mtime_ns = job
+    if journal is not None:
+        entry = journal.completed_entry(rel_path, size, mtime_ns)
+        if entry is not None:
+            # Finished by the interrupted run; the destination is not checked
+            if manifest is not None:
+                manifest.record(rel_path, *entry)
+            return "interrupted"
+
+    run.dirs.make(os.path.dirname(dest_path))
+    if manifest is not None and manifest.incremental:
+        if manifest.check_unchanged(job):
+            return "unchanged"
+    elif (
+        run.skip_existing
+        and os.path.exists(dest_path)
+        and not (journal is not None and rel_path in journal.in_place)
+    ):
+        # A file the interrupted run was updating in place is damaged
+        if manifest is not None and rel_path in manifest.previous:
+            manifest.record(rel_path, *manifest.previous[rel_path])
+        return "existing"
+    return None
+
+
+_existing_messages: dict = {
+    "interrupted": "Skipped (copied before interruption): '{}'",
+    "existing": "Skipped (already exists): '{}'",
+}
+
+
+def skip_file(reason, rel_path, size, progress):
+    # Reports a file that existing_copy found in place
+    if reason == "unchanged":
+        progress.skip_unchanged(size)
+    else:
+        progress.log(_existing_messages[reason].format(rel_path), (139, 140, 0), "skip")
+        progress.remove_from_total(size)
+
+
+def copy_job(job, run, manifest=None, journal=None):
+    # Returns False only when the copy was cancelled
+    src_path, dest_path, rel_path, size, mtime_ns = job
+    progress = run.progress
+    if run.cancel_flag.is_set():
+        return False
+    progress.background_worker()
+
+    reason = existing_copy(job, run, manifest, journal)
+    if reason is not None:
+        skip_file(reason, rel_path, size, progress)
+        return True
+
+    # The hash is taken from the copy's own read of the source
+    digest = None
+    if run.verify or (manifest is not None and manifest.use_hash):
+        digest = new_digest()
+    temp_path = dest_path + copy_journal.partial_suffix
+    if journal is not None:
+        journal.started(rel_path)
+    try:
+        if run.delta is not None and run.delta.wants(size):
+            # Delta copies write changed blocks into the destination in place
+            # (or the whole file under the temporary name, without a signature)
+            if not run.delta.copy(job, run, digest, journal):
+                return False
+        else:
+            # A partial file never carries the final name
+            if not copy_file(src_path, temp_path, run, digest):
+                remove_partial(temp_path)
+                return False
+            # Keep the source timestamp so later runs can compare metadata
+            os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+            os.replace(temp_path, dest_path)
+        file_hash = digest.hexdigest() if digest is not None else None
+        if manifest is not None:
+            manifest.record(rel_path, size, mtime_ns, file_hash)
+        if journal is not None:
+            journal.done(rel_path, size, mtime_ns, file_hash)
+        progress.log(f"Copied: '{rel_path}'", (0, 140, 139), "copy")
+    except IOError as e:
+        remove_partial(temp_path)
+        progress.log_error(f"I/O Error copying '{rel_path}': {e}", "copy")
+    except Exception as e:
+        remove_partial(temp_path)
+        progress.log_error(f"Unexpected error copying '{rel_path}': {e}", "copy")
+    return True
+
+
+def device_of(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        # Unknown device; the path itself keeps the pair on its own lane
+        return path
+
+
+def schedule_by_device(items, paths_of):
+    # Groups items into lanes: items whose source or destination share a device
+    # end up in the same lane and run one after another, lanes run concurrently.
+    # paths_of(item) returns the (source, destination) paths of an item.
+    parents: dict = {}
+
+    def find(device):
+        while parents.setdefault(device, device) != device:
+            parents[device] = parents[parents[device]]
+            device = parents[device]
+        return device
+
+    item_devices = []
+    for item in items:
+        devices = [device_of(path) for path in paths_of(item)]
+        for device in devices[1:]:
+            parents[find(device)] = find(devices[0])
+        item_devices.append(devices[0])
+
+    lanes: dict = {}
+    for item, device in zip(items, item_devices):
+        lanes.setdefault(find(device), []).append(item)
+    return list(lanes.values())
+
+
+def run_lanes(lanes, run_item):
+    # run_item(item) returns False when cancelled; returns False if any lane was
+    def run_lane(lane):
+        for item in lane:
+            if not run_item(item):
+                return False
+        return True
+
+    if len(lanes) <= 1:
+        return all(run_lane(lane) for lane in lanes)
+    with ThreadPoolExecutor(
+        max_workers=len(lanes), thread_name_prefix="pair_lane"
+    ) as executor:
+        return all(list(executor.map(run_lane, lanes)))
+
+
+def run_parallel(items, run_item, workers, cancel_flag):
+    # run_item(item) returns False when cancelled; returns False if cancelled.
+    # items may be any iterable; only a few per worker are taken ahead, so a
+    # generator is consumed as the workers keep up.
+    workers = max(1, min(workers, max_workers))
+    if workers == 1 or (isinstance(items, (list, tuple)) and len(items) <= 1):
+        for item in items:
+            if not run_item(item):
+                return False
+        return True
+
+    results = []
+    pending = set()
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="copy_worker"
+    ) as executor:
+        try:
+            for item in items:
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    # Re-raise worker exceptions so the calling thread reports them
+                    results.extend(future.result() for future in done)
+                    if not all(results):
+                        break
+                pending.add(executor.submit(run_item, item))
+            results.extend(future.result() for future in as_completed(pending))
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return all(results) and not cancel_flag.is_set()
+
+
+def copy_files(jobs, run, workers, manifest=None, journal=None):
+    # jobs: list of (src_path, dest_path, rel_path, size, mtime_ns)
+    # Returns False if cancelled
+    return run_parallel(
+        jobs,
+        lambda job: copy_job(job, run, manifest, journal),
+        workers,
+        run.cancel_flag,
+    )
+
+
+class VerifyResult:
+    def __init__(self):
+        self.verified = 0
+        self.mismatched = 0
+        self.missing = 0
+        self.unhashed = 0
+        self.lock = threading.Lock()
+
+    def count(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+
+def verify_files(manifest, dest, progress, cancel_flag, workers, result):
+    # Re-hashes the destination files recorded in the manifest and compares
+    # them with the hashes taken while copying. Returns False if cancelled.
+    def verify_entry(item):
+        rel_path, (size, mtime_ns, file_hash) = item
+        dest_path = os.path.join(dest, rel_path)
+        progress.background_worker()
+        try:
+            dest_size = os.stat(dest_path).st_size
+        except FileNotFoundError:
+            progress.log_error(f"Missing from destination: '{rel_path}'", "verify")
+            progress.remove_from_total(size)
+            result.count("missing")
+            return True
+        if dest_size != size:
+            progress.log_error(
+                f"Size mismatch: '{rel_path}' ({dest_size} bytes, expected {size})",
+                "verify",
+            )
+            progress.remove_from_total(size)
+            result.count("mismatched")
+            return True
+        if file_hash is None:
+            progress.log(
+                f"Not verified (no hash recorded): '{rel_path}'", (139, 140, 0), "skip"
+            )
+            progress.remove_from_total(size)
+            result.count("unhashed")
+            return True
+
+        try:
+            dest_hash = hash_file(dest_path, progress, cancel_flag)
+        except OSError as e:
+            progress.log_error(f"Cannot read '{rel_path}': {e}", "verify")
+            result.count("mismatched")
+            return True
+        if dest_hash is None:
+            return False
+        if dest_hash != file_hash:
+            progress.log_error(f"Content mismatch: '{rel_path}'", "verify")
+            result.count("mismatched")
+        else:
+            progress.log(f"Verified: '{rel_path}'", (0, 140, 139), "copy")
+            result.count("verified")
+        return True
+
+    return run_parallel(
+        sorted(manifest.previous.items()), verify_entry, workers, cancel_flag
+    )
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# Crash-safe record of one folder pair's copy run. Every file gets a "started"
+# line before it is written and a "done" line once it has been renamed to its
+# final name. The journal is deleted when the pair finishes; if the run is
+# cancelled or the app dies, the next run skips the files marked done (as long
+# as the source still has the recorded size and mtime) without looking at the
+# destination, and restarts the ones that were in progress. Files updated in
+# place (delta copies) are marked as such, since an unfinished one is damaged
+# under its final name.
+
+partial_suffix: str = ".partial"
+fsync_interval: float = 1.0  # seconds; lines are flushed to the OS immediately
+
+
+class CopyJournal:
+    def __init__(self, path):
+        self.path = path
+        self.completed: dict = {}  # rel_path: [size, mtime_ns, hash or None]
+        self.interrupted: set = set()
+        self.in_place: set = set()  # interrupted while updated in place
+        self.lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._load()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash
+                        continue
+                    if record[0] == "s":
+                        self.interrupted.add(record[1])
+                        if record[2:] == ["in_place"]:
+                            self.in_place.add(record[1])
+                    elif record[0] == "d":
+                        self.interrupted.discard(record[1])
+                        self.in_place.discard(record[1])
+                        self.completed[record[1]] = record[2:]
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Ignoring unreadable copy journal '{self.path}': {e}")
+
+    @property
+    def resuming(self):
+        return bool(self.completed or self.interrupted)
+
+    def completed_entry(self, rel_path, size, mtime_ns):
+        # Returns the recorded entry if the file was finished by an earlier run
+        # and the source has not changed since
+        entry = self.completed.get(rel_path)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            return entry
+        return None
+
+    def discard_partials(self, dest):
+        # Temporary files of copies that never finished
+        for rel_path in self.interrupted:
+            try:
+                os.remove(os.path.join(dest, rel_path) + partial_suffix)
+            except OSError:
+                pass
+
+    def started(self, rel_path, in_place=False):
+        self._write(["s", rel_path, "in_place"] if in_place else ["s", rel_path])
+
+    def done(self, rel_path, size, mtime_ns, file_hash=None):
+        self._write(["d", rel_path, size, mtime_ns, file_hash])
+
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            now = time.monotonic()
+            if now - self._last_sync >= fsync_interval:
+                os.fsync(self.file.fileno())
+                self._last_sync = now
+
+    def close(self, finished):
+        # A finished run needs no journal; an unfinished one is resumed later
+        with self.lock:
+            self.file.close()
+        if finished:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,142 @@
+import os
+import struct
+import hashlib
+import logging
+
+import copy_engine
+import copy_journal
+
+# Block-level delta copy for large files. For every destination file above the
+# threshold a signature (one hash per block) is stored in signature_dir. On the
+# next run the source is hashed block by block and only blocks whose hash
+# differs from the signature are written, in place. A signature is only
+# trusted while the destination still has the size and mtime it recorded;
+# without one the file is copied whole under a temporary name like any other.
+# An in-place update that does not finish leaves a damaged file, so it is
+# deleted (or, after a crash, marked in the journal) to be copied again.
+
+_header = struct.Struct("<8sQQqQ")  # magic, block size, file size, mtime_ns, count
+_magic = b"SMSIG001"
+_digest_size = 16
+
+
+class DeltaCopier:
+    def __init__(self, signature_dir, threshold, block_size=copy_engine.chunk_size):
+        self.signature_dir = signature_dir
+        self.threshold = threshold
+        self.block_size = block_size
+        os.makedirs(signature_dir, exist_ok=True)
+
+    def wants(self, size):
+        return size >= self.threshold
+
+    def signature_path(self, dest_path):
+        key = os.path.normcase(os.path.abspath(dest_path)).encode("utf-8")
+        return os.path.join(self.signature_dir, hashlib.sha1(key).hexdigest() + ".sig")
+
+    def load_signature(self, dest_path):
+        # Returns the block hashes, or None if there is no trustworthy signature
+        try:
+            dest_stat = os.stat(dest_path)
+            with open(self.signature_path(dest_path), "rb") as f:
+                magic, block_size, size, mtime_ns, count = _header.unpack(
+                    f.read(_header.size)
+                )
+                data = f.read(count * _digest_size)
+        except (OSError, struct.error):
+            return None
+        if (
+            magic != _magic
+            or block_size != self.block_size
+            or size != dest_stat.st_size
+            or mtime_ns != dest_stat.st_mtime_ns
+            or len(data) != count * _digest_size
+        ):
+            return None
+        return [
+            data[offset : offset + _digest_size]
+            for offset in range(0, len(data), _digest_size)
+        ]
+
+    def save_signature(self, dest_path, size, mtime_ns, hashes):
+        path = self.signature_path(dest_path)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(_header.pack(_magic, self.block_size, size, mtime_ns, len(hashes)))
+            f.write(b"".join(hashes))
+        os.replace(f"{path}.tmp", path)
+
+    def remove_signature(self, dest_path):
+        try:
+            os.remove(self.signature_path(dest_path))
+        except FileNotFoundError:
+            pass
+
+    def copy(self, job, run, digest=None, journal=None):
+        # Returns False if cancelled. Progress only counts written blocks;
+        # unchanged blocks are taken off the total instead. digest, if given,
+        # receives the whole file for verification.
+        src_path, dest_path, rel_path, size, mtime_ns = job
+        old_hashes = self.load_signature(dest_path)
+        # The destination is about to change, so the old signature is void
+        self.remove_signature(dest_path)
+        if old_hashes is None:
+            target_path = dest_path + copy_journal.partial_suffix
+            mode = "wb"
+        else:
+            target_path = dest_path
+            mode = "r+b"
+            if journal is not None:
+                journal.started(rel_path, in_place=True)
+
+        hashes = []
+        written = 0
+        completed = True
+        view = memoryview(run.buffers.get(self.block_size))[: self.block_size]
+        try:
+            with open(src_path, "rb") as f_src, open(target_path, mode) as f_dst:
+                offset = 0
+                while length := f_src.readinto(view):
+                    if run.cancel_flag.is_set():
+                        completed = False
+                        break
+                    block = view[:length]
+                    block_hash = hashlib.blake2b(
+                        block, digest_size=_digest_size
+                    ).digest()
+                    index = len(hashes)
+                    hashes.append(block_hash)
+                    if digest is not None:
+                        digest.update(block)
+                    if (
+                        old_hashes is not None
+                        and index < len(old_hashes)
+                        and old_hashes[index] == block_hash
+                    ):
+                        run.progress.remove_from_total(length)
+                        run.progress.throttle_io(length)
+                    else:
+                        f_dst.seek(offset)
+                        f_dst.write(block)
+                        written += length
+                        run.progress.add_copied(length)
+                    offset += length
+                else:
+                    f_dst.truncate(offset)
+            if completed:
+                os.utime(target_path, ns=(mtime_ns, mtime_ns))
+                if target_path != dest_path:
+                    os.replace(target_path, dest_path)
+        except BaseException:
+            copy_engine.remove_partial(target_path)
+            raise
+        if not completed:
+            copy_engine.remove_partial(target_path)
+            return False
+
+        # Record what the filesystem actually stored (FAT/NTFS round timestamps)
+        self.save_signature(dest_path, offset, os.stat(dest_path).st_mtime_ns, hashes)
+        if old_hashes is not None:
+            logging.debug(
+                f"Delta copy of '{rel_path}': {written} of {offset} bytes written"
+            )
+        return True
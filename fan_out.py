@@ -0,0 +1,378 @@
+import os
+import time
+import queue
+import threading
+
+import copy_engine
+import copy_journal
+
+# Copies a folder pair to several destinations with a single read of the
+# source. Each chunk read goes to one writer thread per destination through a
+# bounded queue, so a slow destination can fall queue_depth chunks behind
+# before the reader waits for it. A destination that fails loses that file
+# only; one that disappears or stops taking chunks for stall_timeout is left
+# out for the rest of the run, and the other destinations carry on.
+
+queue_depth: int = 4  # chunks buffered per destination
+stall_timeout: float = 120.0  # seconds a destination may block the reader
+status_interval: float = 1.0  # seconds between throughput updates
+
+
+class Destination:
+    # One destination of a fanned-out folder pair, with its own manifest,
+    # journal and throughput
+
+    def __init__(self, path, manifest=None, journal=None):
+        self.path = path
+        self.manifest = manifest
+        self.journal = journal
+        self.available = True
+        self.written = 0
+        self.files = 0
+        self.failed = 0
+        self.waited = 0.0  # seconds the reader spent waiting for this one
+        self.start = self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add_written(self, size):
+        with self.lock:
+            self.written += size
+            self.last = time.monotonic()
+
+    def add_waited(self, seconds):
+        with self.lock:
+            self.waited += seconds
+
+    def count(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def rate(self):
+        return self.written / max(self.last - self.start, 1e-6)
+
+    def describe(self):
+        text = f"{self.files} files, {self.written / 1024**2:.1f} MB at {self.rate() / 1024**2:.1f} MB/s"
+        if self.waited >= 0.1:
+            text += f", held up the source for {self.waited:.1f} s"
+        if self.failed:
+            text += f", {self.failed} failed"
+        if not self.available:
+            text += ", unavailable"
+        return text
+
+
+class _Writer:
+    # Writes one file to one destination from a queue of chunks; None ends it
+
+    def __init__(self, destination, temp_path):
+        self.destination = destination
+        self.temp_path = temp_path
+        self.chunks = queue.Queue(maxsize=queue_depth)
+        self.error = None
+        self.stalled = False  # given up on by the reader
+        self.finished = threading.Event()
+
+    def feed(self, chunk):
+        # Returns False once the writer failed or stalled; it gets no more data
+        if self.error is not None or self.stalled:
+            return False
+        try:
+            self.chunks.put_nowait(chunk)
+            return True
+        except queue.Full:
+            pass
+        # This destination is the slowest one right now
+        start = time.monotonic()
+        try:
+            self.chunks.put(chunk, timeout=stall_timeout)
+        except queue.Full:
+            self.stalled = True
+        self.destination.add_waited(time.monotonic() - start)
+        return not self.stalled
+
+    def end(self):
+        if self.stalled:
+            return
+        try:
+            self.chunks.put(None, timeout=stall_timeout)
+        except queue.Full:
+            self.stalled = True
+
+    def wait(self):
+        # Gives up on the writer (stalled) once its destination has written
+        # nothing for stall_timeout
+        while not self.finished.wait(stall_timeout):
+            if time.monotonic() - self.destination.last >= stall_timeout:
+                self.stalled = True
+                return
+
+    def run(self, progress):
+        progress.background_worker()
+        try:
+            with open(self.temp_path, "wb") as f_dst:
+                while (chunk := self.chunks.get()) is not None:
+                    if self.stalled:
+                        break
+                    f_dst.write(chunk)
+                    self.destination.add_written(len(chunk))
+        except OSError as e:
+            self.error = e
+            # Keep taking chunks so the reader never waits on a failed writer
+            while not self.stalled:
+                try:
+                    if self.chunks.get(timeout=1.0) is None:
+                        break
+                except queue.Empty:
+                    pass
+        finally:
+            if self.stalled:
+                # Nobody waits for a stalled writer; it cleans up itself
+                copy_engine.remove_partial(self.temp_path)
+            self.finished.set()
+
+
+class _WriterThreads:
+    # Daemon threads for the writers. A writer stuck on a hung destination
+    # keeps its thread: new writers get another one instead of queueing behind
+    # it, and nothing waits for the stuck ones at the end of the run.
+
+    def __init__(self):
+        self.tasks = queue.SimpleQueue()
+        self.idle = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                threading.Thread(
+                    target=self._work, daemon=True, name="fan_out_writer"
+                ).start()
+        self.tasks.put((function, args))
+
+    def _work(self):
+        while (task := self.tasks.get()) is not None:
+            function, args = task
+            function(*args)
+            with self.lock:
+                if self.closed:
+                    return
+                self.idle += 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for _ in range(self.idle):
+                self.tasks.put(None)
+            self.idle = 0
+
+
+class FanOut:
+    # One copy of a folder pair's files to all of its destinations
+
+    def __init__(self, name, destinations, run, workers):
+        self.name = name
+        self.destinations = destinations
+        self.run = run
+        self.workers = max(1, min(workers, copy_engine.max_workers))
+        self.threads = None
+        self.last_status = 0.0
+        self.status_lock = threading.Lock()
+
+    def copy_files(self, plan):
+        # Returns False if cancelled
+        for destination in self.destinations:
+            destination.start = destination.last = time.monotonic()
+        # Every file in flight may need a writer per destination
+        self.threads = _WriterThreads()
+        try:
+            return copy_engine.run_parallel(
+                plan.files, self.copy_file, self.workers, self.run.cancel_flag
+            )
+        finally:
+            self.threads.close()
+            self.threads = None
+
+    def report(self):
+        # Per-destination throughput on the status line
+        now = time.monotonic()
+        with self.status_lock:
+            if now - self.last_status < status_interval:
+                return
+            self.last_status = now
+        rates = ", ".join(
+            f"'{destination.path}' {destination.rate() / 1024**2:.1f} MB/s"
+            for destination in self.destinations
+            if destination.available
+        )
+        self.run.progress.set_status(f"Copying '{self.name}': {rates}")
+
+    def lose(self, destination, error):
+        # Called after a failed write; a destination whose folder is gone, or
+        # that stalled, is left out from now on instead of failing (or holding
+        # up the source) file by file
+        if not isinstance(error, TimeoutError) and os.path.isdir(destination.path):
+            return
+        with destination.lock:
+            if not destination.available:
+                return
+            destination.available = False
+        self.run.progress.log_error(
+            f"Destination '{destination.path}' of folder pair '{self.name}' is no longer available ({error}); continuing with the other destinations",
+            "copy",
+        )
+
+    def fail(self, destination, temp_path, rel_path, error):
+        if not isinstance(error, TimeoutError):
+            # A stalled writer removes its partial file itself, if it ever can
+            copy_engine.remove_partial(temp_path)
+        destination.count("failed")
+        self.run.progress.log_error(
+            f"I/O Error copying '{rel_path}' to '{destination.path}': {error}", "copy"
+        )
+        self.lose(destination, error)
+
+    def copy_file(self, entry):
+        # Returns False only when the copy was cancelled
+        src_path, rel_path, size, mtime_ns = entry
+        run = self.run
+        progress = run.progress
+        if run.cancel_flag.is_set():
+            return False
+        progress.background_worker()
+
+        targets = []
+        reasons = []
+        for destination in self.destinations:
+            if not destination.available:
+                continue
+            job = (
+                src_path,
+                os.path.join(destination.path, rel_path),
+                rel_path,
+                size,
+                mtime_ns,
+            )
+            try:
+                reason = copy_engine.existing_copy(
+                    job, run, destination.manifest, destination.journal
+                )
+            except OSError as e:
+                self.fail(
+                    destination, job[1] + copy_journal.partial_suffix, rel_path, e
+                )
+                continue
+            if reason is None:
+                targets.append((destination, job))
+            else:
+                reasons.append(reason)
+        if not targets:
+            if reasons:
+                # The source is only read when some destination needs it
+                copy_engine.skip_file(
+                    "unchanged" if "unchanged" in reasons else reasons[0],
+                    rel_path,
+                    size,
+                    progress,
+                )
+            else:
+                progress.remove_from_total(size)
+            return True
+
+        digest = None
+        if run.verify or any(
+            destination.manifest is not None and destination.manifest.use_hash
+            for destination, job in targets
+        ):
+            digest = copy_engine.new_digest()
+        for destination, job in targets:
+            if destination.journal is not None:
+                destination.journal.started(rel_path)
+
+        try:
+            results = self.write(src_path, targets, digest)
+        except OSError as e:
+            # The source itself could not be read
+            for destination, job in targets:
+                copy_engine.remove_partial(job[1] + copy_journal.partial_suffix)
+            progress.log_error(f"I/O Error reading '{rel_path}': {e}", "copy")
+            return True
+        if results is None:
+            for destination, job in targets:
+                copy_engine.remove_partial(job[1] + copy_journal.partial_suffix)
+            return False
+
+        file_hash = digest.hexdigest() if digest is not None else None
+        copied = 0
+        for (destination, job), error in zip(targets, results):
+            temp_path = job[1] + copy_journal.partial_suffix
+            if error is None:
+                try:
+                    # Keep the source timestamp so later runs can compare metadata
+                    os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+                    os.replace(temp_path, job[1])
+                except OSError as e:
+                    error = e
+            if error is not None:
+                self.fail(destination, temp_path, rel_path, error)
+                continue
+            if destination.manifest is not None:
+                destination.manifest.record(rel_path, size, mtime_ns, file_hash)
+            if destination.journal is not None:
+                destination.journal.done(rel_path, size, mtime_ns, file_hash)
+            destination.count("files")
+            copied += 1
+        if copied:
+            progress.log(
+                (
+                    f"Copied: '{rel_path}' ({copied} of {len(targets)} destinations)"
+                    if copied < len(targets)
+                    else f"Copied: '{rel_path}'"
+                ),
+                (0, 140, 139),
+                "copy",
+            )
+        self.report()
+        return True
+
+    def write(self, src_path, targets, digest):
+        # Returns the error (or None) per target, or None if cancelled. Small
+        # files are one chunk, so a slow destination never holds them up either
+        writers = [
+            _Writer(destination, job[1] + copy_journal.partial_suffix)
+            for destination, job in targets
+        ]
+        for writer in writers:
+            self.threads.submit(writer.run, self.run.progress)
+        cancelled = False
+        try:
+            with open(src_path, "rb") as f_src:
+                while chunk := f_src.read(copy_engine.chunk_size):
+                    if self.run.cancel_flag.is_set():
+                        cancelled = True
+                        break
+                    if digest is not None:
+                        digest.update(chunk)
+                    # The source bytes count once, however many destinations
+                    self.run.progress.add_copied(len(chunk))
+                    if not any([writer.feed(chunk) for writer in writers]):
+                        break
+                    self.report()
+        finally:
+            for writer in writers:
+                writer.end()
+            for writer in writers:
+                if not writer.stalled:
+                    writer.wait()
+        if cancelled:
+            return None
+        return [
+            (
+                TimeoutError(f"no progress for {stall_timeout:.0f} s")
+                if writer.stalled
+                else writer.error
+            )
+            for writer in writers
+        ]
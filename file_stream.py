@@ -0,0 +1,187 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+import copy_engine
+import file_walker
+import ignore_rules
+
+# Streaming scan for plain copies. A thread walks the source and hands each
+# folder's files to the copy stage through a bounded queue, so copying starts
+# with the first folder and memory does not grow with the tree. The progress
+# total comes from the size cache, or from a size-only walk; at the end it is
+# corrected to what the scan actually found. Without a cached size under the
+# limit, that walk has to finish before anything is copied, so a source over
+# the size limit never reaches the destination.
+
+queue_depth: int = 64  # batches buffered between the scan and the copy
+batch_size: int = 1000  # files per batch; larger folders take several
+
+
+class FileStream:
+    # Stands in for copy_engine.FilePlan where the files are needed once, in
+    # order: files and jobs() can be iterated a single time. The other
+    # attributes are final after that.
+
+    def __init__(
+        self,
+        source,
+        ignored_folders,
+        skip_hidden,
+        cancel_flag,
+        progress,
+        size_limit=None,
+        known_size=None,
+    ):
+        self.source = source
+        self.ignore = ignore_rules.compiled(ignored_folders, source)
+        self.skip_hidden = skip_hidden
+        self.cancel_flag = cancel_flag
+        self.progress = progress
+        self.size_limit = size_limit
+        # Bytes of this source in progress.total_bytes so far
+        self.known_size = known_size
+        self.counted = known_size or 0
+        self.dirs: list = []  # folders are announced through on_dir instead
+        # on_dir(rel_dir_path) is called on the scan thread, ahead of the copy
+        self.on_dir = None
+        self.dir_mtimes: dict = {}
+        self.file_count = 0
+        self.total_size = 0
+        self.over_limit = False
+        self.complete = False  # the whole tree was streamed
+        self.scan_time = 0.0
+        self.stop = threading.Event()  # the consumer went away
+
+    def check_size(self):
+        # Runs the size pass now if the limit has to be checked before
+        # copying; returns False if the source is over the limit
+        if self.known_size is None and self.size_limit is not None:
+            self._size_pass()
+            self.known_size = self.counted
+        return not self.over_limit
+
+    @property
+    def files(self):
+        return self._stream()
+
+    def jobs(self, dest):
+        return (
+            (src_path, os.path.join(dest, rel_path), rel_path, size, mtime_ns)
+            for src_path, rel_path, size, mtime_ns in self.files
+        )
+
+    def _stream(self):
+        start = time.perf_counter()
+        batches = queue.Queue(maxsize=queue_depth)
+        threads = []
+        # The limit is checked before any folder or file is copied
+        if self.check_size() and self.known_size is None:
+            threads.append(
+                threading.Thread(target=self._size_pass, daemon=True, name="size_pass")
+            )
+        if not self.over_limit:
+            threads.append(
+                threading.Thread(
+                    target=self._scan, args=(batches,), daemon=True, name="file_stream"
+                )
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            if not self.over_limit:
+                while (batch := batches.get()) is not None:
+                    if isinstance(batch, BaseException):
+                        raise batch
+                    for item in batch:
+                        self.file_count += 1
+                        self.total_size += item[2]
+                        yield item
+            self.complete = not (self.over_limit or self.cancel_flag.is_set())
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            self.scan_time = time.perf_counter() - start
+            # Replace the estimate in the progress total with what was found
+            self.progress.add_to_total(self.total_size - self.counted)
+
+    def _put(self, batches, item):
+        # Returns False once the consumer stopped taking batches
+        while not self.stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _scan(self, batches):
+        scanned = 0
+        try:
+            for dir_path, rel_dir_path, file_entries in file_walker.walk(
+                self.source,
+                self.ignore,
+                self.skip_hidden,
+                lambda reason, rel_path: copy_engine.log_skip(
+                    self.progress, reason, rel_path
+                ),
+                self.cancel_flag,
+            ):
+                if self.over_limit:
+                    break
+                try:
+                    self.dir_mtimes[rel_dir_path] = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    pass
+
+                files = []
+                for entry in file_entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        logging.error("File deleted during folder scan")
+                        continue
+                    except OSError as e:
+                        # Too late to skip the pair; the file counts as failed
+                        self.progress.log_error(
+                            f"Cannot read '{entry.path}': {e}", "copy"
+                        )
+                        continue
+                    rel_path = file_walker.join_rel(rel_dir_path, entry.name)
+                    files.append((entry.path, rel_path, stat.st_size, stat.st_mtime_ns))
+                    scanned += stat.st_size
+                # Empty folders are copied too
+                if self.on_dir is not None:
+                    self.on_dir(rel_dir_path)
+                for index in range(0, len(files), batch_size):
+                    if not self._put(batches, files[index : index + batch_size]):
+                        return
+
+                if self.size_limit is not None and scanned > self.size_limit:
+                    self.over_limit = True
+        except Exception as e:
+            self._put(batches, e)
+            return
+        self._put(batches, None)
+
+    def _size_pass(self):
+        # Counts the tree ahead of the scan so the total is known early
+        for dir_path, rel_dir_path, file_entries in file_walker.walk(
+            self.source, self.ignore, self.skip_hidden, None, self.cancel_flag
+        ):
+            if self.stop.is_set() or self.over_limit:
+                return
+            size = 0
+            for entry in file_entries:
+                try:
+                    size += entry.stat().st_size
+                except OSError:
+                    pass
+            self.counted += size
+            self.progress.add_to_total(size)
+            if self.size_limit is not None and self.counted > self.size_limit:
+                self.over_limit = True
+                return
@@ -0,0 +1,89 @@
+import os
+import logging
+
+import ignore_rules
+
+# Tree walker shared by the copy engine and the file finder. It is built on
+# os.scandir so callers get DirEntry objects whose stat() result is cached
+# (and free on Windows, where the directory listing already carries it).
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def walk(
+    top,
+    ignored_folders=(),
+    skip_hidden=False,
+    on_skip=None,
+    cancel_flag=None,
+    rel_top=".",
+):
+    # Yields (dir_path, rel_dir_path, file_entries) top-down, parents first.
+    # ignored_folders are ignore rules (see ignore_rules.py), relative to top
+    # unless compiled rules are passed. Ignored and hidden folders are never
+    # descended into; on_skip(reason, rel_path) is called with "ignored",
+    # "hidden_folder", "hidden_file" or "unreadable" (a folder that could not
+    # be listed). rel_top is the relative path of top when walking part of a
+    # tree.
+    rules = ignore_rules.compiled(ignored_folders, top)
+    if rules.everything:
+        if on_skip is not None:
+            on_skip("ignored", rel_top)
+        return
+    stack = [(os.path.abspath(top), rel_top)]
+
+    while stack:
+        if cancel_flag is not None and cancel_flag.is_set():
+            return
+        dir_path, rel_dir_path = stack.pop()
+
+        if skip_hidden and os.path.basename(dir_path).startswith("."):
+            if on_skip is not None:
+                on_skip("hidden_folder", rel_dir_path)
+            continue
+
+        file_entries = []
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if rules:
+                        rel_path = join_rel(rel_dir_path, entry.name)
+                        if rules.match(rel_path, is_dir):
+                            if on_skip is not None:
+                                on_skip("ignored", rel_path)
+                            continue
+
+                    if is_dir:
+                        # Like os.walk, symlinked folders are not followed
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+
+                    if skip_hidden and entry.name.startswith("."):
+                        if on_skip is not None:
+                            on_skip("hidden_file", join_rel(rel_dir_path, entry.name))
+                        continue
+                    file_entries.append(entry)
+        except OSError as e:
+            if on_skip is not None:
+                on_skip("unreadable", rel_dir_path)
+            else:
+                logging.error(f"Cannot list folder '{dir_path}': {e}")
+            continue
+
+        yield dir_path, rel_dir_path, file_entries
+
+        for name in reversed(subdirs):
+            stack.append((os.path.join(dir_path, name), join_rel(rel_dir_path, name)))
+
+
+def join_rel(rel_dir_path, name):
+    return name if rel_dir_path == "." else os.path.join(rel_dir_path, name)
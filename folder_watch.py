@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import logging
+import threading
+
+import copy_engine
+import file_walker
+import ignore_rules
+
+# Continuous backup: each source folder is watched for changes (inotify on
+# Linux, ReadDirectoryChangesW on Windows, a polling snapshot elsewhere).
+# Changes are collected until the folder has been quiet for debounce_seconds
+# (or max_delay_seconds passed) and then handed over as one batch of relative
+# paths, so a game writing a save in many small steps causes a single copy.
+
+debounce_seconds: float = 2.0
+max_delay_seconds: float = 30.0
+poll_interval: float = 10.0
+
+
+class Changes:
+    # Relative paths that changed since the last batch
+
+    def __init__(self):
+        self.files: set = set()
+        self.dirs: set = set()
+        # Set when events were lost; the whole source has to be compared
+        self.rescan = False
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, rel_path, is_dir=False):
+        with self.lock:
+            (self.dirs if is_dir else self.files).add(rel_path)
+            self._touch()
+
+    def add_rescan(self):
+        with self.lock:
+            self.rescan = True
+            self._touch()
+
+    def _touch(self):
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+
+    def take_ready(self):
+        # Returns (files, dirs, rescan) once the burst is over, else None
+        with self.lock:
+            if self.first is None:
+                return None
+            now = time.monotonic()
+            if (
+                now - self.last < debounce_seconds
+                and now - self.first < max_delay_seconds
+            ):
+                return None
+            batch = (self.files, self.dirs, self.rescan)
+            self.files, self.dirs, self.rescan = set(), set(), False
+            self.first = self.last = None
+            return batch
+
+
+def _under(rel_dir_path, rel_path):
+    # rel_path is relative to rel_dir_path, which is relative to the source
+    if rel_path == ".":
+        return rel_dir_path
+    return file_walker.join_rel(rel_dir_path, rel_path)
+
+
+# inotify(7)
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_inotify_mask = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+)
+_inotify_event = struct.Struct("iIII")
+
+
+def _watch_inotify(source, changes, stop_flag):
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    watches: dict = {}  # watch descriptor: relative folder path
+
+    def add_tree(rel_dir_path):
+        # inotify is not recursive; every folder needs its own watch
+        for dir_path, rel_path, file_entries in file_walker.walk(
+            os.path.join(source, rel_dir_path)
+        ):
+            rel_path = _under(rel_dir_path, rel_path)
+            wd = libc.inotify_add_watch(fd, os.fsencode(dir_path), _inotify_mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached")
+                continue
+            watches[wd] = rel_path
+
+    try:
+        add_tree(".")
+        while not stop_flag.is_set():
+            ready, _, _ = select.select([fd], [], [], 0.5)
+            if not ready:
+                continue
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+                offset += _inotify_event.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    changes.add_rescan()
+                    continue
+                if mask & _IN_IGNORED:
+                    watches.pop(wd, None)
+                    continue
+                rel_dir_path = watches.get(wd)
+                if rel_dir_path is None or not name:
+                    continue
+                rel_path = file_walker.join_rel(rel_dir_path, name)
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO):
+                        # A folder moved in arrives with its contents and
+                        # without events for them
+                        add_tree(rel_path)
+                        changes.add(rel_path, is_dir=True)
+                else:
+                    changes.add(rel_path)
+    finally:
+        os.close(fd)
+
+
+# ReadDirectoryChangesW actions and filters
+_FILE_ACTION_ADDED = 1
+_FILE_ACTION_REMOVED = 2
+_FILE_ACTION_RENAMED_OLD_NAME = 4
+_FILE_ACTION_RENAMED_NEW_NAME = 5
+_FILE_LIST_DIRECTORY = 0x0001
+_FILE_NOTIFY_CHANGE_FILE_NAME = 0x0001
+_FILE_NOTIFY_CHANGE_DIR_NAME = 0x0002
+_FILE_NOTIFY_CHANGE_SIZE = 0x0008
+_FILE_NOTIFY_CHANGE_LAST_WRITE = 0x0010
+
+
+def _watch_windows(source, changes, stop_flag):
+    import win32con
+    import win32file
+
+    handle = win32file.CreateFile(
+        source,
+        _FILE_LIST_DIRECTORY,
+        win32con.FILE_SHARE_READ
+        | win32con.FILE_SHARE_WRITE
+        | win32con.FILE_SHARE_DELETE,
+        None,
+        win32con.OPEN_EXISTING,
+        win32con.FILE_FLAG_BACKUP_SEMANTICS,
+        None,
+    )
+    # The blocking read below is interrupted by closing the handle in stop()
+    stop_flag.handle = handle
+    try:
+        while not stop_flag.is_set():
+            try:
+                results = win32file.ReadDirectoryChangesW(
+                    handle,
+                    64 * 1024,
+                    True,
+                    _FILE_NOTIFY_CHANGE_FILE_NAME
+                    | _FILE_NOTIFY_CHANGE_DIR_NAME
+                    | _FILE_NOTIFY_CHANGE_SIZE
+                    | _FILE_NOTIFY_CHANGE_LAST_WRITE,
+                    None,
+                    None,
+                )
+            except Exception:
+                if stop_flag.is_set():
+                    return
+                raise
+            if not results:
+                # The change buffer overflowed
+                changes.add_rescan()
+                continue
+            for action, rel_path in results:
+                if action in (_FILE_ACTION_REMOVED, _FILE_ACTION_RENAMED_OLD_NAME):
+                    continue
+                if not os.path.isdir(os.path.join(source, rel_path)):
+                    changes.add(rel_path)
+                elif action in (_FILE_ACTION_ADDED, _FILE_ACTION_RENAMED_NEW_NAME):
+                    # Folders only matter when they appear; a "modified"
+                    # folder just had something inside it change
+                    changes.add(rel_path, is_dir=True)
+    finally:
+        handle.Close()
+
+
+def _snapshot(source):
+    snapshot = {}
+    for dir_path, rel_dir_path, file_entries in file_walker.walk(source):
+        for entry in file_entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snapshot[file_walker.join_rel(rel_dir_path, entry.name)] = (
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+    return snapshot
+
+
+def _watch_polling(source, changes, stop_flag):
+    # Fallback without change notifications: compare snapshots
+    previous = _snapshot(source)
+    while not stop_flag.wait(poll_interval):
+        current = _snapshot(source)
+        for rel_path, state in current.items():
+            if previous.get(rel_path) != state:
+                changes.add(rel_path)
+        previous = current
+
+
+def _backends():
+    backends = []
+    if sys.platform.startswith("linux"):
+        backends.append(("inotify", _watch_inotify))
+    elif sys.platform == "win32":
+        backends.append(("ReadDirectoryChangesW", _watch_windows))
+    backends.append(("polling", _watch_polling))
+    return backends
+
+
+class _StopFlag(threading.Event):
+    handle = None
+
+
+class FolderWatcher:
+    # Watches one source; on_changes(files, dirs, rescan) runs on the
+    # watcher's own thread for every debounced batch
+
+    def __init__(self, source, on_changes):
+        self.source = source
+        self.on_changes = on_changes
+        self.changes = Changes()
+        self.stop_flag = _StopFlag()
+        self.backend = None
+        self.threads: list = []
+
+    def start(self):
+        for target in (self._watch, self._deliver):
+            thread = threading.Thread(target=target, daemon=True, name="folder_watch")
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_flag.set()
+        if self.stop_flag.handle is not None:
+            try:
+                self.stop_flag.handle.Close()
+            except Exception:
+                pass
+
+    def _watch(self):
+        for name, watch in _backends():
+            self.backend = name
+            try:
+                watch(self.source, self.changes, self.stop_flag)
+                return
+            except Exception as e:
+                if self.stop_flag.is_set():
+                    return
+                logging.warning(
+                    f"Watching '{self.source}' with {name} failed, falling back: {e}"
+                )
+
+    def _deliver(self):
+        while not self.stop_flag.wait(0.25):
+            batch = self.changes.take_ready()
+            if batch is None:
+                continue
+            try:
+                self.on_changes(*batch)
+            except Exception as e:
+                logging.error(
+                    f"Continuous backup of '{self.source}' failed: {e}", exc_info=True
+                )
+
+
+def _excluded(rel_path, rules, skip_hidden, is_dir=False):
+    if skip_hidden and any(part.startswith(".") for part in rel_path.split(os.sep)):
+        return True
+    return bool(rules) and rules.excludes(rel_path, is_dir)
+
+
+def plan_changes(source, files, dirs, ignored_folders, skip_hidden):
+    # Builds a copy plan for the changed paths only; deleted files drop out
+    plan = copy_engine.FilePlan(source)
+    plan.ignore = ignore_rules.compiled(ignored_folders, source)
+    seen = set()
+
+    def add_file(rel_path):
+        if rel_path in seen or _excluded(rel_path, plan.ignore, skip_hidden):
+            return
+        src_path = os.path.join(source, rel_path)
+        try:
+            stat = os.stat(src_path)
+        except OSError:
+            return
+        if not os.path.isfile(src_path):
+            return
+        seen.add(rel_path)
+        plan.files.append((src_path, rel_path, stat.st_size, stat.st_mtime_ns))
+        plan.total_size += stat.st_size
+
+    for rel_dir_path in sorted(dirs):
+        if _excluded(rel_dir_path, plan.ignore, skip_hidden, True):
+            continue
+        top = os.path.join(source, rel_dir_path)
+        for dir_path, rel_path, file_entries in file_walker.walk(
+            top, plan.ignore, skip_hidden, rel_top=rel_dir_path
+        ):
+            plan.dirs.append(rel_path)
+            for entry in file_entries:
+                add_file(file_walker.join_rel(rel_path, entry.name))
+    for rel_path in sorted(files):
+        add_file(rel_path)
+    return plan
+
+
+class LogOnlyQueue:
+    # Continuous backups log like manual runs but leave the progress bar alone
+
+    def __init__(self, target):
+        self.target = target
+
+    def put(self, item):
+        if item[0] not in ("progress", "adjust_total"):
+            self.target.put(item)
@@ -0,0 +1,193 @@
+import os
+import re
+import errno
+import threading
+from datetime import datetime
+
+import copy_engine
+import tree_delete
+
+# Generations destination mode: every run adds a timestamped folder with the
+# whole tree to the destination, browsable like a plain copy. Files with the
+# size and mtime of their copy in the previous generation are hardlinked to
+# it, so a run only writes the bytes that changed.
+#
+#   <dest>/2025-04-10_18-30-00/...
+#   <dest>/2025-04-11_18-30-00/...      unchanged files are links into the one above
+#
+# A generation is built as "<name>.partial" and renamed when it is complete.
+# Generations dropped by the retention rules are renamed to "<name>.deleting"
+# and deleted on a background thread. Neither kind is ever taken for a
+# finished generation, and leftovers of both are deleted by the next run.
+
+mode: str = "generations"
+name_format: str = "%Y-%m-%d_%H-%M-%S"
+partial_suffix: str = ".partial"
+deleting_suffix: str = ".deleting"
+_name_pattern = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(_\d+)?")
+
+
+def generation_time(name):
+    return datetime.strptime(name[:19], name_format)
+
+
+def sort_key(name):
+    # Generations made within the same second are numbered "_2", "_3", ... and
+    # sort by that number, so "_10" comes after "_9"
+    return name[:19], int(name[20:] or 1)
+
+
+def _dir_names(dest):
+    try:
+        with os.scandir(dest) as entries:
+            return [
+                entry.name for entry in entries if entry.is_dir(follow_symlinks=False)
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def list_generations(dest):
+    # Names of the finished generations, oldest first
+    return sorted(
+        (name for name in _dir_names(dest) if _name_pattern.fullmatch(name)),
+        key=sort_key,
+    )
+
+
+def leftovers(dest):
+    # Paths of unfinished generations and interrupted deletions
+    return [
+        os.path.join(dest, name)
+        for name in _dir_names(dest)
+        if name.endswith((partial_suffix, deleting_suffix))
+        and _name_pattern.fullmatch(name.rsplit(".", 1)[0])
+    ]
+
+
+def _new_name(dest):
+    name = datetime.now().strftime(name_format)
+    candidate = name
+    number = 1
+    while any(
+        os.path.lexists(os.path.join(dest, candidate + suffix))
+        for suffix in ("", partial_suffix, deleting_suffix)
+    ):
+        number += 1
+        candidate = f"{name}_{number}"
+    return candidate
+
+
+def select_pruned(names, keep_last, keep_daily, keep_weekly):
+    # Names of the generations no retention rule keeps. keep_daily keeps the
+    # newest generation of each of the last keep_daily days that have one,
+    # keep_weekly the same per ISO week. With every rule at 0 all are kept.
+    if not (keep_last or keep_daily or keep_weekly) or not names:
+        return []
+    newest_first = sorted(names, key=sort_key, reverse=True)
+    # The newest one is always kept; the next run links against it
+    keep = {newest_first[0], *newest_first[:keep_last]}
+    for count, period_format in ((keep_daily, "%Y-%m-%d"), (keep_weekly, "%G-%V")):
+        periods = set()
+        for name in newest_first:
+            period = generation_time(name).strftime(period_format)
+            if period in periods:
+                continue
+            if len(periods) >= count:
+                break
+            periods.add(period)
+            keep.add(name)
+    return [name for name in names if name not in keep]
+
+
+def write_generation(plan, dest, run, workers):
+    # Adds a generation of the plan to dest. Returns its path, or None if
+    # cancelled (the unfinished generation is deleted by the next run).
+    progress = run.progress
+    names = list_generations(dest)
+    previous = os.path.join(dest, names[-1]) if names else None
+    build_path = os.path.join(dest, _new_name(dest) + partial_suffix)
+    for rel_dir_path in plan.dirs:
+        run.dirs.make(os.path.join(build_path, rel_dir_path))
+    no_links = threading.Event()  # the destination cannot hardlink
+
+    def add_file(item):
+        src_path, rel_path, size, mtime_ns = item
+        if run.cancel_flag.is_set():
+            return False
+        progress.background_worker()
+        dest_path = os.path.join(build_path, rel_path)
+        if previous is not None and not no_links.is_set():
+            previous_path = os.path.join(previous, rel_path)
+            try:
+                previous_stat = os.stat(previous_path)
+            except OSError:
+                previous_stat = None
+            if (
+                previous_stat is not None
+                and previous_stat.st_size == size
+                and previous_stat.st_mtime_ns == mtime_ns
+            ):
+                try:
+                    os.link(previous_path, dest_path)
+                    progress.skip_unchanged(size)
+                    return True
+                except OSError as e:
+                    # A file at the link limit is copied; other errors mean
+                    # the file system has no hardlinks (FAT, some shares)
+                    if e.errno != errno.EMLINK and not no_links.is_set():
+                        no_links.set()
+                        progress.log(
+                            f"Hardlinks are not available in '{dest}' ({e}); copying unchanged files too",
+                            (139, 140, 0),
+                            "skip",
+                        )
+        try:
+            if not copy_engine.copy_file(src_path, dest_path, run):
+                return False
+            os.utime(dest_path, ns=(mtime_ns, mtime_ns))
+            progress.log(f"Copied: '{rel_path}'", (0, 140, 139), "copy")
+        except OSError as e:
+            progress.log_error(f"I/O Error copying '{rel_path}': {e}", "copy")
+        return True
+
+    if not copy_engine.run_parallel(plan.files, add_file, workers, run.cancel_flag):
+        return None
+    generation_path = build_path[: -len(partial_suffix)]
+    os.rename(build_path, generation_path)
+    return generation_path
+
+
+def prune(dest, keep_last, keep_daily, keep_weekly, progress, cancel_flag, workers):
+    # Hides the generations the retention rules drop by renaming them, then
+    # deletes them and any leftovers on a background thread. Returns the
+    # thread, or None if there is nothing to delete.
+    for name in select_pruned(
+        list_generations(dest), keep_last, keep_daily, keep_weekly
+    ):
+        path = os.path.join(dest, name)
+        try:
+            os.rename(path, path + deleting_suffix)
+        except OSError as e:
+            progress.log_error(f"Cannot remove generation '{path}': {e}", "delete")
+    doomed = leftovers(dest)
+    if not doomed:
+        return None
+
+    def delete():
+        stats = tree_delete.DeleteStats(progress, "Removing old generations:")
+        deleted = 0
+        for path in doomed:
+            if not tree_delete.delete_tree(path, stats, cancel_flag, workers):
+                break
+            deleted += 1
+        progress.log(
+            f"Removed {deleted} old or unfinished generations from '{dest}': {stats.files} files and {stats.dirs} folders deleted",
+            (139, 140, 0),
+            "delete",
+        )
+        progress.flush()
+
+    thread = threading.Thread(target=delete, daemon=True, name="prune_generations")
+    thread.start()
+    return thread
@@ -0,0 +1,224 @@
+import os
+import re
+import fnmatch
+
+# Ignore rules for a folder pair, compiled once per run and checked by the
+# walker for every entry, so ignored folders are never descended into.
+#
+#   C:\Games\Foo\Logs   absolute folder, as added with the folder picker
+#   *.tmp               any file or folder with a matching name, at any depth
+#   shader*/            a trailing slash only matches folders
+#   Saves/backup        a slash inside makes it relative to the pair's source
+#   **/cache/**         ** stands for any number of folders
+#
+# Rules without wildcards become hash set lookups (absolute folders are
+# rebased onto the source), "*.ext" and "name*" become one endswith or
+# startswith call, other name globs are joined into one regex, and the
+# remaining path globs share a trie of path segments.
+
+_MATCH_ANY = 1
+_MATCH_DIR = 2
+_wildcard = re.compile(r"[*?\[]")
+
+
+def _split(pattern):
+    return [os.path.normcase(part) for part in re.split(r"[\\/]+", pattern) if part]
+
+
+def _combined(globs):
+    if not globs:
+        return None
+    return re.compile("|".join(fnmatch.translate(glob) for glob in globs))
+
+
+class _Node:
+    __slots__ = ("literal", "globs", "any_depth", "repeat", "ends", "tail")
+
+    def __init__(self, repeat=False):
+        self.literal: dict = {}  # segment: _Node
+        self.globs: dict = {}  # glob: (regex, _Node)
+        self.any_depth = None  # _Node reached through "**"
+        self.repeat = repeat  # a "**" node also matches the next segment
+        self.ends = 0
+        self.tail = 0  # ends of this node and of the nodes "**" reaches from it
+
+
+class IgnoreRules:
+    def __init__(self, rules, root):
+        self.rules = list(rules)
+        self.everything = False  # root itself is ignored
+        self.paths: dict = {_MATCH_ANY: set(), _MATCH_DIR: set()}
+        self.names: dict = {_MATCH_ANY: set(), _MATCH_DIR: set()}
+        suffixes: dict = {_MATCH_ANY: [], _MATCH_DIR: []}
+        prefixes: dict = {_MATCH_ANY: [], _MATCH_DIR: []}
+        name_globs: dict = {_MATCH_ANY: [], _MATCH_DIR: []}
+        self._trie = _Node()
+        self._has_trie = False
+        self._last_parent = (None, None)  # (rel_path, trie states) of the last folder
+
+        root = os.path.normcase(os.path.abspath(root))
+        root_prefix = os.path.join(root, "")
+        for rule in self.rules:
+            rule = rule.strip()
+            if not rule:
+                continue
+            if os.path.isabs(rule):
+                path = os.path.normcase(os.path.abspath(rule))
+                # A folder above the source does not ignore it, as before
+                if path == root:
+                    self.everything = True
+                elif path.startswith(root_prefix):
+                    self.paths[_MATCH_ANY].add(path[len(root_prefix) :])
+                continue
+
+            kind = _MATCH_DIR if rule[-1] in "\\/" else _MATCH_ANY
+            parts = _split(rule)
+            if not parts:
+                continue
+            anchored = len(parts) > 1
+            if not any(_wildcard.search(part) for part in parts):
+                if anchored:
+                    self.paths[kind].add(os.sep.join(parts))
+                else:
+                    self.names[kind].add(parts[0])
+            elif not anchored and parts[0] != "**":
+                glob = parts[0]
+                if glob[0] == "*" and not _wildcard.search(glob[1:]):
+                    suffixes[kind].append(glob[1:])
+                elif glob[-1] == "*" and not _wildcard.search(glob[:-1]):
+                    prefixes[kind].append(glob[:-1])
+                else:
+                    name_globs[kind].append(glob)
+            else:
+                self._add_to_trie(parts, kind)
+        self.name_regex = {kind: _combined(globs) for kind, globs in name_globs.items()}
+        self._finish(self._trie)
+        self.suffixes = {kind: tuple(values) for kind, values in suffixes.items()}
+        self.prefixes = {kind: tuple(values) for kind, values in prefixes.items()}
+
+    def __bool__(self):
+        return (
+            self.everything
+            or self._has_trie
+            or any(self.paths.values())
+            or any(self.names.values())
+            or any(self.suffixes.values())
+            or any(self.prefixes.values())
+            or any(regex is not None for regex in self.name_regex.values())
+        )
+
+    def _add_to_trie(self, parts, kind):
+        self._has_trie = True
+        node = self._trie
+        for part in parts:
+            if part == "**":
+                if node.any_depth is None:
+                    node.any_depth = _Node(repeat=True)
+                node = node.any_depth
+            elif _wildcard.search(part):
+                if part not in node.globs:
+                    node.globs[part] = (re.compile(fnmatch.translate(part)), _Node())
+                node = node.globs[part][1]
+            else:
+                node = node.literal.setdefault(part, _Node())
+        node.ends |= kind
+
+    def _finish(self, node):
+        for child in node.literal.values():
+            self._finish(child)
+        for regex, child in node.globs.values():
+            self._finish(child)
+        node.tail = node.ends
+        if node.any_depth is not None:
+            self._finish(node.any_depth)
+            # A trailing "**" needs something below this node, so through it
+            # the node itself only matches as a folder ("cache/**" ignores the
+            # folder cache, not a file of that name)
+            if node.any_depth.tail:
+                node.tail |= _MATCH_DIR
+
+    @staticmethod
+    def _closure(nodes):
+        # Adds the nodes a "**" can reach without consuming a segment
+        states = {}
+        for node in nodes:
+            while node is not None and id(node) not in states:
+                states[id(node)] = node
+                node = node.any_depth
+        return list(states.values())
+
+    def _step(self, states, part):
+        next_states = []
+        for node in states:
+            if node.repeat:
+                next_states.append(node)
+            child = node.literal.get(part)
+            if child is not None:
+                next_states.append(child)
+            for regex, child in node.globs.values():
+                if regex.match(part):
+                    next_states.append(child)
+        return self._closure(next_states)
+
+    def _trie_states(self, rel_dir_path):
+        # Entries of one folder are checked one after another; its trie states
+        # are kept so each entry only costs one step
+        last_path, last_states = self._last_parent
+        if last_path == rel_dir_path:
+            return last_states
+        states = self._closure([self._trie])
+        if rel_dir_path:
+            for part in rel_dir_path.split(os.sep):
+                states = self._step(states, part)
+                if not states:
+                    break
+        self._last_parent = (rel_dir_path, states)
+        return states
+
+    def match(self, rel_path, is_dir=False):
+        # True if the entry at rel_path (relative to the root) is ignored.
+        # Only the entry itself is checked; the walker never gets below an
+        # ignored folder, so parents have been checked already.
+        if self.everything:
+            return True
+        kinds = (_MATCH_ANY, _MATCH_DIR) if is_dir else (_MATCH_ANY,)
+        key = os.path.normcase(rel_path)
+        parent, _, name = key.rpartition(os.sep)
+        for kind in kinds:
+            if key in self.paths[kind] or name in self.names[kind]:
+                return True
+            if name.endswith(self.suffixes[kind]) or name.startswith(
+                self.prefixes[kind]
+            ):
+                return True
+            regex = self.name_regex[kind]
+            if regex is not None and regex.match(name):
+                return True
+        if self._has_trie:
+            # The last step only needs to know whether a rule ends here
+            wanted = _MATCH_ANY | _MATCH_DIR if is_dir else _MATCH_ANY
+            for node in self._trie_states(parent):
+                if node.repeat and node.tail & wanted:
+                    return True
+                child = node.literal.get(name)
+                if child is not None and child.tail & wanted:
+                    return True
+                for regex, child in node.globs.values():
+                    if child.tail & wanted and regex.match(name):
+                        return True
+        return False
+
+    def excludes(self, rel_path, is_dir=False):
+        # Like match, for a path found without walking: checks its folders too
+        parts = rel_path.split(os.sep)
+        for depth in range(1, len(parts)):
+            if self.match(os.sep.join(parts[:depth]), True):
+                return True
+        return self.match(rel_path, is_dir)
+
+
+def compiled(rules, root):
+    # Accepts compiled rules or a list of rule strings
+    if isinstance(rules, IgnoreRules):
+        return rules
+    return IgnoreRules(rules or (), root)
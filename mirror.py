@@ -0,0 +1,100 @@
+import os
+
+import file_walker
+import tree_delete
+
+# Mirror mode: after a folder pair was copied, everything in the destination
+# that is not part of the source plan is removed. Paths the scan left out on
+# purpose (ignore rules, hidden files when they are skipped) are kept, like
+# rsync --delete without --delete-excluded. A source folder that could not be
+# listed looks empty, so a plan with such folders is not mirrored at all.
+
+
+def overlaps(dest, other_dests):
+    # True if dest is, contains or lies inside any of other_dests
+    dest = file_walker.normalize_path(dest)
+    for other in other_dests:
+        other = file_walker.normalize_path(other)
+        try:
+            common = os.path.commonpath([dest, other])
+        except ValueError:
+            # Different drives
+            continue
+        if common in (dest, other):
+            return True
+    return False
+
+
+def find_stale(plan, dest, skip_hidden, cancel_flag):
+    # Returns [(path, rel_path, is_dir)] of destination items missing from the
+    # source, or None if cancelled. Stale folders are listed but not entered.
+    # Names are compared case-folded where the filesystem is case-insensitive.
+    keep_files = {os.path.normcase(rel_path) for _, rel_path, _, _ in plan.files}
+    keep_dirs = {os.path.normcase(rel_path) for rel_path in plan.dirs}
+    excluded = {os.path.normcase(rel_path) for rel_path in plan.excluded}
+    stale = []
+    stack = ["."]
+
+    while stack:
+        if cancel_flag.is_set():
+            return None
+        rel_dir_path = stack.pop()
+        dir_path = os.path.join(dest, rel_dir_path) if rel_dir_path != "." else dest
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    rel_path = file_walker.join_rel(rel_dir_path, entry.name)
+                    key = os.path.normcase(rel_path)
+                    if key in excluded or (skip_hidden and entry.name.startswith(".")):
+                        continue
+                    # Junctions are links, like symlinks: removed, not entered
+                    is_dir = tree_delete.is_real_dir(entry)
+                    if plan.ignore and plan.ignore.match(rel_path, is_dir):
+                        # Matches an ignore rule but only exists in the destination
+                        continue
+                    if is_dir:
+                        if key in keep_dirs:
+                            stack.append(rel_path)
+                        else:
+                            stale.append((entry.path, rel_path, True))
+                    elif key not in keep_files:
+                        stale.append((entry.path, rel_path, False))
+        except FileNotFoundError:
+            continue
+    return stale
+
+
+def remove_stale(plan, dest, skip_hidden, progress, cancel_flag, workers=1):
+    # Returns the number of removed items, or None if cancelled
+    if plan.unreadable:
+        progress.log(
+            f"{len(plan.unreadable)} source folders could not be listed; not removing stale files from '{dest}'",
+            (139, 140, 0),
+            "skip",
+        )
+        return 0
+    stale = find_stale(plan, dest, skip_hidden, cancel_flag)
+    if stale is None:
+        return None
+
+    removed = 0
+    stats = tree_delete.DeleteStats(progress, "Removing stale files...")
+    for path, rel_path, is_dir in stale:
+        if cancel_flag.is_set():
+            return None
+        try:
+            if is_dir:
+                if not tree_delete.delete_tree(path, stats, cancel_flag, workers):
+                    return None
+                progress.log(
+                    f"Deleted folder and its contents: '{rel_path}'",
+                    (139, 140, 0),
+                    "delete",
+                )
+            else:
+                os.unlink(path)
+                progress.log(f"Deleted file: '{rel_path}'", (139, 140, 0), "delete")
+            removed += 1
+        except OSError as e:
+            progress.log_error(f"Failed to delete '{rel_path}': {e}", "delete")
+    return removed
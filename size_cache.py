@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+# Last known size and file count of every source, for the folder pair headers
+# and the size limit. An entry records the mtime of every folder it counted;
+# adding, removing or renaming anything changes the mtime of its folder, so
+# when all of them still match, the tree has the same files as before. Files
+# rewritten in place keep their folder's mtime, so the size of such a tree can
+# drift until max_age_seconds forces a walk.
+
+max_age_seconds: float = 24 * 60 * 60
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size} B" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def rules_key(ignored_folders, skip_hidden):
+    # Sizes depend on what the scan leaves out
+    text = json.dumps([sorted(ignored_folders), skip_hidden])
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class SizeCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries: dict = {}  # normalized source: entry
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f).get("sources", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable size cache '{path}': {e}")
+
+    @staticmethod
+    def _key(source):
+        return os.path.normcase(os.path.abspath(source))
+
+    def get(self, source):
+        # The last recorded entry, unchecked; good enough for display
+        return self.entries.get(self._key(source))
+
+    def lookup(self, source, key):
+        # The entry if it was made with the same rules and the tree is unchanged
+        entry = self.get(source)
+        if entry is None or entry["rules"] != key:
+            return None
+        if time.time() - entry["time"] > max_age_seconds:
+            return None
+        for rel_dir_path, mtime_ns in entry["dirs"].items():
+            try:
+                if os.stat(os.path.join(source, rel_dir_path)).st_mtime_ns != mtime_ns:
+                    return None
+            except OSError:
+                return None
+        return entry
+
+    def store(self, plan, key):
+        # complete is False when the scan stopped at the size limit; size is
+        # then a lower bound
+        entry = {
+            "rules": key,
+            "size": plan.total_size,
+            "files": plan.file_count,
+            "complete": not plan.over_limit,
+            "time": time.time(),
+            "dirs": plan.dir_mtimes,
+        }
+        with self.lock:
+            self.entries[self._key(plan.source)] = entry
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(temp_path, "w") as f:
+                json.dump({"version": 1, "sources": self.entries}, f)
+        os.replace(temp_path, self.path)
+
+
+def describe(entry):
+    # "1.2 GB, 345 files" for a pair header
+    if entry is None:
+        return None
+    if not entry["complete"]:
+        return f"over {format_size(entry['size'])}"
+    return f"{format_size(entry['size'])}, {entry['files']} files"
@@ -0,0 +1,290 @@
+import os
+import gzip
+import json
+import time
+import logging
+import tempfile
+import threading
+from datetime import datetime
+
+import copy_engine
+import copy_journal
+
+# Snapshot destination mode: every run of a folder pair adds a snapshot to a
+# content-addressed store in the destination. File contents are kept once,
+# named by their hash, so unchanged files and files identical to ones from
+# any other pair backed up to the same destination are not stored again. A
+# snapshot is a gzipped JSON lines index of paths, sizes, mtimes and hashes:
+#
+#   <dest>/SaveManager snapshots/objects/3f/3f0a...      file contents
+#   <dest>/SaveManager snapshots/index/<pair id>/<snapshot id>.jsonl.gz
+#
+# Files with the size and mtime recorded in the pair's last snapshot are not
+# read at all. Listing only reads the first line of each index, and restoring
+# only reads the index and the objects it names.
+
+mode: str = "snapshot"
+store_folder: str = "SaveManager snapshots"
+index_suffix: str = ".jsonl.gz"
+index_version: int = 1
+
+
+class SnapshotStore:
+    def __init__(self, dest):
+        self.root = os.path.join(dest, store_folder)
+        self.objects = os.path.join(self.root, "objects")
+        self.indexes = os.path.join(self.root, "index")
+
+    def object_path(self, file_hash):
+        return os.path.join(self.objects, file_hash[:2], file_hash)
+
+    def pair_dir(self, source):
+        return os.path.join(self.indexes, copy_engine.pair_id(source, self.root))
+
+    def snapshots(self, source=None):
+        # Headers of the snapshots of one source (or of all), oldest first
+        if source is not None:
+            pair_dirs = [self.pair_dir(source)]
+        else:
+            try:
+                pair_dirs = [entry.path for entry in os.scandir(self.indexes)]
+            except FileNotFoundError:
+                return []
+        headers = []
+        for pair_dir in pair_dirs:
+            try:
+                index_names = [
+                    name for name in os.listdir(pair_dir) if name.endswith(index_suffix)
+                ]
+            except FileNotFoundError:
+                continue
+            for index_name in index_names:
+                index_path = os.path.join(pair_dir, index_name)
+                try:
+                    with gzip.open(index_path, "rt", encoding="utf-8") as f:
+                        header = json.loads(f.readline())
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Ignoring unreadable snapshot '{index_path}': {e}")
+                    continue
+                header["path"] = index_path
+                headers.append(header)
+        return sorted(headers, key=lambda header: (header["time"], header["id"]))
+
+    @staticmethod
+    def read_index(index_path):
+        # Returns ({rel_path: [size, mtime_ns, hash]}, [rel_dir_path])
+        files = {}
+        dirs = []
+        with gzip.open(index_path, "rt", encoding="utf-8") as f:
+            f.readline()
+            for line in f:
+                record = json.loads(line)
+                if record[0] == "f":
+                    files[record[1]] = record[2:]
+                elif record[0] == "d":
+                    dirs.append(record[1])
+        return files, dirs
+
+    def latest_files(self, source):
+        # The files of the source's last snapshot, or {} before the first one
+        headers = self.snapshots(source)
+        if not headers:
+            return {}
+        try:
+            return self.read_index(headers[-1]["path"])[0]
+        except (OSError, ValueError) as e:
+            logging.warning(
+                f"Ignoring unreadable snapshot '{headers[-1]['path']}': {e}"
+            )
+            return {}
+
+    def add_file(self, src_path, size, progress, cancel_flag):
+        # Stores the file's contents unless an identical object exists.
+        # Returns (hash, whether the object is new); the hash is None if cancelled.
+        digest = copy_engine.new_digest()
+        os.makedirs(self.objects, exist_ok=True)
+        with open(src_path, "rb") as f_src:
+            if size <= copy_engine.chunk_size:
+                # Small files are hashed first and only written when new
+                data = f_src.read()
+                digest.update(data)
+                progress.add_copied(len(data))
+                file_hash = digest.hexdigest()
+                if os.path.exists(self.object_path(file_hash)):
+                    return file_hash, False
+                fd, temp_path = tempfile.mkstemp(
+                    suffix=copy_journal.partial_suffix, dir=self.objects
+                )
+                try:
+                    with os.fdopen(fd, "wb") as f_dst:
+                        f_dst.write(data)
+                except BaseException:
+                    copy_engine.remove_partial(temp_path)
+                    raise
+            else:
+                # Larger ones are written while hashed, then kept or dropped
+                fd, temp_path = tempfile.mkstemp(
+                    suffix=copy_journal.partial_suffix, dir=self.objects
+                )
+                try:
+                    with os.fdopen(fd, "wb") as f_dst:
+                        while chunk := f_src.read(copy_engine.chunk_size):
+                            if cancel_flag.is_set():
+                                os.remove(temp_path)
+                                return None, False
+                            digest.update(chunk)
+                            f_dst.write(chunk)
+                            progress.add_copied(len(chunk))
+                except BaseException:
+                    copy_engine.remove_partial(temp_path)
+                    raise
+                file_hash = digest.hexdigest()
+                if os.path.exists(self.object_path(file_hash)):
+                    os.remove(temp_path)
+                    return file_hash, False
+
+        object_path = self.object_path(file_hash)
+        try:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            # Two workers storing the same contents both end up with one object
+            os.replace(temp_path, object_path)
+        except BaseException:
+            copy_engine.remove_partial(temp_path)
+            raise
+        return file_hash, True
+
+    def write_index(self, header, files, dirs):
+        # Objects are all in place before the index that names them appears
+        pair_dir = self.pair_dir(header["source"])
+        os.makedirs(pair_dir, exist_ok=True)
+        snapshot_id = datetime.fromtimestamp(header["time"]).strftime(
+            "%Y-%m-%d_%H-%M-%S"
+        )
+        index_path = os.path.join(pair_dir, snapshot_id + index_suffix)
+        suffix = 1
+        while os.path.exists(index_path):
+            suffix += 1
+            index_path = os.path.join(pair_dir, f"{snapshot_id}_{suffix}{index_suffix}")
+        snapshot_id = os.path.basename(index_path)[: -len(index_suffix)]
+        header = {"version": index_version, "id": snapshot_id, **header}
+        temp_path = index_path + copy_journal.partial_suffix
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for rel_dir_path in dirs:
+                f.write(json.dumps(["d", rel_dir_path]) + "\n")
+            for rel_path in sorted(files):
+                f.write(json.dumps(["f", rel_path, *files[rel_path]]) + "\n")
+        os.replace(temp_path, index_path)
+        header["path"] = index_path
+        return header
+
+    def find(self, snapshot_id, source=None):
+        # The header of a snapshot by id; None if there is none
+        for header in self.snapshots(source):
+            if header["id"] == snapshot_id:
+                return header
+        return None
+
+
+class SnapshotStats:
+    def __init__(self):
+        self.new_files = 0
+        self.new_bytes = 0
+        self.unchanged_files = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def count(self, outcome, size=0):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if outcome == "new_files":
+                self.new_bytes += size
+
+
+def take_snapshot(plan, dest, name, progress, cancel_flag, workers):
+    # Adds a snapshot of the plan to the store in dest. Returns its header, or
+    # None if cancelled (objects stored so far are reused by the next run).
+    store = SnapshotStore(dest)
+    previous = store.latest_files(plan.source)
+    files: dict = {}
+    files_lock = threading.Lock()
+    stats = SnapshotStats()
+
+    def store_file(item):
+        src_path, rel_path, size, mtime_ns = item
+        if cancel_flag.is_set():
+            return False
+        progress.background_worker()
+        entry = previous.get(rel_path)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            # Unchanged since the last snapshot: only an index entry
+            with files_lock:
+                files[rel_path] = entry
+            stats.count("unchanged_files")
+            progress.skip_unchanged(size)
+            return True
+        try:
+            file_hash, new = store.add_file(src_path, size, progress, cancel_flag)
+        except OSError as e:
+            stats.count("failed")
+            progress.log_error(f"I/O Error storing '{rel_path}': {e}", "copy")
+            return True
+        if file_hash is None:
+            return False
+        with files_lock:
+            files[rel_path] = [size, mtime_ns, file_hash]
+        if new:
+            stats.count("new_files", size)
+            progress.log(f"Stored: '{rel_path}'", (0, 140, 139), "copy")
+        else:
+            progress.log(
+                f"Skipped (already stored): '{rel_path}'", (139, 140, 0), "skip"
+            )
+        return True
+
+    if not copy_engine.run_parallel(plan.files, store_file, workers, cancel_flag):
+        return None
+    header = {
+        "name": name,
+        "source": plan.source,
+        "time": time.time(),
+        "files": len(files),
+        "size": sum(entry[0] for entry in files.values()),
+        "new_files": stats.new_files,
+        "new_bytes": stats.new_bytes,
+        "failed": stats.failed,
+    }
+    return store.write_index(header, files, plan.dirs)
+
+
+def restore_snapshot(store, header, target, progress, cancel_flag, workers):
+    # Recreates a snapshot's files under target from the index and the
+    # objects it names. Returns False if cancelled.
+    files, dirs = store.read_index(header["path"])
+    run = copy_engine.CopyRun(progress, cancel_flag)
+    for rel_dir_path in dirs:
+        run.dirs.make(os.path.join(target, rel_dir_path))
+
+    def restore_file(item):
+        rel_path, (size, mtime_ns, file_hash) = item
+        if cancel_flag.is_set():
+            return False
+        progress.background_worker()
+        dest_path = os.path.join(target, rel_path)
+        temp_path = dest_path + copy_journal.partial_suffix
+        try:
+            run.dirs.make(os.path.dirname(dest_path))
+            if not copy_engine.copy_file(store.object_path(file_hash), temp_path, run):
+                copy_engine.remove_partial(temp_path)
+                return False
+            os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+            os.replace(temp_path, dest_path)
+            progress.log(f"Restored: '{rel_path}'", (0, 140, 139), "copy")
+        except OSError as e:
+            copy_engine.remove_partial(temp_path)
+            progress.log_error(f"I/O Error restoring '{rel_path}': {e}", "restore")
+        return True
+
+    return copy_engine.run_parallel(
+        sorted(files.items()), restore_file, workers, cancel_flag
+    )
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import ctypes
+import logging
+import platform
+import threading
+
+# Keeps backups from competing with games for the disk: a bandwidth limit
+# shared by every worker of a run, and an optional low I/O priority for the
+# threads doing the copying, hashing and deleting.
+
+_sleep_slice: float = 0.1  # seconds; bounds how long a cancel can go unnoticed
+
+
+class TokenBucket:
+    # Workers pay for bytes after moving them; once the bucket is in debt the
+    # caller sleeps until the debt is paid, so the long-run rate stays at rate
+    # while bursts are bounded by burst
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # bytes per second
+        self.burst = burst if burst is not None else max(rate / 4, 64 * 1024)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size, cancel_flag=None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        while wait > 0:
+            if cancel_flag is not None and cancel_flag.is_set():
+                return
+            time.sleep(min(wait, _sleep_slice))
+            wait -= _sleep_slice
+
+
+# ioprio_set syscall numbers; the idle class only gets disk time nobody else uses
+_ioprio_syscalls = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+_THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+_IOPOL_TYPE_DISK = 0
+_IOPOL_SCOPE_THREAD = 1
+_IOPOL_THROTTLE = 3
+
+_lowered = threading.local()
+
+
+def lower_thread_priority():
+    # Lowers the calling thread's CPU and I/O priority where the OS allows it.
+    # Done once per thread; worker threads are discarded after each stage.
+    if getattr(_lowered, "done", False):
+        return
+    _lowered.done = True
+    try:
+        if sys.platform == "win32":
+            # Background mode lowers both the I/O and the memory priority
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(
+                kernel32.GetCurrentThread(), _THREAD_MODE_BACKGROUND_BEGIN
+            )
+        elif sys.platform.startswith("linux"):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+            syscall_number = _ioprio_syscalls.get(platform.machine())
+            if syscall_number is not None:
+                libc = ctypes.CDLL(None, use_errno=True)
+                # who 0 is the calling thread
+                libc.syscall(
+                    syscall_number,
+                    _IOPRIO_WHO_PROCESS,
+                    0,
+                    _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT,
+                )
+        elif sys.platform == "darwin":
+            libc = ctypes.CDLL(None)
+            libc.setiopolicy_np(_IOPOL_TYPE_DISK, _IOPOL_SCOPE_THREAD, _IOPOL_THROTTLE)
+    except (OSError, AttributeError) as e:
+        logging.debug(f"Cannot lower thread priority: {e}")
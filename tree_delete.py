@@ -0,0 +1,149 @@
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel folder deletion. One thread lists the tree and hands every folder's
+# files to the pool in batches while it keeps listing; once all files are gone
+# the folders are removed bottom-up, all folders of one depth at a time. Only
+# counts are reported (as a throttled status line), not every deleted item.
+
+batch_size: int = 64
+
+
+class DeleteStats:
+    def __init__(self, progress, label):
+        self.progress = progress
+        self.label = label
+        self.files = 0
+        self.dirs = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, files=0, dirs=0, errors=0):
+        with self.lock:
+            self.files += files
+            self.dirs += dirs
+            self.errors += errors
+            message = f"{self.label} {self.files} files, {self.dirs} folders deleted"
+        self.progress.set_status(message)
+
+
+def _is_link(stat_result):
+    # Symlinks, and on Windows junctions and other reparse points: removing
+    # one must never touch what it points to
+    return stat.S_ISLNK(stat_result.st_mode) or bool(
+        getattr(stat_result, "st_file_attributes", 0)
+        & stat.FILE_ATTRIBUTE_REPARSE_POINT
+    )
+
+
+def is_real_dir(entry):
+    # True for a DirEntry of a folder that can be descended into.
+    # is_dir(follow_symlinks=False) alone is also True for junctions.
+    try:
+        return entry.is_dir(follow_symlinks=False) and not _is_link(
+            entry.stat(follow_symlinks=False)
+        )
+    except OSError:
+        return False
+
+
+def _remove(remove_function, path):
+    try:
+        remove_function(path)
+    except PermissionError:
+        # Read-only items cannot be deleted on Windows until made writable
+        os.chmod(path, stat.S_IWRITE)
+        remove_function(path)
+
+
+def _unlink_batch(paths, stats, cancel_flag):
+    stats.progress.background_worker()
+    removed = 0
+    for path in paths:
+        if cancel_flag.is_set():
+            break
+        try:
+            _remove(os.unlink, path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            stats.add(errors=1)
+            stats.progress.log_error(f"Failed to delete '{path}': {e}", "delete")
+    stats.add(files=removed)
+
+
+def _rmdir(path, stats):
+    stats.progress.background_worker()
+    try:
+        _remove(os.rmdir, path)
+        stats.add(dirs=1)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        stats.add(errors=1)
+        stats.progress.log_error(f"Failed to delete '{path}': {e}", "delete")
+
+
+def delete_tree(path, stats, cancel_flag, workers, keep_root=False):
+    # Deletes everything below path, and path itself unless keep_root.
+    # Symlinks and junctions are removed, never followed. Returns False if
+    # cancelled.
+    try:
+        path_stat = os.lstat(path)
+        is_dir = stat.S_ISDIR(path_stat.st_mode) and not _is_link(path_stat)
+    except OSError:
+        is_dir = False
+    if not is_dir:
+        if not keep_root:
+            _unlink_batch([path], stats, cancel_flag)
+        return not cancel_flag.is_set()
+
+    dirs_by_depth: dict = {}
+    with ThreadPoolExecutor(
+        max_workers=max(1, workers), thread_name_prefix="deleter"
+    ) as executor:
+        futures = []
+        stack = [(path, 0)]
+        while stack and not cancel_flag.is_set():
+            dir_path, depth = stack.pop()
+            dirs_by_depth.setdefault(depth, []).append(dir_path)
+            files = []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if is_real_dir(entry):
+                            stack.append((entry.path, depth + 1))
+                        else:
+                            files.append(entry.path)
+            except OSError as e:
+                stats.add(errors=1)
+                stats.progress.log_error(f"Cannot list '{dir_path}': {e}", "delete")
+                continue
+            for start in range(0, len(files), batch_size):
+                futures.append(
+                    executor.submit(
+                        _unlink_batch,
+                        files[start : start + batch_size],
+                        stats,
+                        cancel_flag,
+                    )
+                )
+
+        # Every file of a folder must be gone before the folder can be removed
+        for future in futures:
+            future.result()
+        if cancel_flag.is_set():
+            return False
+
+        if keep_root:
+            dirs_by_depth.pop(0, None)
+        for depth in sorted(dirs_by_depth, reverse=True):
+            list(
+                executor.map(
+                    lambda dir_path: _rmdir(dir_path, stats), dirs_by_depth[depth]
+                )
+            )
+    return not cancel_flag.is_set()